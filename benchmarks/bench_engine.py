@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Benchmark the subprocess and worker certbot engines.
+
+A fake certbot package, with a configurable start-up delay standing in
+for certbot's interpreter start-up and plugin imports, is used to
+acquire and deploy a number of certificates with each engine. The
+per-certificate wall time of each engine is reported.
+
+Usage: bench_engine.py [--count=N] [--startup=SECONDS] [--json]
+"""
+
+import argparse
+import configparser
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from engine import CertbotWorker  # noqa: E402
+
+FAKE_INIT = '''
+import time
+
+time.sleep({startup})
+'''
+
+FAKE_MAIN = '''
+import os
+
+
+def main(argv):
+    opts = dict(a[2:].split("=", 1) for a in argv if a.startswith("--") and "=" in a)
+    live = os.path.join(opts["config-dir"], "live", opts["cert-name"])
+    os.makedirs(live, exist_ok=True)
+    for name in ("cert", "chain", "fullchain", "privkey"):
+        with open(os.path.join(live, name + ".pem"), "w") as f:
+            f.write(opts["cert-name"] + " " + name + "\\n")
+'''
+
+FAKE_CLI = '''#!{python}
+import sys
+
+from certbot.main import main
+
+sys.exit(main(sys.argv[1:]))
+'''
+
+DEPLOY = "import sys, deploy; deploy.Deploy(sys.argv[1], sys.argv[2]).run()"
+
+
+def setup(dir, startup):
+    """Create the fake certbot and a deploy configuration."""
+    pkg = os.path.join(dir, "fake", "certbot")
+    os.makedirs(pkg)
+    with open(os.path.join(pkg, "__init__.py"), "w") as f:
+        f.write(FAKE_INIT.format(startup=startup))
+    with open(os.path.join(pkg, "main.py"), "w") as f:
+        f.write(FAKE_MAIN)
+    cli = os.path.join(dir, "fake", "certbot-cli")
+    with open(cli, "w") as f:
+        f.write(FAKE_CLI.format(python=sys.executable))
+    os.chmod(cli, 0o755)
+
+    os.mkdir(os.path.join(dir, "dest"))
+    configfile = os.path.join(dir, "config.ini")
+    config = configparser.ConfigParser()
+    config.add_section("deploy")
+    for key in ("cert-path", "chain-path", "combined-path", "fullchain-path", "key-path"):
+        config["DEFAULT"][key] = os.path.join(dir, "dest")
+    config["deploy"]["command"] = ""
+    with open(configfile, "w") as f:
+        config.write(f)
+    return cli, configfile
+
+
+def certbot_args(dir, mode, i):
+    return ["certonly", "-n", "--config-dir={}".format(os.path.join(dir, mode)),
+            "--cert-name={}-{}.example.com".format(mode, i)]
+
+
+def bench_subprocess(dir, cli, configfile, count):
+    times = []
+    for i in range(count):
+        start = time.monotonic()
+        args = certbot_args(dir, "subprocess", i)
+        subprocess.run([cli] + args, check=True)
+        lineage = os.path.join(dir, "subprocess", "live", args[-1].split("=")[1])
+        subprocess.run([sys.executable, "-c", DEPLOY, lineage, configfile], check=True)
+        times.append(time.monotonic() - start)
+    return times
+
+
+def bench_worker(dir, configfile, count):
+    times = []
+    start = time.monotonic()
+    worker = CertbotWorker([sys.executable, os.path.join(ROOT, "bin", "certbot_worker.py"),
+                            "--config={}".format(configfile)])
+    try:
+        for i in range(count):
+            args = certbot_args(dir, "worker", i)
+            worker.certbot(args)
+            worker.deploy(os.path.join(dir, "worker", "live", args[-1].split("=")[1]))
+            times.append(time.monotonic() - start)
+            start = time.monotonic()
+    finally:
+        worker.close()
+    return times
+
+
+def summarize(times):
+    return {
+        "count": len(times),
+        "total-seconds": sum(times),
+        "mean-seconds": statistics.mean(times),
+        "median-seconds": statistics.median(times),
+        "first-seconds": times[0],
+        "max-seconds": max(times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20,
+                        help="number of certificates to acquire with each engine")
+    parser.add_argument("--startup", type=float, default=1.0,
+                        help="simulated certbot start-up time in seconds")
+    parser.add_argument("--json", action="store_true", help="output results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir:
+        cli, configfile = setup(dir, args.startup)
+        os.environ["PYTHONPATH"] = os.pathsep.join([
+            os.path.join(dir, "fake"), os.path.join(ROOT, "bin"), os.path.join(ROOT, "src")])
+        results = {
+            "startup-seconds": args.startup,
+            "subprocess": summarize(bench_subprocess(dir, cli, configfile, args.count)),
+            # The first worker time includes starting the worker.
+            "worker": summarize(bench_worker(dir, configfile, args.count)),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("{} certificates, {:.2f}s simulated certbot start-up".format(
+        args.count, args.startup))
+    print("{:<12}{:>12}{:>12}{:>12}".format("engine", "total", "mean", "first"))
+    for engine in ("subprocess", "worker"):
+        r = results[engine]
+        print("{:<12}{:>11.3f}s{:>11.3f}s{:>11.3f}s".format(
+            engine, r["total-seconds"], r["mean-seconds"], r["first-seconds"]))
+
+
+if __name__ == "__main__":
+    main()
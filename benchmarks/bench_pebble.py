@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Benchmark issuance, deploy and renewal against a local Pebble server.
+
+The charm's own _get_certificate path is run, with the real certbot and
+bin/deploy.py, against Pebble, a test ACME server. pebble-challtestsrv
+is Pebble's DNS, resolving every name to 127.0.0.1, where the charm's
+http-01 responder answers the challenges. For each number of lineages
+the certificates are acquired one at a time and then renewed in a
+single renewal run. The certificates per minute, the p50 and p95
+issuance and deploy latencies and the renewal run wall time are
+reported.
+
+The charm works in /etc/letsencrypt and /etc/certbot-charm, so this
+must be run as root on a disposable machine with certbot installed and
+no existing certificates. It points certbot at Pebble using
+/etc/letsencrypt/cli.ini, and leaves the certificates it acquires.
+
+Usage: bench_pebble.py --pebble-dir=DIR [--lineages=1,100,1000]
+           [--engine=subprocess|worker] [--concurrency=N] [--json]
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from ops.testing import Harness  # noqa: E402
+
+import charm  # noqa: E402
+import state  # noqa: E402
+
+CLI_INI = "/etc/letsencrypt/cli.ini"
+
+# Ports of Pebble's ACME directory, the DNS server and the http-01
+# challenges in Pebble's test configuration.
+ACME_PORT = 14000
+DNS_PORT = 8053
+HTTP_PORT = 5002
+
+
+def wait_for_port(port, proc, timeout=30.0):
+    """Wait for a server process to listen on a local port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("{} exited with status {}".format(proc.args[0], proc.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("{} is not listening on port {}".format(proc.args[0], port))
+
+
+def start_servers(args, webroot, log):
+    """Start pebble-challtestsrv, Pebble and the http-01 responder.
+
+    Returns:
+        The server processes.
+    """
+    procs = []
+    cmds = [
+        # Only the DNS server is wanted, the http-01 port is the
+        # responder's.
+        ([args.challtestsrv, "-defaultIPv4", "127.0.0.1", "-defaultIPv6", "",
+          "-dns01", ":{}".format(DNS_PORT), "-http01", "", "-https01", "", "-tlsalpn01", ""],
+         DNS_PORT, None, None),
+        ([args.pebble, "-config", "test/config/pebble-config.json",
+          "-dnsserver", "127.0.0.1:{}".format(DNS_PORT)],
+         ACME_PORT, args.pebble_dir,
+         # Pebble's random validation delays and nonce rejections make
+         # timings noisy.
+         dict(os.environ, PEBBLE_VA_NOSLEEP="1", PEBBLE_WFE_NONCEREJECT="0")),
+        ([sys.executable, os.path.join(ROOT, "bin", "http01.py"), webroot, str(HTTP_PORT)],
+         HTTP_PORT, None, None),
+    ]
+    try:
+        for cmd, port, cwd, env in cmds:
+            procs.append(subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log,
+                                          stderr=subprocess.STDOUT))
+            wait_for_port(port, procs[-1])
+    except Exception:
+        stop_servers(procs)
+        raise
+    return procs
+
+
+def stop_servers(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+
+
+def setup_charm(args, dir, webroot, lineages):
+    """Create the charm, configured to deploy into dir.
+
+    Returns:
+        The charm and the list the time of each deploy is added to.
+    """
+    dest = os.path.join(dir, "dest")
+    os.mkdir(dest)
+    harness = Harness(charm.CertbotCharm)
+    harness.begin()
+    # The install hook without its packages.
+    for hook in ("deploy", "post"):
+        charm._host.symlink(os.path.join(ROOT, "bin", "deploy.py"),
+                            "/etc/letsencrypt/renewal-hooks/{}/certbot-charm".format(hook))
+    harness.update_config({
+        "cert-path": dest,
+        "chain-path": dest,
+        "combined-path": dest,
+        "fullchain-path": dest,
+        "key-path": dest,
+        "certbot-engine": args.engine,
+        "http-01-webroot": webroot,
+        # Pebble has no rate limits.
+        "rate-limits": "certificates-per-domain=0,orders=0,duplicates=0,failed-validations=0",
+        # Every certificate is due, and renewed in one run.
+        "renew-before-days": 100000,
+        "renewal-concurrency": args.concurrency,
+        "renewal-jitter-hours": 0,
+        "renewal-max-per-run": lineages,
+    })
+
+    deploys = []
+    deploy = harness.charm._deploy
+
+    def timed_deploy(*args, **kwargs):
+        start = time.monotonic()
+        deploy(*args, **kwargs)
+        deploys.append(time.monotonic() - start)
+
+    harness.charm._deploy = timed_deploy
+    return harness, deploys
+
+
+def percentile(times, p):
+    """Calculate the nearest-rank percentile of times."""
+    times = sorted(times)
+    return times[max(0, math.ceil(p / 100 * len(times)) - 1)]
+
+
+def latency(times):
+    return {
+        "p50-seconds": percentile(times, 50),
+        "p95-seconds": percentile(times, 95),
+        "max-seconds": max(times),
+    }
+
+
+def bench(harness, deploys, lineages):
+    """Acquire and renew a number of lineages.
+
+    Returns:
+        The results.
+    """
+    run = "{}-{}".format(lineages, int(time.time()))
+    names = ["bench-{}.{}.example.com".format(i, run) for i in range(lineages)]
+    del deploys[:]
+    issues = []
+    start = time.monotonic()
+    for name in names:
+        issue_start = time.monotonic()
+        harness.charm._get_certificate("http-01", True, "bench@example.com", name)
+        issues.append(time.monotonic() - issue_start)
+    issue_seconds = time.monotonic() - start
+
+    entries = [e for e in harness.charm._refresh_index() if e["name"] in names]
+    start = time.monotonic()
+    harness.charm._renew_due(entries)
+    renew_seconds = time.monotonic() - start
+    history = state.load_json(harness.charm._config_path("renewals.json"), {})
+    renewed = sum(1 for name in names if history.get(name, {}).get("status") == "ok")
+
+    return {
+        "lineages": lineages,
+        "issue": dict(latency(issues), **{
+            "seconds": issue_seconds,
+            "certificates-per-minute": lineages / issue_seconds * 60,
+        }),
+        "deploy": latency(deploys),
+        "renew": {
+            "seconds": renew_seconds,
+            "renewed": renewed,
+            "certificates-per-minute": renewed / renew_seconds * 60,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pebble-dir", required=True,
+                        help="Pebble source directory, for its configuration and certificates")
+    parser.add_argument("--pebble", default="pebble", help="Pebble executable")
+    parser.add_argument("--challtestsrv", default="pebble-challtestsrv",
+                        help="pebble-challtestsrv executable")
+    parser.add_argument("--lineages", default="1,100,1000",
+                        help="comma separated numbers of lineages to benchmark")
+    parser.add_argument("--engine", choices=["subprocess", "worker"], default="subprocess",
+                        help="certbot engine")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of certificates renewed concurrently")
+    parser.add_argument("--json", action="store_true", help="output results as JSON")
+    args = parser.parse_args()
+    try:
+        scales = [int(n) for n in args.lineages.split(",")]
+    except ValueError:
+        parser.error("invalid --lineages value {}".format(args.lineages))
+    if os.geteuid() != 0:
+        parser.error("must be run as root")
+    if shutil.which("certbot") is None:
+        parser.error("certbot is not installed")
+    if os.path.isdir("/etc/letsencrypt/live") and os.listdir("/etc/letsencrypt/live"):
+        parser.error("/etc/letsencrypt already has certificates")
+    if os.path.exists(CLI_INI):
+        parser.error("{} already exists".format(CLI_INI))
+
+    os.environ["REQUESTS_CA_BUNDLE"] = os.path.join(args.pebble_dir, "test", "certs",
+                                                    "pebble.minica.pem")
+    os.makedirs(os.path.dirname(CLI_INI), exist_ok=True)
+    with open(CLI_INI, "w") as f:
+        f.write("server = https://localhost:{}/dir\n".format(ACME_PORT))
+    with tempfile.TemporaryDirectory() as dir:
+        webroot = os.path.join(dir, "webroot")
+        os.mkdir(webroot)
+        with open(os.path.join(dir, "servers.log"), "wb") as log:
+            procs = start_servers(args, webroot, log)
+            try:
+                harness, deploys = setup_charm(args, dir, webroot, max(scales))
+                results = {
+                    "engine": args.engine,
+                    "concurrency": args.concurrency,
+                    "scales": [bench(harness, deploys, n) for n in scales],
+                }
+            finally:
+                stop_servers(procs)
+                os.unlink(CLI_INI)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("certbot engine {}, renewal concurrency {}".format(args.engine, args.concurrency))
+    print("{:>9}{:>10}{:>12}{:>12}{:>12}{:>12}{:>12}".format(
+        "lineages", "cert/min", "issue p50", "issue p95", "deploy p50", "deploy p95", "renew"))
+    for r in results["scales"]:
+        print("{:>9}{:>10.1f}{:>11.3f}s{:>11.3f}s{:>11.3f}s{:>11.3f}s{:>11.3f}s".format(
+            r["lineages"], r["issue"]["certificates-per-minute"], r["issue"]["p50-seconds"],
+            r["issue"]["p95-seconds"], r["deploy"]["p50-seconds"], r["deploy"]["p95-seconds"],
+            r["renew"]["seconds"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+
+"""Long-lived worker running certbot and the deploy hook in-process.
+
+Starting certbot costs several seconds of interpreter start-up and
+plugin imports. This worker pays that cost once and then serves any
+number of requests. Requests are read from stdin as one JSON object per
+line, each response is written to stdout as one JSON object per line.
+
+A request may contain:
+    certbot: List of arguments to pass to certbot.
+    env: Environment variables to set while certbot runs.
+    deploy: Path of a lineage to deploy once certbot succeeds.
+    flush: Run the deploy command for any coalesced deployments.
+
+A response contains "ok", and "error" if ok is false, along with the
+time taken by each step in "certbot-seconds" and "deploy-seconds".
+
+Usage: certbot_worker.py [--config=PATH] [--poll] [--resolver=ADDRESS]
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+import deploy
+
+
+def run_certbot(argv, env=None):
+    """Run certbot in-process.
+
+    Args:
+        argv: Arguments to pass to certbot.
+        env: Environment variables to set for this run only.
+
+    Returns:
+        None on success, otherwise a description of the failure.
+    """
+    from certbot.main import main
+
+    # certbot configures logging, and the exception hook, on every run;
+    # restore them so that runs don't accumulate state.
+    root = logging.getLogger()
+    handlers, level, excepthook = list(root.handlers), root.level, sys.excepthook
+    saved = {k: os.environ.get(k) for k in env or {}}
+    os.environ.update(env or {})
+    _reset_boto3()
+    try:
+        result = main(argv)
+    except SystemExit as err:
+        result = err.code
+    except Exception as err:
+        result = "{}: {}".format(type(err).__name__, err)
+    finally:
+        root.handlers, sys.excepthook = handlers, excepthook
+        root.setLevel(level)
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        _reset_boto3()
+    if not result:
+        return None
+    if isinstance(result, int):
+        return "certbot exited with status {}".format(result)
+    return str(result)
+
+
+def _reset_boto3():
+    """Forget boto3's default session.
+
+    The session caches the AWS configuration it was created with, the
+    dns-route53 plugin's credentials are selected by the environment of
+    each run.
+    """
+    boto3 = sys.modules.get("boto3")
+    if boto3 is not None:
+        boto3.DEFAULT_SESSION = None
+
+
+def handle(request, configpath):
+    """Handle a single request."""
+    response = {"ok": True}
+    if request.get("certbot"):
+        start = time.monotonic()
+        error = run_certbot(request["certbot"], request.get("env"))
+        response["certbot-seconds"] = time.monotonic() - start
+        if error:
+            response.update(ok=False, error=error)
+            return response
+    if request.get("deploy") or request.get("flush"):
+        start = time.monotonic()
+        ok = True
+        if request.get("deploy"):
+            ok = deploy.Deploy(request["deploy"], configpath).run() and ok
+        if request.get("flush"):
+            ok = deploy.run_pending(configpath) and ok
+        response["deploy-seconds"] = time.monotonic() - start
+        if not ok:
+            response.update(ok=False, error="deploy command failed")
+    return response
+
+
+def main(argv):
+    configpath = "/etc/certbot-charm/config.ini"
+    poll = False
+    resolver = None
+    for arg in argv:
+        key, _, value = arg.lstrip("-").partition("=")
+        if key == "config":
+            configpath = value
+        elif key == "poll":
+            poll = True
+        elif key == "resolver":
+            resolver = value or None
+        else:
+            raise ValueError("unknown option {}".format(arg))
+
+    # Keep the real stdout for responses, anything certbot prints goes
+    # to stderr.
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    if poll:
+        import propagation
+        propagation.install(resolver=resolver)
+    # Pay the import cost before the first request arrives.
+    import certbot.main  # noqa: F401
+
+    for line in sys.stdin:
+        try:
+            response = handle(json.loads(line), configpath)
+        except Exception as err:
+            response = {"ok": False, "error": "{}: {}".format(type(err).__name__, err)}
+        out.write(json.dumps(response) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
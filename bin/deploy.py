@@ -2,52 +2,356 @@
 # Copyright 2020 Canonical Ltd
 
 import configparser
+import datetime
+import hashlib
 import os
-import shutil
 import subprocess
 import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "src"))
+
+import metrics  # noqa: E402
+import ocsp  # noqa: E402
+import x509  # noqa: E402
+
+# Number of seconds to wait for an OCSP responder.
+OCSP_TIMEOUT = 10
 
 
 class Deploy:
     def __init__(self, path, configpath="/etc/certbot-charm/config.ini"):
         super().__init__()
         self._path = path
-        self._domain = os.path.basename(path)
+        self._name = os.path.basename(path)
+        self._domain = self._name
+        self._key_suffix = ""
         self._config = configparser.ConfigParser()
         self._config.read(configpath)
+        self._pendingpath = _pending_path(configpath)
+        self._ocspdir = os.path.join(os.path.dirname(configpath), "ocsp")
+        self._metrics = _metrics(configpath, self._config)
 
     def run(self):
-        self._copy_file("cert.pem", "cert-path", ".crt")
-        self._copy_file("chain.pem", "chain-path", "_chain.pem")
-
-        dst = self._config["deploy"]["combined-path"]
-        if dst:
-            if os.path.isdir(dst):
-                dst = os.path.join(dst, self._domain + ".pem")
-            with open(dst, "wb") as outf:
-                with open(os.path.join(self._path, "fullchain.pem"), "rb") as inf:
-                    shutil.copyfileobj(inf, outf)
-                with open(os.path.join(self._path, "privkey.pem"), "rb") as inf:
-                    shutil.copyfileobj(inf, outf)
-
-        self._copy_file("fullchain.pem", "fullchain-path", "_fullchain.pem")
-        self._copy_file("privkey.pem", "key-path", ".key")
+        """Deploy the lineage to the configured locations.
+
+        Targets whose content is unchanged are left alone and the deploy
+        command is only run if at least one target changed, or if no
+        targets are configured.
+
+        Returns:
+            False if the deploy command failed.
+        """
+        if not self._read_key_type():
+            return False
+        results = [
+            self._install(["cert.pem"], "cert-path", ".crt"),
+            self._install(["chain.pem"], "chain-path", "_chain.pem"),
+            self._install(["fullchain.pem", "privkey.pem"], "combined-path", ".pem"),
+            self._install(["fullchain.pem"], "fullchain-path", "_fullchain.pem"),
+            self._install(["privkey.pem"], "key-path", ".key"),
+            self._install_ocsp(),
+        ]
+        if self._metrics.enabled:
+            try:
+                cert = x509.parse_pem_file(os.path.join(self._path, "cert.pem"))
+                self._metrics.set_expiry(self._name, cert.not_after.timestamp())
+            except (OSError, ValueError) as err:
+                print("cannot read certificate expiry: ", err, file=sys.stderr)
+        configured = [r for r in results if r is not None]
+        if configured and not any(configured):
+            print("{} unchanged, not running deploy command".format(self._name))
+            return True
+
+        if self._config["deploy"].getboolean("coalesce", fallback=False):
+            # The deploy command will be run once by the post hook.
+            fd = os.open(self._pendingpath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self._domain + "\n")
+            return True
 
         cmd = self._config["deploy"]["command"]
         if cmd:
-            try:
-                subprocess.run(cmd, shell=True)
-            except subprocess.CalledProcessError as err:
-                print("error running deploy command: ", err, file=sys.stderr)
+            return _run_command(cmd, self._metrics)
+        return True
+
+    def update_ocsp(self):
+        """Refresh the OCSP staple of the lineage, if it is due.
+
+        The deploy command is not run.
+
+        Returns:
+            Whether the staple changed.
+        """
+        return self._read_key_type() and bool(self._install_ocsp())
+
+    def _read_key_type(self):
+        """With dual issuance, find the suffix of the lineage's targets.
 
-    def _copy_file(self, srcfile, dstkey, suffix):
+        Every target is suffixed with the key type, so that
+        <domain>.pem.ecdsa and <domain>.pem.rsa sit side by side.
+
+        Returns:
+            False if the certificate cannot be read.
+        """
+        if not self._config["deploy"].getboolean("key-type-suffix", fallback=False):
+            return True
+        try:
+            cert = x509.parse_pem_file(os.path.join(self._path, "cert.pem"))
+        except (OSError, ValueError) as err:
+            print("cannot read certificate key type: ", err, file=sys.stderr)
+            return False
+        self._key_suffix = "." + cert.key_type
+        if self._name.endswith("-" + cert.key_type):
+            self._domain = self._name[:-len(cert.key_type) - 1]
+        return True
+
+    def _install(self, srcfiles, dstkey, suffix):
+        """Install the concatenation of srcfiles to the target in dstkey.
+
+        Returns:
+            None if the target is not configured, otherwise whether the
+            target was changed.
+        """
         dst = self._config["deploy"].get(dstkey)
         if not dst:
-            return
+            return None
         if os.path.isdir(dst):
             dst = os.path.join(dst, self._domain + suffix)
-        shutil.copyfile(os.path.join(self._path, srcfile), dst)
+        dst += self._key_suffix
+        content = b""
+        for srcfile in srcfiles:
+            with open(os.path.join(self._path, srcfile), "rb") as f:
+                content += f.read()
+        return _update(dst, content)
+
+    def _install_ocsp(self):
+        """Install the lineage's OCSP response to the ocsp-path target.
+
+        HAProxy looks for the staple of a certificate file next to it,
+        with ".ocsp" appended, so a directory target gets
+        <domain>.pem.ocsp and the key type suffix goes before ".ocsp".
+
+        Returns:
+            None if the target is not configured, otherwise whether the
+            target was changed.
+        """
+        dst = self._config["deploy"].get("ocsp-path")
+        if not dst:
+            return None
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self._domain + ".pem.ocsp")
+        root, ext = os.path.splitext(dst)
+        if ext == ".ocsp":
+            dst = root + self._key_suffix + ext
+        else:
+            dst += self._key_suffix
+        response = self._ocsp_response()
+        if response is None:
+            return False
+        return _update(dst, response.der)
+
+    def _ocsp_response(self):
+        """Get a current OCSP response for the certificate.
+
+        The last response fetched is kept in the charm's configuration
+        directory and reused until half way through its validity period.
+        If a new response cannot be fetched, the last one is used until
+        it expires.
+
+        Returns:
+            The response, or None if there is no usable response.
+        """
+        cachepath = os.path.join(self._ocspdir, self._name + ".der")
+        cert = os.path.join(self._path, "cert.pem")
+        issuer = os.path.join(self._path, "chain.pem")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cached = None
+        try:
+            with open(cachepath, "rb") as f:
+                cached = ocsp.parse_response(f.read(), cert, issuer)
+        except (OSError, ValueError):
+            # Missing, or for the certificate before a renewal.
+            pass
+        if cached is not None and now < cached.refresh_at():
+            return cached
+        try:
+            response = ocsp.fetch(cert, issuer, timeout=OCSP_TIMEOUT)
+            if response.status != "good":
+                raise ocsp.OCSPError("certificate status is " + response.status)
+        except (OSError, ValueError) as err:
+            print("cannot fetch OCSP response for {}: {}".format(self._name, err),
+                  file=sys.stderr)
+            if cached is not None and cached.next_update and now < cached.next_update:
+                return cached
+            return None
+        os.makedirs(self._ocspdir, mode=0o700, exist_ok=True)
+        _write_atomic(cachepath, response.der)
+        return response
+
+
+def run_pending(configpath="/etc/certbot-charm/config.ini"):
+    """Run the deploy command for any pending coalesced deployments.
+
+    The command is run once, with the space-separated list of changed
+    domains in the CERTBOT_CHARM_DOMAINS environment variable. Nothing
+    is run if there are no pending deployments. If the command fails
+    the domains stay pending for the next run.
+
+    Returns:
+        False if the deploy command failed.
+    """
+    pendingpath = _pending_path(configpath)
+    processing = pendingpath + ".processing"
+    domains = []
+    if os.path.exists(processing):
+        # Left over from an interrupted run.
+        with open(processing) as f:
+            domains.extend(f)
+    try:
+        # Claim the pending list so that deployments recorded while the
+        # command is running are handled by the next run.
+        os.rename(pendingpath, processing)
+        with open(processing) as f:
+            domains.extend(f)
+    except FileNotFoundError:
+        if not domains:
+            return True
+    domains = list(dict.fromkeys(d.strip() for d in domains if d.strip()))
+
+    config = configparser.ConfigParser()
+    config.read(configpath)
+    cmd = config["deploy"]["command"]
+    ok = True
+    if cmd:
+        env = dict(os.environ, CERTBOT_CHARM_DOMAINS=" ".join(domains))
+        ok = _run_command(cmd, _metrics(configpath, config), env=env)
+    if ok:
+        os.unlink(processing)
+    else:
+        # Keep every domain, including those left over from earlier
+        # runs, for the next run to deploy.
+        _write_atomic(processing, "".join(d + "\n" for d in domains).encode("utf-8"))
+    return ok
+
+
+def refresh_ocsp(lineages, configpath="/etc/certbot-charm/config.ini"):
+    """Refresh the OCSP staples of lineages that are due.
+
+    The deploy command is run once if any staple changed, with the
+    space-separated list of changed lineages in the
+    CERTBOT_CHARM_DOMAINS environment variable.
+
+    Returns:
+        False if the deploy command failed.
+    """
+    changed = [os.path.basename(path) for path in lineages
+               if Deploy(path, configpath).update_ocsp()]
+    config = configparser.ConfigParser()
+    config.read(configpath)
+    cmd = config["deploy"]["command"]
+    if not changed or not cmd:
+        return True
+    env = dict(os.environ, CERTBOT_CHARM_DOMAINS=" ".join(changed))
+    return _run_command(cmd, _metrics(configpath, config), env=env)
+
+
+def _run_command(cmd, recorder, **kwargs):
+    """Run the deploy command, recording its outcome and duration.
+
+    Returns:
+        True if the command succeeded.
+    """
+    start = time.monotonic()
+    ok = False
+    try:
+        ok = subprocess.run(cmd, shell=True, **kwargs).returncode == 0
+        if not ok:
+            print("deploy command failed", file=sys.stderr)
+    except (OSError, subprocess.CalledProcessError) as err:
+        print("error running deploy command: ", err, file=sys.stderr)
+    recorder.record_deploy_command(ok, time.monotonic() - start)
+    return ok
+
+
+def _metrics(configpath, config):
+    return metrics.Metrics(os.path.join(os.path.dirname(configpath), "metrics.json"),
+                           config.get("metrics", "textfile", fallback=""))
+
+
+def _pending_path(configpath):
+    return os.path.join(os.path.dirname(configpath), "deploy-pending")
+
+
+def _update(path, content):
+    """Replace the file at path with content, unless it already has it.
+
+    Returns:
+        Whether the file was changed.
+    """
+    if _file_hash(path) == hashlib.sha256(content).hexdigest():
+        return False
+    _write_atomic(path, content)
+    return True
+
+
+def _file_hash(path):
+    """Calculate the SHA-256 of a file, or None if it doesn't exist."""
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def _write_atomic(path, content):
+    """Replace the file at path with content.
+
+    The content is written to a temporary file in the same directory,
+    synced to disk and then renamed over the target, so readers never
+    see a partially written file. The mode and ownership of an existing
+    target are preserved, a new file is only readable by its owner since
+    it may hold a private key.
+    """
+    directory = os.path.dirname(path) or "."
+    try:
+        st = os.stat(path)
+        mode, owner = st.st_mode & 0o7777, (st.st_uid, st.st_gid)
+    except FileNotFoundError:
+        mode, owner = 0o600, None
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        if owner is not None and owner != (os.getuid(), os.getgid()):
+            os.chown(tmp, *owner)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    dirfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
 
 
 if __name__ == "__main__":
-    Deploy(os.environ["RENEWED_LINEAGE"]).run()
+    # certbot sets RENEWED_LINEAGE for deploy hooks, but not for post
+    # hooks. The charm passes the lineages whose staples to refresh.
+    if sys.argv[1:2] == ["ocsp"]:
+        ok = refresh_ocsp(sys.argv[2:])
+    elif "RENEWED_LINEAGE" in os.environ:
+        ok = Deploy(os.environ["RENEWED_LINEAGE"]).run()
+    else:
+        ok = run_pending()
+    # Let the charm know the deploy command failed, certbot only warns.
+    sys.exit(0 if ok else 1)
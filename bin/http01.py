@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+
+"""Serve ACME http-01 challenges from a webroot.
+
+The charm runs this as the certbot-charm-http01 service when
+http-01-port is set.
+
+Usage: http01.py WEBROOT PORT
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "src"))
+
+import http01  # noqa: E402
+
+
+if __name__ == "__main__":
+    http01.run(sys.argv[1], int(sys.argv[2]))
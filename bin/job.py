@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+
+"""Run a get-certificate job in the background.
+
+The charm writes a job file describing the certbot command and the
+deploy steps, then starts this script detached from the hook so that
+the action can return immediately. The progress of the job is recorded
+in the job file as it runs. Jobs run one at a time, as certbot only
+allows a single instance to use its configuration.
+
+Usage: job.py JOB-FILE
+"""
+
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "src"))
+
+import keypool  # noqa: E402
+import metrics  # noqa: E402
+import ratelimit  # noqa: E402
+import state  # noqa: E402
+
+# The stages of a job, in order.
+STAGES = ("queued", "running", "challenge-published", "validating", "deploying", "done")
+
+# Output logged by certbot, when run with -v, as the request progresses.
+_MARKERS = (
+    ("for DNS changes to propagate", "challenge-published"),
+    ("Waiting for verification", "validating"),
+)
+
+
+class Job:
+    """A job and its state file.
+
+    Args:
+        path: Location of the job file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = state.load_json(path)
+        if self.data is None:
+            raise ValueError("cannot read job {}".format(path))
+
+    @property
+    def status(self) -> str:
+        return self.data["status"]
+
+    def update(self, status: str = None, **kwargs):
+        """Update the job's state file.
+
+        Args:
+            status: New status of the job, if it has changed.
+            kwargs: Other values to set in the job's state.
+        """
+        if status:
+            self.data["status"] = status
+            self.data["history"].append([status, time.time()])
+        self.data.update(kwargs)
+        state.save_json(self.path, self.data)
+
+    def advance(self, status: str):
+        """Move the job to a later stage, never an earlier one."""
+        if STAGES.index(status) > STAGES.index(self.status):
+            self.update(status)
+
+
+def run_command(cmd, env=None, timeout=None, on_line=None):
+    """Run a command, copying its output to stdout.
+
+    Args:
+        cmd: The command to run.
+        env: Environment for the command.
+        timeout: Number of seconds after which the command is killed.
+        on_line: Function called with each line of output.
+
+    Raises:
+        RuntimeError: The command failed or timed out.
+    """
+    killed = threading.Event()
+    last = ""
+    with subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True) as proc:
+
+        def kill():
+            killed.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            if line.strip():
+                last = line.strip()
+            if on_line:
+                on_line(line)
+        proc.wait()
+        if timer:
+            timer.cancel()
+    if killed.is_set():
+        raise RuntimeError("{} timed out after {}s".format(os.path.basename(cmd[0]), timeout))
+    if proc.returncode != 0:
+        raise RuntimeError("{} exited with status {}: {}".format(
+            os.path.basename(cmd[0]), proc.returncode, last))
+
+
+def run(path: str):
+    """Run the job in the given file."""
+    job = Job(path)
+    job.update(pid=os.getpid())
+    with open(os.path.join(os.path.dirname(path), ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        job.update("running")
+        timeouts = job.data.get("timeouts", {})
+        start = time.monotonic()
+        certbot_seconds = deploy_seconds = None
+
+        def progress(line):
+            for marker, status in _MARKERS:
+                if marker in line:
+                    job.advance(status)
+
+        try:
+            env = job.data.get("certbot-env")
+            run_command(job.data["certbot"], env=dict(os.environ, **env) if env else None,
+                        timeout=timeouts.get("certbot"), on_line=progress)
+            certbot_seconds = time.monotonic() - start
+            job.update("deploying")
+            install = job.data.get("install")
+            if install:
+                # The certificate was requested for a pooled key.
+                keypool.install_issued(install["dir"], install["config-dir"], job.data["name"])
+                os.makedirs(os.path.dirname(install["marker"]), exist_ok=True)
+                with open(install["marker"], "wb"):
+                    pass
+            if job.data.get("renewal-env"):
+                # Renewals use the credentials the lineage was issued with.
+                env_path, renewal_env = job.data["renewal-env"]
+                if renewal_env:
+                    state.save_json(env_path, renewal_env)
+                else:
+                    try:
+                        os.unlink(env_path)
+                    except FileNotFoundError:
+                        pass
+            for step in job.data["deploy"]:
+                run_command(step["cmd"], env=step.get("env"), timeout=timeouts.get("deploy"))
+            deploy_seconds = time.monotonic() - start - certbot_seconds
+            job.update("done")
+        except Exception as err:
+            print("job failed: {}".format(err), file=sys.stderr)
+            job.update("failed", error=str(err))
+            for cleanup in job.data.get("cleanup", []):
+                try:
+                    os.unlink(cleanup)
+                except FileNotFoundError:
+                    pass
+        if job.data.get("install"):
+            shutil.rmtree(job.data["install"]["dir"], ignore_errors=True)
+        if job.data.get("ledger"):
+            path, order = job.data["ledger"]
+            try:
+                ratelimit.Ledger(path).finish(order, certbot_seconds is not None)
+            except Exception as err:
+                print("cannot update ledger: {}".format(err), file=sys.stderr)
+        recorder = metrics.Metrics(*job.data.get("metrics", ["", ""]))
+        try:
+            recorder.record_run(job.data["name"], "issue", job.status == "done",
+                                certbot_seconds, deploy_seconds)
+        except Exception as err:
+            print("cannot update metrics: {}".format(err), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run(sys.argv[1])
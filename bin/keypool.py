@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+
+"""Fill the private key pool in the background.
+
+The charm starts this script, detached from the hook, whenever the
+pool holds fewer keys than configured. Only one instance fills a pool
+at a time, any others exit immediately.
+
+Usage: keypool.py POOL-DIR SPEC SIZE
+"""
+
+import fcntl
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "src"))
+
+import keypool  # noqa: E402
+
+
+def run(path: str, spec: str, size: int) -> int:
+    """Fill the pool, unless another process is already doing so.
+
+    Returns:
+        The number of keys generated.
+    """
+    pool = keypool.KeyPool(path, spec)
+    os.makedirs(pool.path, mode=0o700, exist_ok=True)
+    with open(os.path.join(pool.path, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        start = time.monotonic()
+        added = pool.fill(size)
+        seconds = time.monotonic() - start
+        print("generated {} {} keys in {:.3f}s".format(added, pool.spec, seconds))
+        return added
+
+
+if __name__ == "__main__":
+    run(sys.argv[1], sys.argv[2], int(sys.argv[3]))
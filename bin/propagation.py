@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright 2020 Canonical Ltd
+
+"""Run certbot, polling for DNS propagation.
+
+Certbot's DNS plugins wait for a fixed propagation-seconds after
+publishing the challenge records. This wrapper replaces that wait with
+polling of the zone's authoritative servers, the ACME server is asked
+to validate as soon as every server answers with the challenge, with
+propagation-seconds as the upper bound.
+
+Usage: propagation.py [--resolver=ADDRESS] [--interval=SECONDS] -- CERTBOT-ARGS...
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                "src"))
+
+import dnsquery  # noqa: E402
+
+
+def install(resolver: str = None, interval: float = 2.0):
+    """Install the propagation polling into certbot's DNS plugins.
+
+    Only plugins using certbot's common DNS authenticator implementation
+    are affected, plugins that implement their own wait are unchanged.
+    """
+    from certbot.plugins import dns_common
+
+    perform = dns_common.DNSAuthenticator.perform
+    if getattr(perform, "_polling", False):
+        return
+
+    def polling_perform(self, achalls):
+        records = [(achall.validation_domain_name(achall.domain),
+                    achall.validation(achall.account_key)) for achall in achalls]
+        dest = self.dest("propagation-seconds")
+        limit = getattr(self.config, dest)
+        setattr(self.config, dest, 0)
+        try:
+            responses = perform(self, achalls)
+        finally:
+            setattr(self.config, dest, limit)
+        dnsquery.wait_for_txt(records, limit, resolver=resolver, interval=interval)
+        return responses
+
+    polling_perform._polling = True
+    dns_common.DNSAuthenticator.perform = polling_perform
+
+
+def parse_args(argv):
+    """Split the wrapper's arguments from certbot's.
+
+    Returns:
+        A tuple of the wrapper options and the certbot arguments.
+    """
+    opts = {"resolver": None, "interval": 2.0}
+    if "--" not in argv:
+        return opts, argv
+    split = argv.index("--")
+    for arg in argv[:split]:
+        key, _, value = arg.lstrip("-").partition("=")
+        if key == "resolver":
+            opts["resolver"] = value or None
+        elif key == "interval":
+            opts["interval"] = float(value)
+        else:
+            raise ValueError("unknown option {}".format(arg))
+    return opts, argv[split + 1:]
+
+
+def main(argv):
+    opts, args = parse_args(argv)
+    install(**opts)
+    from certbot.main import main as certbot_main
+    return certbot_main(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,255 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""ACME Renewal Information (RFC 9773).
+
+A CA that supports ARI publishes a suggested renewal window for each
+certificate it has issued, and moves the window earlier when it needs
+certificates replaced early, for example ahead of a mass revocation.
+The window is cached, with the time the CA asks to be polled again,
+and each certificate is renewed at a random point in its window,
+chosen once per window, so renewals are spread the way the CA wants.
+"""
+
+import base64
+import configparser
+import datetime
+import email.utils
+import json
+import os
+import random
+import re
+import threading
+import urllib.request
+from typing import Callable, List, Optional
+
+import state
+import x509
+
+# Directory of certbot's default ACME server.
+DEFAULT_DIRECTORY = "https://acme-v02.api.letsencrypt.org/directory"
+
+# Bounds on the time until a window is fetched again, whatever
+# Retry-After says, and the time used if it says nothing.
+MIN_RETRY = datetime.timedelta(hours=1)
+MAX_RETRY = datetime.timedelta(days=1)
+DEFAULT_RETRY = datetime.timedelta(hours=6)
+
+# Time until a window that could not be fetched is tried again.
+ERROR_RETRY = datetime.timedelta(hours=1)
+
+# renewalInfo URLs of the ACME directories seen by this process.
+_renewal_info_urls = {}
+_renewal_info_lock = threading.Lock()
+
+
+class ARIError(Exception):
+    """Raised when a renewal window cannot be fetched."""
+    pass
+
+
+class Window:
+    """A suggested renewal window.
+
+    Attributes:
+        start: Start of the window.
+        end: End of the window.
+        retry_after: Time until the window should be fetched again.
+        explanation: URL of the CA's explanation of the window, if any.
+    """
+
+    def __init__(self, start: datetime.datetime, end: datetime.datetime,
+                 retry_after: datetime.timedelta = DEFAULT_RETRY, explanation: str = None):
+        self.start = start
+        self.end = end
+        self.retry_after = retry_after
+        self.explanation = explanation
+
+
+def cert_id(cert: x509.Certificate) -> str:
+    """Calculate the ARI identifier of a certificate.
+
+    Raises:
+        ARIError: The certificate has no authority key identifier.
+    """
+    if cert.authority_key_id is None:
+        raise ARIError("certificate has no authority key identifier")
+    serial = cert.serial.to_bytes(cert.serial.bit_length() // 8 + 1, "big", signed=True)
+    return "{}.{}".format(_b64url(cert.authority_key_id), _b64url(serial))
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def lineage_directory(config_dir: str, name: str) -> str:
+    """Find the ACME directory a lineage was issued by.
+
+    This is the server in the lineage's renewal configuration, or
+    certbot's default server if it has none.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(os.path.join(config_dir, "renewal", name + ".conf")) as f:
+            # Settings before the first section belong to no section.
+            parser.read_string("[lineage]\n" + f.read())
+    except (OSError, configparser.Error):
+        return DEFAULT_DIRECTORY
+    return parser.get("renewalparams", "server", fallback=DEFAULT_DIRECTORY)
+
+
+def renewal_info_url(directory: str, timeout: float = 10.0) -> str:
+    """Find the renewalInfo endpoint of an ACME server.
+
+    Raises:
+        ARIError: The server does not support ARI.
+        OSError: The directory cannot be fetched.
+    """
+    with _renewal_info_lock:
+        url = _renewal_info_urls.get(directory)
+    if url is None:
+        with urllib.request.urlopen(directory, timeout=timeout) as resp:
+            try:
+                url = json.load(resp).get("renewalInfo")
+            except (ValueError, AttributeError) as err:
+                raise ARIError("invalid ACME directory {}: {}".format(directory, err))
+        if not url:
+            raise ARIError("{} does not support renewal information".format(directory))
+        with _renewal_info_lock:
+            _renewal_info_urls[directory] = url
+    return url
+
+
+def fetch(directory: str, cert: x509.Certificate, timeout: float = 10.0,
+          now: datetime.datetime = None) -> Window:
+    """Fetch the suggested renewal window of a certificate.
+
+    Raises:
+        ARIError: The server does not support ARI, or its answer is not
+          valid.
+        OSError: The server cannot be reached.
+    """
+    url = "{}/{}".format(renewal_info_url(directory, timeout).rstrip("/"), cert_id(cert))
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        retry_after = parse_retry_after(resp.headers.get("Retry-After"), now)
+        try:
+            info = json.load(resp)
+            window = info["suggestedWindow"]
+            start = _parse_time(window["start"])
+            end = _parse_time(window["end"])
+        except (ValueError, KeyError, TypeError) as err:
+            raise ARIError("invalid renewal information: {}".format(err))
+    if end < start:
+        raise ARIError("renewal window ends before it starts")
+    return Window(start, end, retry_after, info.get("explanationURL"))
+
+
+def _parse_time(value: str) -> datetime.datetime:
+    """Parse an RFC 3339 timestamp."""
+    value = re.sub(r"[Zz]$", "+00:00", value)
+    value = re.sub(r"^(\d{4}-\d\d-\d\d)[t ]", r"\1T", value)
+    # Python parses at most microseconds.
+    value = re.sub(r"\.(\d+)", lambda m: "." + m.group(1)[:6], value)
+    t = state.parse_time(value)
+    if t.tzinfo is None:
+        raise ValueError("timestamp {} has no time zone".format(value))
+    return t
+
+
+def parse_retry_after(value: Optional[str],
+                      now: datetime.datetime = None) -> datetime.timedelta:
+    """Parse a Retry-After header, clamped to MIN_RETRY and MAX_RETRY."""
+    if not value:
+        return DEFAULT_RETRY
+    value = value.strip()
+    if value.isdigit():
+        delay = datetime.timedelta(seconds=int(value))
+    else:
+        try:
+            delay = email.utils.parsedate_to_datetime(value) - (now or _now())
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY
+    return max(MIN_RETRY, min(MAX_RETRY, delay))
+
+
+class RenewalInfo:
+    """Persistent cache of the renewal windows of certificates.
+
+    Each record holds the window of the certificate that was current
+    when it was fetched, the renewal time chosen in it and when the
+    window should be fetched again.
+
+    Args:
+        path: Location of the cache file.
+        rand: Source of random numbers in [0, 1).
+    """
+
+    def __init__(self, path: str, rand: Callable[[], float] = random.random):
+        self._path = path
+        self._rand = rand
+        self._records = state.load_json(path, {})
+
+    def stale(self, name: str, serial: str, now: datetime.datetime = None) -> bool:
+        """Check whether a certificate's window should be fetched."""
+        record = self._records.get(name)
+        if record is None or record["serial"] != serial:
+            return True
+        return state.parse_time(record["retry-at"]) <= (now or _now())
+
+    def update(self, name: str, serial: str, window: Window,
+               now: datetime.datetime = None) -> None:
+        """Record a fetched window.
+
+        The renewal time is kept if the window is unchanged, otherwise a
+        new one is chosen in the window.
+        """
+        now = now or _now()
+        record = self._records.get(name, {})
+        start, end = window.start.isoformat(), window.end.isoformat()
+        if record.get("serial") != serial or (record.get("start"), record.get("end")) != (
+                start, end) or "renew-at" not in record:
+            renew_at = window.start + (window.end - window.start) * self._rand()
+            record = {"serial": serial, "start": start, "end": end,
+                      "renew-at": renew_at.isoformat()}
+        record["retry-at"] = (now + window.retry_after).isoformat()
+        if window.explanation:
+            record["explanation"] = window.explanation
+        else:
+            record.pop("explanation", None)
+        self._records[name] = record
+
+    def failed(self, name: str, serial: str, now: datetime.datetime = None) -> None:
+        """Record a failure to fetch a certificate's window.
+
+        Any window already known for the certificate is kept.
+        """
+        record = self._records.get(name, {})
+        if record.get("serial") != serial:
+            record = {"serial": serial}
+        record["retry-at"] = ((now or _now()) + ERROR_RETRY).isoformat()
+        self._records[name] = record
+
+    def renew_at(self, name: str, serial: str) -> Optional[datetime.datetime]:
+        """Find when to renew a certificate.
+
+        Returns:
+            The renewal time chosen in the certificate's window, or None
+            if its window is not known.
+        """
+        record = self._records.get(name, {})
+        if record.get("serial") != serial or "renew-at" not in record:
+            return None
+        return state.parse_time(record["renew-at"])
+
+    def retain(self, names: List[str]) -> None:
+        """Forget the certificates not in names."""
+        keep = set(names)
+        self._records = {k: v for k, v in self._records.items() if k in keep}
+
+    def save(self) -> None:
+        """Write the cache."""
+        state.save_json(self._path, self._records)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
@@ -0,0 +1,117 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Exponential backoff of failed automatic certificate requests.
+
+Failures are recorded against a key derived from everything that
+affects whether a request can succeed, so changing any of it allows an
+immediate retry while repeating the same request waits progressively
+longer.
+"""
+
+import datetime
+import hashlib
+import json
+from typing import Optional, Set
+
+import state
+
+# Delay after the first failure, doubled for every further failure.
+INITIAL_DELAY = datetime.timedelta(minutes=5)
+MAX_DELAY = datetime.timedelta(days=1)
+
+
+def key(*values: str) -> str:
+    """Derive a failure key from the values describing a request.
+
+    The key is a digest, so credentials can be part of it.
+    """
+    return hashlib.sha256(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+class FailureCache:
+    """Persistent record of failed requests.
+
+    Args:
+        path: Location of the failure file.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def retry_at(self, key: str, now: datetime.datetime = None) -> Optional[datetime.datetime]:
+        """Find when a failed request may be retried.
+
+        Returns:
+            The time of the next attempt, or None if the request may be
+            made now.
+        """
+        now = now or _now()
+        record = state.load_json(self._path, {}).get(key)
+        if record is None:
+            return None
+        retry = state.parse_time(record["retry-at"])
+        return retry if retry > now else None
+
+    def failed(self, key: str, now: datetime.datetime = None) -> dict:
+        """Record a failed request.
+
+        Returns:
+            The failure record, with the number of failures and the
+            time of the next attempt.
+        """
+        now = now or _now()
+        records = state.load_json(self._path, {})
+        failures = records.get(key, {}).get("failures", 0) + 1
+        delay = min(MAX_DELAY, INITIAL_DELAY * 2 ** (failures - 1))
+        records[key] = {
+            "failures": failures,
+            "last": now.isoformat(),
+            "retry-at": (now + delay).isoformat(),
+        }
+        state.save_json(self._path, records)
+        return records[key]
+
+    def defer(self, key: str, until: datetime.datetime,
+              now: datetime.datetime = None) -> dict:
+        """Hold back a request that may not be made until a given time,
+        without counting it as a failure.
+
+        Returns:
+            The failure record, with the time of the next attempt.
+        """
+        now = now or _now()
+        records = state.load_json(self._path, {})
+        records[key] = {
+            "failures": records.get(key, {}).get("failures", 0),
+            "last": now.isoformat(),
+            "retry-at": until.isoformat(),
+        }
+        state.save_json(self._path, records)
+        return records[key]
+
+    def has_failures(self) -> bool:
+        """Check whether any failure is recorded."""
+        return bool(state.load_json(self._path, {}))
+
+    def failures(self, key: str) -> int:
+        """Count the recorded failures of a request."""
+        return state.load_json(self._path, {}).get(key, {}).get("failures", 0)
+
+    def waiting(self, now: datetime.datetime = None) -> Set[str]:
+        """Find the failed requests that may not be retried yet."""
+        now = now or _now()
+        return {key for key, record in state.load_json(self._path, {}).items()
+                if state.parse_time(record["retry-at"]) > now}
+
+    def clear(self, key: str = None):
+        """Forget the failures of a request, or every failure."""
+        records = state.load_json(self._path, {})
+        if key is None and records:
+            state.save_json(self._path, {})
+        elif key is not None and records.pop(key, None) is not None:
+            state.save_json(self._path, records)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
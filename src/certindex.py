@@ -0,0 +1,122 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""An index of the certificates managed by certbot.
+
+The index records the details of every lineage in certbot's live
+directory. It is refreshed incrementally, a lineage's certificate is
+only parsed again when the file it points to changes.
+"""
+
+import datetime
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import state
+import x509
+
+logger = logging.getLogger(__name__)
+
+_FILES = ("cert", "chain", "fullchain", "privkey")
+
+
+class CertificateIndex:
+    """Index of the lineages in a certbot live directory.
+
+    Args:
+        path: Location of the index file.
+        live_dir: certbot live directory to index.
+    """
+
+    def __init__(self, path: str, live_dir: str = "/etc/letsencrypt/live"):
+        self._path = path
+        self._live_dir = live_dir
+
+    def refresh(self) -> List[dict]:
+        """Bring the index up to date with the live directory.
+
+        Returns:
+            The index entries sorted by lineage name.
+        """
+        entries = state.load_json(self._path, {})
+        changed = False
+        try:
+            names = sorted(n for n in os.listdir(self._live_dir)
+                           if os.path.isdir(os.path.join(self._live_dir, n)))
+        except FileNotFoundError:
+            names = []
+        for name in set(entries) - set(names):
+            del entries[name]
+            changed = True
+        for name in names:
+            entry = self._refresh_entry(name, entries.get(name))
+            if entry is None:
+                if entries.pop(name, None) is not None:
+                    changed = True
+            elif entry is not entries.get(name):
+                entries[name] = entry
+                changed = True
+        if changed:
+            state.save_json(self._path, entries)
+        return [entries[n] for n in sorted(entries)]
+
+    def _refresh_entry(self, name: str, entry: Optional[dict]) -> Optional[dict]:
+        """Refresh the entry for a lineage.
+
+        Returns:
+            The existing entry if the lineage is unchanged, a new entry
+            if it has changed, or None if it cannot be read.
+        """
+        lineage = os.path.join(self._live_dir, name)
+        try:
+            stats = {kind: os.stat(os.path.join(lineage, kind + ".pem")) for kind in _FILES}
+        except FileNotFoundError:
+            return None
+        cert = stats["cert"]
+        key = [cert.st_ino, cert.st_mtime_ns, cert.st_size]
+        mtimes = {kind: int(st.st_mtime) for kind, st in stats.items()}
+        if entry and entry.get("stat") == key and entry.get("mtimes") == mtimes:
+            return entry
+        try:
+            c = x509.parse_pem_file(os.path.join(lineage, "cert.pem"))
+        except (OSError, ValueError) as err:
+            logger.warning("cannot parse certificate for %s: %s", name, err)
+            return None
+        return {
+            "name": name,
+            "domains": c.domains,
+            "not-before": c.not_before.isoformat(),
+            "not-after": c.not_after.isoformat(),
+            "serial": "{:x}".format(c.serial),
+            "key-type": c.key_type,
+            "key-size": c.key_size or 0,
+            "curve": c.curve or "",
+            "mtimes": mtimes,
+            "stat": key,
+        }
+
+
+def not_after(entry: dict) -> datetime.datetime:
+    """Get the expiry time of an index entry."""
+    return datetime.datetime.strptime(entry["not-after"], "%Y-%m-%dT%H:%M:%S+00:00").replace(
+        tzinfo=datetime.timezone.utc)
+
+
+def key_params(entry: dict) -> Dict[str, Any]:
+    """Get the certificate parameters requesting the key type of an entry.
+
+    Returns:
+        The key-type, and rsa-key-size or elliptic-curve, parameters.
+        This is empty if the key type is unknown.
+    """
+    if entry.get("key-type") == "rsa" and entry.get("key-size"):
+        return {"key-type": "rsa", "rsa-key-size": entry["key-size"]}
+    if entry.get("key-type") == "ecdsa" and entry.get("curve"):
+        return {"key-type": "ecdsa", "elliptic-curve": entry["curve"]}
+    return {}
+
+
+def soonest_expiry(entries: List[dict]) -> Optional[dict]:
+    """Find the entry that expires first."""
+    return min(entries, key=not_after, default=None)
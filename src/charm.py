@@ -5,94 +5,734 @@
 import base64
 import binascii
 import configparser
+import datetime
+import hashlib
+import io
+import json
 import logging
 import os
 import pathlib
+import queue
+import re
+import shutil
 import subprocess
-from typing import Any, List, Mapping
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+import yaml
 
 from ops.charm import CharmBase
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus
+from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
+
+import ari
+from backoff import FailureCache, key as failure_key
+from certindex import CertificateIndex, key_params, not_after, soonest_expiry
+from engine import CertbotWorker
+from hashring import HashRing
+import keypool
+from keypool import KeyPool
+from lineage import IsolatedDirs, copy_missing, install_version, merge_lineage, remove_lineage
+from metrics import Metrics
+import planner
+import preflight
+from ratelimit import Ledger, RateLimited, parse_limits
+import replication
+from scheduler import select_due
+import state
+import x509
 
 
 logger = logging.getLogger(__name__)
 
 
+# Packages installed by the install hook.
+PACKAGES = [
+    "certbot",
+    "python3-certbot-dns-google",
+    "python3-certbot-dns-rfc2136",
+    "python3-certbot-dns-route53",
+]
+
+# certbot release that added --no-random-sleep-on-renew, along with the
+# random sleep it disables.
+NO_RANDOM_SLEEP_VERSION = (1, 4)
+
+# certbot release that added --key-type, needed for ECDSA keys and for
+# dual-issuance.
+KEY_TYPE_VERSION = (1, 10)
+
+# Status of a unit sharing lineages with its peers without a
+# replication-key.
+REPLICATION_KEY_MESSAGE = "replication-key must be set to share certificates."
+
+# Status of a unit with a key pool whose certificates would not be
+# renewed.
+KEY_POOL_MESSAGE = "key-pool-size requires renewal-scheduler."
+
+# Status of a unit with lineages issued with their own credentials that
+# would be renewed with the configured ones.
+RENEWAL_ENV_MESSAGE = "certificates with their own AWS credentials require renewal-scheduler."
+
+# Status of a unit configured with key types its certbot cannot
+# request.
+KEY_TYPE_MESSAGE = "key-type and dual-issuance require certbot 1.10 or later."
+
+# certbot authenticators of the charm's plugins, where they differ.
+AUTHENTICATORS = {"http-01": "webroot"}
+
+HTTP01_SERVICE_NAME = "certbot-charm-http01.service"
+
+HTTP01_SERVICE = """[Unit]
+Description=ACME http-01 challenge responder for the certbot charm
+After=network.target
+
+[Service]
+ExecStart={cmd} {webroot} {port}
+Restart=on-failure
+NoNewPrivileges=true
+ProtectHome=true
+ProtectSystem=strict
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
 class UnsupportedPluginError(Exception):
     """Raised when an attempt is made to acquire a certificate using
     an unsupported plugin."""
     pass
 
 
+class CommandError(subprocess.CalledProcessError):
+    """Raised when a command run on the host exits with a non-zero
+    status."""
+
+    def __str__(self):
+        msg = super().__str__()
+        lines = (self.stderr or "").strip().splitlines()
+        if lines:
+            msg += " {}".format(lines[-1])
+        return msg
+
+
 class CertbotCharm(CharmBase):
     """Class that implements the certbot charm."""
 
+    _stored = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(renewal_scheduler=False, replicated={}, http01_service="",
+                                 artifacts={})
+        _host.set_timeouts(self.model.config["command-timeouts"])
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.start, self._on_start)
         self.framework.observe(self.on.stop, self._on_stop)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(self.on.replicas_relation_changed,
+                               self._on_replicas_relation_changed)
+        self.framework.observe(self.on.replicas_relation_departed,
+                               self._on_replicas_relation_changed)
         self.framework.observe(self.on.deploy_action, self._on_deploy_action)
         self.framework.observe(self.on.get_certificate_action, self._on_get_certificate_action)
+        self.framework.observe(self.on.get_certificate_status_action,
+                               self._on_get_certificate_status_action)
+        self.framework.observe(self.on.get_certificates_action, self._on_get_certificates_action)
+        self.framework.observe(self.on.list_certificates_action,
+                               self._on_list_certificates_action)
+        self.framework.observe(self.on.list_queue_action, self._on_list_queue_action)
+        self.framework.observe(self.on.plan_certificates_action,
+                               self._on_plan_certificates_action)
+        self.framework.observe(self.on.preflight_action, self._on_preflight_action)
         self._aws_config_file = pathlib.Path.home().joinpath(".aws", "config")
+        self._aws_lock = threading.Lock()
+        self._aws_profiles = set()
+        self._workers = {}
+        self._cipher = None
+        self._queue_lock = threading.Lock()
+        self._index = CertificateIndex(self._config_path("index.json"))
 
     def _on_install(self, _):
         """Handler for the install hook."""
-        _host.install_packages([
-            "certbot",
-            "python3-certbot-dns-google",
-            "python3-certbot-dns-rfc2136",
-            "python3-certbot-dns-route53"])
+        start = time.monotonic()
+        # The resource is only fetched and unpacked if it is needed.
+        missing = _host.missing_packages(PACKAGES)
+        source = "installed"
+        if missing:
+            source = _host.install_packages(missing, self._package_resource())
+        seconds = time.monotonic() - start
+        logger.info("packages %s in %.3fs", source, seconds,
+                    extra={"source": source, "seconds": seconds})
+        try:
+            self._metrics().record_install(source, seconds)
+        except Exception as err:
+            logger.error("cannot update metrics: {}".format(err))
         _host.symlink(os.path.join(self.charm_dir, "bin/deploy.py"),
                       "/etc/letsencrypt/renewal-hooks/deploy/certbot-charm")
+        _host.symlink(os.path.join(self.charm_dir, "bin/deploy.py"),
+                      "/etc/letsencrypt/renewal-hooks/post/certbot-charm")
 
-    def _on_config_changed(self, _):
-        """Handler for the config-changed hook."""
-        _host.write_config(
-            self._config_path("config.ini"),
-            {
-                "DEFAULT": {
-                    "cert-path": self.model.config["cert-path"],
-                    "chain-path": self.model.config["chain-path"],
-                    "combined-path": self.model.config["combined-path"],
-                    "fullchain-path": self.model.config["fullchain-path"],
-                    "key-path": self.model.config["key-path"],
-                },
-                "deploy": {
-                    "command": self.model.config["deploy-command"],
-                },
-            }
-        )
+    def _package_resource(self) -> List[str]:
+        """Unpack the packages resource, if one is attached.
+
+        The resource is a tar archive of .deb files, for installing the
+        charm's packages without an apt mirror.
+
+        Returns:
+            The paths of the unpacked .deb files.
+        """
         try:
-            self._write_base64(self._config_path("dns-google.json"),
-                               self.model.config["dns-google-credentials"])
-        except (ValueError, binascii.Error):
-            logger.exception("invalid dns-google-credentials value")
+            path = self.model.resources.fetch("packages")
+        except (ModelError, NameError):
+            return []
+        unpacked = self._config_path("packages")
+        debs = []
         try:
-            self._write_base64(self._config_path("dns-rfc2136.ini"),
-                               self.model.config["dns-rfc2136-credentials"])
-        except (ValueError, binascii.Error):
-            logger.exception("invalid dns-rfc2136-credentials value")
+            with tarfile.open(path) as tar:
+                for member in tar.getmembers():
+                    if not member.isfile() or not member.name.endswith(".deb"):
+                        continue
+                    os.makedirs(unpacked, exist_ok=True)
+                    deb = os.path.join(unpacked, os.path.basename(member.name))
+                    with tar.extractfile(member) as src, open(deb, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    debs.append(deb)
+        except (tarfile.TarError, OSError) as err:
+            logger.warning("cannot unpack packages resource: {}".format(err))
+            return []
+        return sorted(debs)
+
+    def _on_config_changed(self, _):
+        """Handler for the config-changed hook."""
+        touched = []
+        deploy_config = {
+            "DEFAULT": {
+                "cert-path": self.model.config["cert-path"],
+                "chain-path": self.model.config["chain-path"],
+                "combined-path": self.model.config["combined-path"],
+                "fullchain-path": self.model.config["fullchain-path"],
+                "key-path": self.model.config["key-path"],
+                "ocsp-path": self.model.config["ocsp-path"],
+            },
+            "deploy": {
+                "coalesce": str(self.model.config["deploy-coalesce"]).lower(),
+                "command": self.model.config["deploy-command"],
+                "key-type-suffix": str(self.model.config["dual-issuance"]).lower(),
+            },
+            "metrics": {
+                "textfile": self.model.config["metrics-textfile"],
+            },
+        }
+        if self._update_artifact("config.ini", deploy_config,
+                                 lambda path: _host.write_config(path, deploy_config)):
+            touched.append("config.ini")
+        for filename, option in (("dns-google.json", "dns-google-credentials"),
+                                 ("dns-rfc2136.ini", "dns-rfc2136-credentials")):
+            value = self.model.config[option]
+            try:
+                if self._update_artifact(filename, value,
+                                         lambda path: self._write_base64(path, value)):
+                    touched.append(filename)
+            except (ValueError, binascii.Error):
+                logger.exception("invalid {} value".format(option))
+        key_id = self.model.config["dns-route53-aws-access-key-id"]
+        secret = self.model.config["dns-route53-aws-secret-access-key"]
+        if key_id and secret:
+            # certbot renews dns-route53 certificates with the default
+            # AWS profile.
+            aws_config = {"default": {"aws_access_key_id": key_id,
+                                      "aws_secret_access_key": secret}}
+            if self._update_artifact("aws-config", aws_config,
+                                     lambda path: _host.write_config(path, aws_config),
+                                     path=str(self._aws_config_file)):
+                touched.append(str(self._aws_config_file))
+        logger.info("config-changed updated %s", ", ".join(touched) or "nothing",
+                    extra={"touched": touched})
+        if self.model.config["renewal-scheduler"] != self._stored.renewal_scheduler:
+            # The charm's scheduler replaces certbot's own renewal timer.
+            # Not every installation of certbot provides the timer.
+            if self.model.config["renewal-scheduler"]:
+                _host.run(["systemctl", "disable", "--now", "certbot.timer"], check=False)
+            else:
+                _host.run(["systemctl", "enable", "--now", "certbot.timer"], check=False)
+            self._stored.renewal_scheduler = self.model.config["renewal-scheduler"]
+        self._configure_http01_responder()
+        if self.model.config["planned-domains"] and not self._is_replica():
+            try:
+                _, saved = self._plan(self.model.config["planned-domains"])
+                state.save_json(self._config_path("plan.json"), saved)
+            except ValueError:
+                logger.exception("invalid planned-domains value")
+        # A failed automatic request is retried as soon as the
+        # configuration it depends on changes.
+        failures = FailureCache(self._config_path("start-failures.json"))
+        if not self._is_replica() and failures.has_failures():
+            if not failures.failures(self._auto_certificate_key()):
+                self._get_auto_certificate()
+        self._refill_key_pool()
+        self._key_pool_blocked()
+        self._renewal_env_blocked()
+        self._key_type_blocked()
+        self._replication_blocked()
 
     def _on_start(self, _):
         """Handler for the start hook."""
+        if self._is_replica():
+            self.model.unit.status = WaitingStatus("waiting for certificates from the leader.")
+            return
         self.model.unit.status = BlockedStatus("certificate not yet acquired.")
+        self._get_auto_certificate()
+
+    def _get_auto_certificate(self) -> None:
+        """Attempt to get a certificate using the charm configuration.
+
+        Failures are logged, and recorded so that the same request is
+        not attempted again until its backoff has passed. A request held
+        back by a rate limit is retried once the limit allows it.
+        """
+        domains = self.model.config["domains"]
+        if not domains:
+            return
+        if not self._owns(domains.split(",")[0]):
+            logger.info("certificate for %s is acquired by %s", domains,
+                        self._owner(domains.split(",")[0]))
+            return
+        failures = FailureCache(self._config_path("start-failures.json"))
+        key = self._auto_certificate_key()
+        retry_at = failures.retry_at(key)
+        if retry_at is not None:
+            logger.info("not acquiring certificate for %s until %s after %d failures",
+                        domains, retry_at.isoformat(), failures.failures(key))
+            return
         try:
-            # attempt to get a certificate using the defaults, don't
-            # worry if it fails.
             self._get_certificate(
                 self.model.config["plugin"],
                 self.model.config["agree-tos"],
                 self.model.config["email"],
-                self.model.config["domains"])
+                domains)
+        except RateLimited as err:
+            # update-status makes the request once the rate limit allows.
+            logger.info("could not automatically acquire certificate: %s", err)
+            record = failures.defer(key, err.eta)
+            self.model.unit.status = BlockedStatus(
+                "certificate not yet acquired, retrying after {}.".format(record["retry-at"]))
+            return
         except Exception as err:
             logger.info("could not automatically acquire certificate", exc_info=err)
+            record = failures.failed(key)
+            self.model.unit.status = BlockedStatus(
+                "certificate not yet acquired, retrying after {}.".format(record["retry-at"]))
+            return
+        failures.clear()
+
+    def _auto_certificate_key(self) -> str:
+        """Derive the failure key of the automatic certificate request.
+
+        The key covers the plugin, the domains and the plugin's
+        credentials.
+        """
+        config = self.model.config
+        credentials = {
+            "dns-google": ["dns-google-credentials"],
+            "dns-rfc2136": ["dns-rfc2136-credentials"],
+            "dns-route53": ["dns-route53-aws-access-key-id",
+                            "dns-route53-aws-secret-access-key"],
+        }.get(config["plugin"], [])
+        return failure_key(config["plugin"], config["domains"],
+                           *(config[name] for name in credentials))
 
     def _on_stop(self, _):
         """Handler for the stop hook."""
         _host.unlink("/etc/letsencrypt/renewal-hooks/deploy/certbot-charm")
+        _host.unlink("/etc/letsencrypt/renewal-hooks/post/certbot-charm")
+
+    def _on_update_status(self, _):
+        """Handler for the update-status hook."""
+        if self._is_replica():
+            if self._replication_blocked():
+                return
+            self._sync_replicas()
+            entries = self._refresh_index()
+            self._refresh_ocsp(entries)
+            self._update_expiry_status(entries)
+            return
+        self._refill_key_pool()
+        # A failed automatic request is retried once its backoff has
+        # passed.
+        if FailureCache(self._config_path("start-failures.json")).has_failures():
+            self._get_auto_certificate()
+        entries = self._refresh_index()
+        if self._sharding() and self._rebalance(entries):
+            entries = self._refresh_index()
+        if self.model.config["renewal-scheduler"] and self._renew_due(entries):
+            entries = self._refresh_index()
+        if self._issue_planned(self.model.config["renewal-max-per-run"],
+                               self.model.config["renewal-concurrency"]):
+            entries = self._refresh_index()
+        if self._release_queued(self.model.config["renewal-max-per-run"],
+                                self.model.config["renewal-concurrency"]):
+            entries = self._refresh_index()
+        self._refresh_ocsp(entries)
+        self._update_expiry_status(entries)
+        self._key_pool_blocked()
+        self._renewal_env_blocked()
+        self._key_type_blocked()
+        if not self._replication_blocked():
+            self._publish_lineages(entries)
+
+    def _on_leader_elected(self, _):
+        """Handler for the leader-elected hook."""
+        if not self.model.config["replicate-certificates"]:
+            return
+        # Take over renewal of the lineages acquired by the previous
+        # leader.
+        staged = self._config_path("replicas")
+        copy_missing(os.path.join(staged, "renewal"), "/etc/letsencrypt/renewal")
+        copy_missing(os.path.join(staged, "accounts"), "/etc/letsencrypt/accounts")
+        self._publish_lineages()
+
+    def _on_replicas_relation_changed(self, _):
+        """Handler for the replicas-relation-changed and
+        replicas-relation-departed hooks."""
+        if self._is_replica():
+            self._sync_replicas()
+        elif self._sharding():
+            self._rebalance(self._refresh_index())
+
+    def _is_replica(self) -> bool:
+        """Check whether this unit gets its certificates from the leader."""
+        return self.model.config["replicate-certificates"] and not self.model.unit.is_leader()
+
+    def _sharding(self) -> bool:
+        """Check whether lineages are shared out between the units."""
+        if self.model.config["replicate-certificates"]:
+            return False
+        return self.model.config["shard-certificates"]
+
+    def _ring(self) -> HashRing:
+        """Build the hash ring of this unit and its peers."""
+        units = [self.model.unit.name]
+        relation = self.model.get_relation("replicas")
+        if relation is not None:
+            units.extend(unit.name for unit in relation.units)
+        return HashRing(units)
+
+    def _owner(self, name: str) -> str:
+        """Find the unit responsible for a lineage."""
+        return self._ring().owner(name)
+
+    def _owns(self, name: str) -> bool:
+        """Check whether this unit is responsible for a lineage."""
+        return not self._sharding() or self._owner(name) == self.model.unit.name
+
+    def _holds(self, name: str) -> bool:
+        """Check whether this unit renews a lineage it has installed."""
+        if _host.exists(os.path.join("/etc/letsencrypt/renewal", name + ".conf")):
+            return True
+        return _host.exists(self._pool_marker(name))
+
+    def _replication_cipher(self) -> Optional[replication.Cipher]:
+        """Get the cipher of the lineages shared over the replicas relation.
+
+        Returns:
+            The cipher, or None if replication-key is not set.
+        """
+        passphrase = self.model.config["replication-key"]
+        if not passphrase:
+            return None
+        if self._cipher is None or self._cipher[0] != passphrase:
+            self._cipher = (passphrase, replication.Cipher(
+                passphrase, timeout=_host.timeouts.get("deploy")))
+        return self._cipher[1]
+
+    def _replication_blocked(self) -> bool:
+        """Block the unit if it shares lineages with no replication-key.
+
+        Returns:
+            True if the unit is blocked.
+        """
+        sharing = self.model.config["replicate-certificates"] or self._sharding()
+        blocked = sharing and not self.model.config["replication-key"]
+        if blocked:
+            logger.warning("replication-key is not set, no certificates are shared")
+        return self._block(REPLICATION_KEY_MESSAGE, blocked)
+
+    def _key_pool_blocked(self) -> bool:
+        """Block the unit if the key pool is enabled without the
+        renewal-scheduler.
+
+        Returns:
+            True if the unit is blocked.
+        """
+        blocked = self.model.config["key-pool-size"] > 0 and \
+            not self.model.config["renewal-scheduler"]
+        if blocked:
+            logger.warning("renewal-scheduler is disabled, the key pool is not used")
+        return self._block(KEY_POOL_MESSAGE, blocked)
+
+    def _renewal_env_blocked(self) -> bool:
+        """Block the unit if it has lineages with their own credentials
+        and the renewal-scheduler, the only renewer that can use them,
+        is disabled.
+
+        Returns:
+            True if the unit is blocked.
+        """
+        blocked = False
+        if not self.model.config["renewal-scheduler"]:
+            try:
+                blocked = bool(os.listdir(self._config_path("renewal-env")))
+            except FileNotFoundError:
+                pass
+        if blocked:
+            logger.warning("renewal-scheduler is disabled, certbot renews every certificate "
+                           "with the configured credentials")
+        return self._block(RENEWAL_ENV_MESSAGE, blocked)
+
+    def _key_type_blocked(self) -> bool:
+        """Block the unit if it is configured with key types the
+        installed certbot cannot request.
+
+        Returns:
+            True if the unit is blocked.
+        """
+        blocked = bool(self.model.config["key-type"] or self.model.config["dual-issuance"]) \
+            and not self._certbot_supports(KEY_TYPE_VERSION)
+        if blocked:
+            logger.warning("certbot %s does not support --key-type", _host.certbot_version())
+        return self._block(KEY_TYPE_MESSAGE, blocked)
+
+    def _block(self, message: str, blocked: bool) -> bool:
+        """Set, or clear, a Blocked status caused by the configuration.
+
+        Args:
+            message: The message of the status.
+            blocked: Whether the configuration still causes it.
+
+        Returns:
+            blocked
+        """
+        status = self.model.unit.status
+        if blocked:
+            self.model.unit.status = BlockedStatus(message)
+        elif isinstance(status, BlockedStatus) and status.message == message:
+            if self._is_replica():
+                self.model.unit.status = WaitingStatus("waiting for certificates from the leader.")
+            else:
+                self.model.unit.status = ActiveStatus()
+        return blocked
+
+    def _rebalance(self, entries: List[dict]) -> bool:
+        """Move lineages to the units that own them.
+
+        Lineages held by this unit but owned by another are offered in
+        this unit's peer relation data, encrypted with the
+        replication-key, once the owner reports that it holds the
+        lineage this unit stops renewing it. Lineages offered by other
+        units that are owned by this unit are adopted, with their
+        renewal configuration, and deployed. Nothing is handed over if
+        replication-key is not set.
+
+        Args:
+            entries: Certificate index entries.
+
+        Returns:
+            True if any lineage was adopted.
+        """
+        relation = self.model.get_relation("replicas")
+        if relation is None:
+            return False
+        data = relation.data[self.model.unit]
+        ring = self._ring()
+        held = {e["name"] for e in entries if self._holds(e["name"])}
+        cipher = self._replication_cipher()
+
+        adopted = []
+        units = sorted(relation.units, key=lambda u: u.name) if cipher is not None else []
+        for unit in units:
+            offers = relation.data[unit]
+            for key in sorted(offers.keys()):
+                name = key[len("lineage-"):]
+                if not key.startswith("lineage-") or name in held:
+                    continue
+                if ring.owner(name) != self.model.unit.name:
+                    continue
+                try:
+                    _, files = replication.unpack(offers[key], cipher)
+                    if offers.get("accounts"):
+                        staged = self._config_path(os.path.join("handover", unit.name,
+                                                                "accounts"))
+                        replication.write_tree(
+                            staged, replication.unpack(offers["accounts"], cipher)[1])
+                        copy_missing(staged, "/etc/letsencrypt/accounts")
+                    install_version("/etc/letsencrypt", name, replication.lineage_files(files))
+                    if "renewal" in files:
+                        _host.write_file(os.path.join("/etc/letsencrypt/renewal", name + ".conf"),
+                                         files["renewal"], mode=0o644)
+                    else:
+                        _host.write_file(self._pool_marker(name), b"", mode=0o644)
+                    logger.info("adopted %s from %s", name, unit.name)
+                    self._deploy(name, coalesce=True)
+                    held.add(name)
+                    adopted.append(name)
+                except Exception as err:
+                    logger.error("cannot adopt {} from {}: {}".format(name, unit.name, err))
+        if adopted:
+            try:
+                self._run_pending_deploys()
+            except Exception as err:
+                logger.error("cannot run deploy command: {}".format(err))
+
+        others = {}
+        for unit in relation.units:
+            others[unit.name] = set(json.loads(relation.data[unit].get("held", "[]")))
+        offered = set()
+        for name in sorted(held):
+            owner = ring.owner(name)
+            if owner == self.model.unit.name:
+                continue
+            if name in others.get(owner, ()):
+                logger.info("handed %s over to %s", name, owner)
+                remove_lineage("/etc/letsencrypt", name)
+                _host.unlink(self._pool_marker(name))
+                held.discard(name)
+                continue
+            if cipher is None:
+                continue
+            try:
+                files = replication.read_lineage("/etc/letsencrypt", name)
+            except OSError as err:
+                logger.error("cannot read lineage {}: {}".format(name, err))
+                continue
+            offered.add("lineage-" + name)
+            self._share(data, "lineage-" + name, files, cipher)
+        for key in list(data.keys()):
+            if key.startswith("lineage-") and key not in offered:
+                del data[key]
+        if offered:
+            self._share(data, "accounts", replication.read_tree("/etc/letsencrypt/accounts"),
+                        cipher)
+        elif "accounts" in data:
+            del data["accounts"]
+        data["held"] = json.dumps(sorted(held))
+        return bool(adopted)
+
+    def _publish_lineages(self, entries: List[dict] = None) -> None:
+        """Publish the live lineages to the peer units.
+
+        Only the leader publishes, and only lineages that have changed
+        since they were last published are updated. Lineages that are
+        no longer live are withdrawn. The ACME accounts are published
+        alongside the lineages so that any unit can take over renewals
+        if it becomes the leader. Everything is encrypted with the
+        replication-key, nothing is published if it is not set.
+
+        Args:
+            entries: Certificate index entries, if the index has already
+              been refreshed.
+        """
+        if not self.model.config["replicate-certificates"] or not self.model.unit.is_leader():
+            return
+        relation = self.model.get_relation("replicas")
+        cipher = self._replication_cipher()
+        if relation is None or cipher is None:
+            return
+        if entries is None:
+            entries = self._index.refresh()
+        values = {"accounts": replication.read_tree("/etc/letsencrypt/accounts")}
+        for entry in entries:
+            try:
+                values["lineage-" + entry["name"]] = replication.read_lineage(
+                    "/etc/letsencrypt", entry["name"])
+            except OSError as err:
+                logger.error("cannot read lineage {}: {}".format(entry["name"], err))
+        data = relation.data[self.model.app]
+        for key, files in values.items():
+            if self._share(data, key, files, cipher):
+                logger.info("publishing %s", key)
+        live = {"lineage-" + entry["name"] for entry in entries}
+        for key in list(data.keys()):
+            if key.startswith("lineage-") and key not in live:
+                logger.info("withdrawing %s", key)
+                del data[key]
+
+    def _share(self, data, key: str, files: Mapping[str, bytes],
+               cipher: replication.Cipher) -> bool:
+        """Set a relation value to a set of files, if they have changed.
+
+        Args:
+            data: The relation data to update.
+            key: The key of the value.
+            files: The files to share.
+            cipher: The cipher to encrypt the value with.
+
+        Returns:
+            True if the value was updated.
+        """
+        if replication.value_hash(data.get(key)) == cipher.digest(files):
+            return False
+        data[key] = replication.pack(files, cipher)
+        return True
+
+    def _sync_replicas(self) -> None:
+        """Install the lineages published by the leader.
+
+        Each changed lineage is installed into the live certbot
+        configuration and deployed locally. Renewal configurations and
+        accounts are staged, so that only the leader renews, and
+        installed if this unit becomes the leader. Lineages the leader
+        has withdrawn are removed.
+        """
+        relation = self.model.get_relation("replicas")
+        cipher = self._replication_cipher()
+        if relation is None or cipher is None:
+            return
+        staged = self._config_path("replicas")
+        published = relation.data[self.model.app]
+        for key in list(self._stored.replicated.keys()):
+            if key.startswith("lineage-") and key not in published:
+                name = key[len("lineage-"):]
+                remove_lineage("/etc/letsencrypt", name)
+                _host.unlink(os.path.join(staged, "renewal", name + ".conf"))
+                del self._stored.replicated[key]
+                logger.info("removed withdrawn replicated certificate %s", name)
+        changed = []
+        for key, value in sorted(published.items()):
+            if key != "accounts" and not key.startswith("lineage-"):
+                continue
+            try:
+                if self._stored.replicated.get(key) == replication.value_hash(value):
+                    continue
+                digest, files = replication.unpack(value, cipher)
+                if key == "accounts":
+                    replication.write_tree(os.path.join(staged, "accounts"), files)
+                else:
+                    name = key[len("lineage-"):]
+                    install_version("/etc/letsencrypt", name, replication.lineage_files(files))
+                    if "renewal" in files:
+                        _host.write_file(os.path.join(staged, "renewal", name + ".conf"),
+                                         files["renewal"], mode=0o644)
+                    # A former leader must stop renewing the lineage.
+                    _host.unlink(os.path.join("/etc/letsencrypt/renewal", name + ".conf"))
+                    self._deploy(name, coalesce=True)
+                    changed.append(name)
+                self._stored.replicated[key] = digest
+            except Exception as err:
+                logger.error("cannot install replicated {}: {}".format(key, err))
+        if changed:
+            logger.info("installed %d replicated certificates", len(changed))
+            try:
+                self._run_pending_deploys()
+            except Exception as err:
+                logger.error("cannot run deploy command: {}".format(err))
 
     def _on_deploy_action(self, event):
         """Implmentation of the deploy action."""
@@ -103,7 +743,15 @@ class CertbotCharm(CharmBase):
 
     def _on_get_certificate_action(self, event):
         """Implementation of the get-certificate action."""
+        if self._is_replica():
+            event.fail("certificates are acquired by the leader unit.")
+            return
         params = event.params
+        domain = params.get("domains", self.model.config["domains"]).split(",")[0]
+        if not self._owns(domain):
+            event.fail("certificate for {} is acquired by {}.".format(
+                domain, self._owner(domain)))
+            return
         credpath = self._config_path("action-{}.cred".format(os.environ["JUJU_ACTION_UUID"]))
         if params.get("credentials"):
             try:
@@ -113,11 +761,26 @@ class CertbotCharm(CharmBase):
                 event.fail("invalid credentials: {}".format(err))
                 return
         try:
+            if params.get("async"):
+                domains = params.get("domains", self.model.config["domains"])
+                variants = self._variants(dict(params, domains=domains))
+                results = {}
+                for i, variant in enumerate(variants):
+                    # The credentials are needed until the last job has run.
+                    job_id = self._start_job(
+                        params.get("plugin", self.model.config["plugin"]),
+                        params.get("agree-tos", self.model.config["agree-tos"]),
+                        params.get("email", self.model.config["email"]),
+                        domains, variant, [credpath] if i == len(variants) - 1 else [])
+                    results["rsa-job-id" if i else "job-id"] = job_id
+                event.set_results(results)
+                return
             self._get_certificate(params.get("plugin", self.model.config["plugin"]),
                                   params.get("agree-tos", self.model.config["agree-tos"]),
                                   params.get("email", self.model.config["email"]),
                                   params.get("domains", self.model.config["domains"]),
                                   params)
+            self._publish_lineages()
         except Exception as err:
             logger.error("cannot get certificate: {}".format(err))
             event.fail("cannot get certificate: {}".format(err))
@@ -128,6 +791,803 @@ class CertbotCharm(CharmBase):
                 except Exception:
                     pass
 
+    def _on_get_certificate_status_action(self, event):
+        """Implementation of the get-certificate-status action."""
+        job = state.load_json(self._job_path(event.params["job-id"]))
+        if job is None:
+            event.fail("unknown job {}".format(event.params["job-id"]))
+            return
+        finished = job["status"] in ("done", "failed")
+        if not finished and job.get("pid") and not _host.exists("/proc/{}".format(job["pid"])):
+            finished = True
+            job["status"] = "failed"
+            job["error"] = "job runner exited unexpectedly"
+        history = job["history"]
+        end = history[-1][1] if finished else time.time()
+        timings = {}
+        for i, (stage, started) in enumerate(history):
+            if stage in ("done", "failed"):
+                continue
+            stopped = history[i + 1][1] if i + 1 < len(history) else end
+            timings[stage] = "{:.3f}".format(stopped - started)
+        results = {
+            "job-id": event.params["job-id"],
+            "domains": job["domains"],
+            "status": job["status"],
+            "seconds": "{:.3f}".format(end - history[0][1]),
+            "timings": timings,
+        }
+        if job.get("error"):
+            results["error"] = job["error"]
+        event.set_results(results)
+
+    def _configure_http01_responder(self) -> None:
+        """Run the http-01 challenge responder as a service if
+        http-01-port is set, or stop it if not."""
+        port = self.model.config["http-01-port"]
+        service = ""
+        if port > 0:
+            service = HTTP01_SERVICE.format(
+                cmd=os.path.join(self.charm_dir, "bin/http01.py"),
+                webroot=self._http01_webroot(), port=port)
+        if service == self._stored.http01_service:
+            return
+        path = os.path.join("/etc/systemd/system", HTTP01_SERVICE_NAME)
+        if service:
+            _host.write_file(path, service.encode("utf-8"), mode=0o644)
+            _host.run(["systemctl", "daemon-reload"], check=False)
+            _host.run(["systemctl", "enable", HTTP01_SERVICE_NAME], check=False)
+            _host.run(["systemctl", "restart", HTTP01_SERVICE_NAME], check=False)
+        else:
+            _host.run(["systemctl", "disable", "--now", HTTP01_SERVICE_NAME], check=False)
+            _host.unlink(path)
+            _host.run(["systemctl", "daemon-reload"], check=False)
+        self._stored.http01_service = service
+
+    def _http01_webroot(self) -> str:
+        """Find the webroot certbot writes http-01 challenges to."""
+        return self.model.config["http-01-webroot"] or self._config_path("webroot")
+
+    def _start_job(self, plugin: str, agree_tos: bool, email: str, domains: str,
+                   params: dict, cleanup: List[str]) -> str:
+        """Start acquiring a certificate in the background.
+
+        The job is run by bin/job.py, detached from the hook so that it
+        continues after the action completes. Its state is kept in the
+        jobs directory.
+
+        Args:
+            plugin: Name of the plugin to use to acquire the certificate.
+            agree_tos: Agree to the the terms-of-service of the ACME server.
+            email: Email address to assocaite with the certificate.
+            domains: Comma separated list of domains the certificate is for.
+            params: Additional plugin-specific parameters needed to
+              retrieve the certificate, the lineage is named after the
+              first domain unless they include a cert-name.
+            cleanup: Files to remove if the job fails.
+
+        Returns:
+            The ID of the job.
+
+        Raises:
+            UnsupportedPluginError: The requested plugin is not supported
+              by this charm.
+            PreflightError: The plugin cannot get the certificate.
+            RateLimited: Acquiring the certificate would exceed a rate
+              limit.
+            ValueError: The key parameters are not valid.
+        """
+        job_id = os.environ["JUJU_ACTION_UUID"]
+        domain = domains.split(",")[0]
+        name = params.get("cert-name") or domain
+        if name != domain:
+            job_id = "{}-{}".format(job_id, name)
+        deploy = [{
+            "cmd": ["/etc/letsencrypt/renewal-hooks/deploy/certbot-charm"],
+            "env": {"RENEWED_LINEAGE": os.path.join("/etc/letsencrypt/live", name)},
+        }]
+        if self.model.config["deploy-coalesce"]:
+            deploy.append({"cmd": ["/etc/letsencrypt/renewal-hooks/post/certbot-charm"]})
+        # certbot only reports the progress of the challenges with -v.
+        args = self._plugin_args(plugin, params) + ["-v"]
+        env = self._plugin_env(plugin, params)
+        if self.model.config["preflight"]:
+            self._preflight(plugin, params, domains)
+        key = self._key_spec(params)
+        pool = self._key_pool(key)
+        install = None
+        if pool is not None:
+            work_dir, csr_args = self._csr_request(pool, name, domains, "job-" + job_id)
+            args.extend(csr_args)
+            install = {"dir": work_dir, "config-dir": "/etc/letsencrypt",
+                       "marker": self._pool_marker(name)}
+            key = None
+        elif name != domain:
+            args.append("--cert-name={}".format(name))
+        order = self._ledger().reserve(domains.split(","))
+        job = {
+            "name": name,
+            "domains": domains,
+            "status": "queued",
+            "history": [["queued", time.time()]],
+            "certbot": self._certbot_command() + self._certonly_args(
+                plugin, agree_tos, email, domains, args, key),
+            "deploy": deploy,
+            "cleanup": cleanup,
+            "timeouts": _host.timeouts,
+            "metrics": [self._config_path("metrics.json"), self.model.config["metrics-textfile"]],
+            "ledger": [self._config_path("ledger.json"), order],
+        }
+        if install is not None:
+            job["install"] = install
+        if env:
+            job["certbot-env"] = env
+        job["renewal-env"] = [self._renewal_env_path(name), self._own_env(plugin, env)]
+        path = self._job_path(job_id)
+        state.save_json(path, job)
+        _host.spawn([os.path.join(self.charm_dir, "bin/job.py"), path],
+                    path[:-len(".json")] + ".log")
+        return job_id
+
+    def _job_path(self, job_id: str) -> str:
+        """Calculate the location of a job's state file."""
+        return self._config_path(os.path.join("jobs", os.path.basename(job_id) + ".json"))
+
+    def _on_get_certificates_action(self, event):
+        """Implementation of the get-certificates action."""
+        if self._is_replica():
+            event.fail("certificates are acquired by the leader unit.")
+            return
+        try:
+            specs = yaml.safe_load(event.params["certificates"])
+            if not isinstance(specs, list) or not all(isinstance(s, dict) for s in specs):
+                raise ValueError("expected a list of certificate parameters")
+            for spec in specs:
+                if not spec.get("domains"):
+                    raise ValueError("no domains specified")
+        except (ValueError, yaml.YAMLError) as err:
+            event.fail("invalid certificates: {}".format(err))
+            return
+        specs = [variant for spec in specs for variant in self._variants(spec)]
+
+        def get(worker, lock, index, spec):
+            domain = spec["domains"].split(",")[0]
+            if not self._owns(domain):
+                return {"domains": spec["domains"], "status": "skipped",
+                        "owner": self._owner(domain)}
+            credfile = "action-{}-{}.cred".format(os.environ["JUJU_ACTION_UUID"], index)
+            return self._get_isolated_certificate(worker, lock, credfile, spec, retry=True)
+
+        start = time.monotonic()
+        self._register_account([s for s in specs if self._owns(s["domains"].split(",")[0])])
+        results = self._run_pool(get, specs, event.params.get("workers", 4))
+        if any(r["status"] == "ok" for r in results):
+            try:
+                self._run_pending_deploys()
+            except Exception as err:
+                logger.error("cannot run deploy command: {}".format(err))
+            self._publish_lineages()
+        failed = [r for r in results if r["status"] == "failed"]
+        skipped = [r for r in results if r["status"] == "skipped"]
+        queued = [r for r in results if r["status"] == "queued"]
+        output = {
+            "count": len(results),
+            "failed": len(failed),
+            "queued": len(queued),
+            "skipped": len(skipped),
+            "seconds": "{:.3f}".format(time.monotonic() - start),
+        }
+        for i, result in enumerate(results):
+            output["certificate-{}".format(i)] = result
+        event.set_results(output)
+        if failed:
+            event.fail("cannot get {} of {} certificates".format(len(failed), len(results)))
+        acquired = len(results) - len(failed) - len(skipped) - len(queued)
+        if acquired:
+            self.model.unit.status = ActiveStatus(
+                "maintaining {} certificates.".format(acquired))
+
+    def _register_account(self, specs: List[dict]) -> None:
+        """Register the ACME account shared by isolated certbot runs.
+
+        IsolatedDirs.prepare copies the live accounts to each worker, on
+        a unit without one every concurrent run would otherwise register
+        an account of its own. The account is registered with the
+        agree-tos and email of the first spec.
+        """
+        if not specs or _host.has_account("/etc/letsencrypt"):
+            return
+        args = ["register", "-n", "--no-eff-email"]
+        if specs[0].get("agree-tos", self.model.config["agree-tos"]):
+            args.append("--agree-tos")
+        email = specs[0].get("email", self.model.config["email"])
+        if email:
+            args.append("--email={}".format(email))
+        try:
+            self._certbot(args)
+        except Exception as err:
+            # Each run registers its own account, as before.
+            logger.error("cannot register ACME account: {}".format(err))
+
+    def _run_pool(self, fn: Callable[[int, threading.Lock, int, Any], Any], items: list,
+                  workers: int) -> list:
+        """Call fn for every item using a bounded pool of worker threads.
+
+        fn is called as fn(worker, lock, index, item). Concurrent calls
+        get a different worker index, so that each can use its own
+        certbot directories and certbot worker. Changes to the live
+        certbot configuration must be made holding lock.
+
+        Returns:
+            The results of each call, in the order of items.
+        """
+        slots = queue.Queue()
+        for i in range(max(1, min(workers, len(items)))):
+            slots.put(i)
+        lock = threading.Lock()
+
+        def run(index, item):
+            worker = slots.get()
+            try:
+                return fn(worker, lock, index, item)
+            finally:
+                slots.put(worker)
+
+        with ThreadPoolExecutor(max_workers=slots.qsize()) as executor:
+            return list(executor.map(run, range(len(items)), items))
+
+    def _get_isolated_certificate(self, worker: int, lock: threading.Lock, credfile: str,
+                                  spec: dict, retry: bool = False,
+                                  renewal: bool = False) -> dict:
+        """Get and install a certificate using isolated certbot directories.
+
+        This allows multiple certificates to be acquired in parallel.
+        The acquired lineage is merged into the live certbot
+        configuration before the deploy hook is run.
+
+        Args:
+            worker: Index of the worker, each concurrently running
+              worker must have a different index.
+            lock: Lock serializing changes to the live configuration.
+            credfile: Name of the file in which to store any credentials
+              supplied in the spec.
+            spec: Parameters for the certificate, these are the same as
+              the get-certificate action parameters. The lineage is named
+              after the first domain unless the spec has a cert-name.
+            retry: If the request would exceed a rate limit, queue the
+              spec to be retried once the limit has room.
+            renewal: The request replaces an existing certificate for the
+              same names.
+
+        Returns:
+            The result of the request, with timings.
+        """
+        start = time.monotonic()
+        params = dict(spec)
+        domains = params["domains"]
+        domain = params.get("cert-name") or domains.split(",")[0]
+        result = {"domains": domains, "status": "ok"}
+        certbot_seconds = deploy_seconds = None
+        credpath = self._config_path(credfile)
+        ledger = self._ledger()
+        order = None
+        try:
+            if params.get("credentials"):
+                self._write_base64(credpath, params["credentials"])
+                params["credentials-path"] = credpath
+            plugin = params.get("plugin", self.model.config["plugin"])
+            args = self._plugin_args(plugin, params)
+            # A lineage is renewed with the credentials it was issued with.
+            env = (renewal and self._renewal_env(domain)) or self._plugin_env(plugin, params)
+            key = self._key_spec(params)
+            dirs = IsolatedDirs(self._config_path("workers/{}".format(worker)))
+            dirs.prepare("/etc/letsencrypt", domain)
+            args.extend(dirs.args())
+            args.append("--cert-name={}".format(domain))
+            if self.model.config["preflight"]:
+                self._preflight(plugin, params, domains)
+            order = ledger.reserve(domains.split(","), renewal=renewal)
+            self._dequeue(domain)
+            self._run_certbot(plugin,
+                              params.get("agree-tos", self.model.config["agree-tos"]),
+                              params.get("email", self.model.config["email"]),
+                              domains, args, worker=worker, key=key, env=env)
+            certbot_seconds = time.monotonic() - start
+            ledger.finish(order, True)
+            result["certbot-seconds"] = "{:.3f}".format(certbot_seconds)
+            deploy_start = time.monotonic()
+            with lock:
+                merge_lineage(dirs.config_dir, "/etc/letsencrypt", domain)
+            if not self._deploy_issued(domain, coalesce=True, worker=worker):
+                result["deploy-status"] = "failed"
+            deploy_seconds = time.monotonic() - deploy_start
+            result["deploy-seconds"] = "{:.3f}".format(deploy_seconds)
+        except RateLimited as err:
+            logger.info("queued certificate for %s: %s", domains, err)
+            result.update(status="queued", limit=err.limit, eta=err.eta.isoformat())
+            self._enqueue(domain, domains, err, spec if retry else None)
+        except Exception as err:
+            logger.error("cannot get certificate for {}: {}".format(domains, err))
+            result["status"] = "failed"
+            result["error"] = str(err)
+            if order is not None and certbot_seconds is None:
+                ledger.finish(order, False)
+        if result["status"] != "ok" and _host.exists(credpath):
+            try:
+                _host.unlink(credpath)
+            except Exception:
+                pass
+        result["seconds"] = "{:.3f}".format(time.monotonic() - start)
+        if result["status"] != "queued":
+            self._record_run(domain, "renew" if renewal else "issue", result["status"] == "ok",
+                             certbot_seconds, deploy_seconds)
+        return result
+
+    def _on_list_certificates_action(self, event):
+        """Implementation of the list-certificates action."""
+        entries = self._refresh_index()
+        results = {"count": len(entries)}
+        for i, entry in enumerate(entries):
+            results["certificate-{}".format(i)] = {
+                "name": entry["name"],
+                "domains": ",".join(entry["domains"]),
+                "not-after": entry["not-after"],
+                "serial": entry["serial"],
+                "key-type": entry["key-type"],
+                "key-size": entry["key-size"],
+            }
+        event.set_results(results)
+        self._update_expiry_status(entries)
+
+    def _on_plan_certificates_action(self, event):
+        """Implementation of the plan-certificates action."""
+        if self._is_replica():
+            event.fail("certificates are acquired by the leader unit.")
+            return
+        try:
+            hostnames = event.params.get("domains") or self.model.config["planned-domains"]
+            plan, saved = self._plan(hostnames)
+        except ValueError as err:
+            event.fail("invalid domains: {}".format(err))
+            return
+        statuses = {name: "pending" for name in saved["pending"]}
+        results = []
+        if event.params.get("apply"):
+            state.save_json(self._config_path("plan.json"), saved)
+            results = self._issue_planned(None, event.params.get("workers", 4))
+            statuses.update((r["name"], r["status"]) for r in results)
+        output = {
+            "count": len(plan.certificates),
+            "domains": sum(len(d) for d in plan.certificates.values()),
+            "pending": len(saved["pending"]),
+            "removed": ",".join(plan.removed),
+        }
+        for i, (name, domains) in enumerate(plan.certificates.items()):
+            output["certificate-{}".format(i)] = {
+                "name": name,
+                "domains": ",".join(domains),
+                "status": statuses.get(name, "current"),
+            }
+        event.set_results(output)
+        failed = [r for r in results if r["status"] == "failed"]
+        if failed:
+            event.fail("cannot get {} of {} certificates".format(len(failed), len(results)))
+
+    def _plan(self, hostnames: str) -> Tuple[planner.Plan, dict]:
+        """Plan the certificates for a list of hostnames.
+
+        The plan is made from the saved plan, so that only certificates
+        affected by changes to the hostnames need to be issued. New
+        certificates are never given the name of an existing lineage
+        that is not part of the plan.
+
+        Args:
+            hostnames: Comma, or whitespace, separated hostnames.
+
+        Returns:
+            The plan, and the state to save in plan.json to apply it.
+
+        Raises:
+            ValueError: A hostname is not valid.
+        """
+        current = state.load_json(self._config_path("plan.json"), {})
+        previous = current.get("certificates", {})
+        plan = planner.plan(planner.parse_hostnames(hostnames), previous,
+                            self.model.config["planned-max-names"],
+                            self.model.config["planned-isolate-domains"],
+                            [entry["name"] for entry in self._index.refresh()])
+        pending = set(current.get("pending", [])) | set(plan.changed)
+        return plan, {
+            "certificates": plan.certificates,
+            "pending": sorted(name for name in pending if name in plan.certificates),
+        }
+
+    def _issue_planned(self, limit: int, workers: int) -> List[dict]:
+        """Issue the pending certificates of the saved plan.
+
+        Certificates that fail to issue stay pending and are retried
+        the next time this is called, those held back by a rate limit
+        are not retried until the limit has room. When sharding, only
+        certificates owned by this unit are issued.
+
+        Args:
+            limit: Maximum number of certificates to issue, or None.
+            workers: Number of certificates to issue concurrently.
+
+        Returns:
+            The result of each issued certificate, with its name.
+        """
+        path = self._config_path("plan.json")
+        saved = state.load_json(path, {})
+        held = self._held_back()
+        pending = [name for name in saved.get("pending", [])
+                   if self._owns(name) and name not in held][:limit]
+        if not pending:
+            return []
+        logger.info("issuing %d planned certificates", len(pending))
+        requests = [(name, variant) for name in pending for variant in self._variants(
+            {"domains": ",".join(saved["certificates"][name]), "cert-name": name})]
+        results = self._run_pool(
+            lambda worker, lock, index, request: self._get_isolated_certificate(
+                worker, lock, "plan-{}.cred".format(index), request[1]),
+            requests, workers)
+        failed = set()
+        for (name, variant), result in zip(requests, results):
+            result["name"] = variant["cert-name"]
+            if result["status"] != "ok":
+                failed.add(name)
+        issued = set(pending) - failed
+        saved["pending"] = [name for name in saved["pending"] if name not in issued]
+        state.save_json(path, saved)
+        if issued:
+            try:
+                self._run_pending_deploys()
+            except Exception as err:
+                logger.error("cannot run deploy command: {}".format(err))
+            self._publish_lineages()
+        return results
+
+    def _on_preflight_action(self, event):
+        """Implementation of the preflight action."""
+        params = dict(event.params)
+        plugin = params.get("plugin", self.model.config["plugin"])
+        domains = params.get("domains", self.model.config["domains"])
+        if not domains:
+            event.fail("no domains specified")
+            return
+        credpath = self._config_path("action-{}.cred".format(os.environ["JUJU_ACTION_UUID"]))
+        start = time.monotonic()
+        try:
+            if params.get("credentials"):
+                self._write_base64(credpath, params["credentials"])
+                params["credentials-path"] = credpath
+            results = self._preflight(plugin, params, domains)
+            results["status"] = "ok"
+        except (ValueError, binascii.Error) as err:
+            event.fail("invalid credentials: {}".format(err))
+            return
+        except preflight.PreflightError as err:
+            results = {"status": "failed", "error": str(err)}
+        finally:
+            if params.get("credentials"):
+                _host.unlink(credpath)
+        results["seconds"] = "{:.3f}".format(time.monotonic() - start)
+        event.set_results(results)
+        if results["status"] != "ok":
+            event.fail("preflight failed: {}".format(results["error"]))
+
+    def _on_list_queue_action(self, event):
+        """Implementation of the list-queue action."""
+        queue = state.load_json(self._config_path("queue.json"), {})
+        results = {"count": len(queue)}
+        for i, (name, entry) in enumerate(sorted(queue.items(), key=lambda i: i[1]["eta"])):
+            results["certificate-{}".format(i)] = {
+                "name": name,
+                "domains": entry["domains"],
+                "limit": entry["limit"],
+                "queued": entry["queued"],
+                "eta": entry["eta"],
+            }
+        event.set_results(results)
+
+    def _ledger(self) -> Ledger:
+        """Get the ledger of ACME orders made by this unit."""
+        return Ledger(self._config_path("ledger.json"),
+                      parse_limits(self.model.config["rate-limits"]))
+
+    def _enqueue(self, name: str, domains: str, err: RateLimited, spec: dict = None) -> None:
+        """Record a certificate held back by a rate limit.
+
+        Args:
+            name: Name of the lineage.
+            domains: Comma separated list of domains the certificate is for.
+            err: The rate limit that would be exceeded.
+            spec: Parameters to acquire the certificate with once the
+              limit has room, if nothing else will retry it.
+        """
+        with self._queue_lock:
+            path = self._config_path("queue.json")
+            queue = state.load_json(path, {})
+            queued = queue.get(name, {}).get(
+                "queued", datetime.datetime.now(datetime.timezone.utc).isoformat())
+            queue[name] = {"domains": domains, "limit": err.limit, "eta": err.eta.isoformat(),
+                           "queued": queued}
+            if spec is not None:
+                queue[name]["spec"] = spec
+            state.save_json(path, queue)
+
+    def _dequeue(self, name: str) -> None:
+        """Remove a certificate from the queue, if it is there."""
+        with self._queue_lock:
+            path = self._config_path("queue.json")
+            queue = state.load_json(path, {})
+            if queue.pop(name, None) is not None:
+                state.save_json(path, queue)
+
+    def _held_back(self) -> set:
+        """Find the queued certificates whose rate limit has no room yet."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        queue = state.load_json(self._config_path("queue.json"), {})
+        return {name for name, entry in queue.items()
+                if state.parse_time(entry["eta"]) > now}
+
+    def _release_queued(self, limit: int, workers: int) -> bool:
+        """Acquire the queued certificates whose rate limit has room.
+
+        Only certificates queued with their parameters are acquired
+        here, planned certificates and renewals are retried by the
+        planner and the renewal scheduler.
+
+        Args:
+            limit: Maximum number of certificates to acquire.
+            workers: Number of certificates to acquire concurrently.
+
+        Returns:
+            True if any certificate was acquired.
+        """
+        queue = state.load_json(self._config_path("queue.json"), {})
+        held = self._held_back()
+        ready = sorted((entry["eta"], name) for name, entry in queue.items()
+                       if "spec" in entry and name not in held)
+        specs = [queue[name]["spec"] for _, name in ready[:limit]]
+        if not specs:
+            return False
+        logger.info("acquiring %d queued certificates", len(specs))
+        results = self._run_pool(
+            lambda worker, lock, index, spec: self._get_isolated_certificate(
+                worker, lock, "queue-{}.cred".format(index), spec, retry=True),
+            specs, workers)
+        if not any(r["status"] == "ok" for r in results):
+            return False
+        try:
+            self._run_pending_deploys()
+        except Exception as err:
+            logger.error("cannot run deploy command: {}".format(err))
+        self._publish_lineages()
+        return True
+
+    def _refresh_index(self) -> List[dict]:
+        """Refresh the certificate index and export the expiry times.
+
+        Returns:
+            The index entries.
+        """
+        entries = self._index.refresh()
+        try:
+            self._metrics().replace_expiry(
+                {entry["name"]: not_after(entry).timestamp() for entry in entries})
+        except Exception as err:
+            logger.error("cannot update metrics: {}".format(err))
+        return entries
+
+    def _update_expiry_status(self, entries: List[dict]) -> None:
+        """Set the unit status from the certificate that expires first.
+
+        The status is not changed if there are no certificates.
+        """
+        entry = soonest_expiry(entries)
+        if entry is None:
+            return
+        expiry = not_after(entry)
+        if expiry <= datetime.datetime.now(datetime.timezone.utc):
+            self.model.unit.status = BlockedStatus("certificate for {} expired {}.".format(
+                entry["name"], expiry.strftime("%Y-%m-%d %H:%M")))
+            return
+        self.model.unit.status = ActiveStatus(
+            "maintaining {} certificate{}, next expiry {} on {}.".format(
+                len(entries), "" if len(entries) == 1 else "s", entry["name"],
+                expiry.strftime("%Y-%m-%d")))
+
+    def _renew_due(self, entries: List[dict]) -> bool:
+        """Renew the certificates that are due for renewal.
+
+        At most renewal-max-per-run certificates, those expiring
+        soonest, are renewed concurrently using renewal-concurrency
+        workers. The result of each renewal is recorded in
+        renewals.json. A certificate that failed to renew is not tried
+        again until its backoff has passed, as each attempt counts
+        against the CA's failed validation limit.
+
+        Args:
+            entries: Certificate index entries.
+
+        Returns:
+            True if any certificate was renewed.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._sharding():
+            ring = self._ring()
+            entries = [e for e in entries if ring.owner(e["name"]) == self.model.unit.name]
+        failures = FailureCache(self._config_path("renewal-failures.json"))
+        held = self._held_back() | failures.waiting(now)
+        entries = [e for e in entries if e["name"] not in held]
+        renew_at = {}
+        if self.model.config["renewal-info"]:
+            renew_at = self._renewal_info(entries, now)
+        due = select_due(entries, now, self.model.unit.name,
+                         datetime.timedelta(days=self.model.config["renew-before-days"]),
+                         datetime.timedelta(hours=self.model.config["renewal-jitter-hours"]),
+                         renew_at)
+        due = due[:self.model.config["renewal-max-per-run"]]
+        if not due:
+            return False
+        logger.info("renewing %d certificates", len(due))
+        results = self._run_pool(lambda worker, lock, _, entry: self._renew_isolated(
+            worker, lock, entry["name"], entry["domains"], key_params(entry)), due,
+            self.model.config["renewal-concurrency"])
+
+        path = self._config_path("renewals.json")
+        history = state.load_json(path, {})
+        for entry, result in zip(due, results):
+            result["attempted"] = now.isoformat()
+            if result["status"] == "failed":
+                result["retry-at"] = failures.failed(entry["name"], now)["retry-at"]
+            elif result["status"] == "ok":
+                failures.clear(entry["name"])
+            history[entry["name"]] = result
+        state.save_json(path, history)
+
+        renewed = any(r["status"] == "ok" for r in results)
+        if renewed:
+            try:
+                self._run_pending_deploys()
+            except Exception as err:
+                logger.error("cannot run deploy command: {}".format(err))
+        return renewed
+
+    def _renewal_info(self, entries: List[dict],
+                      now: datetime.datetime) -> Dict[str, datetime.datetime]:
+        """Find the renewal times suggested by the CAs of certificates.
+
+        The suggested windows are cached in renewal-info.json and only
+        fetched again when the CA's Retry-After has passed, or the
+        certificate has been replaced. Windows are fetched concurrently
+        using renewal-concurrency workers.
+
+        Args:
+            entries: Certificate index entries.
+            now: The current time.
+
+        Returns:
+            The renewal time of each certificate whose window is known.
+        """
+        info = ari.RenewalInfo(self._config_path("renewal-info.json"))
+        stale = [e for e in entries if info.stale(e["name"], e["serial"], now)]
+
+        def fetch(worker, lock, index, entry):
+            try:
+                cert = x509.parse_pem_file(
+                    os.path.join("/etc/letsencrypt/live", entry["name"], "cert.pem"))
+                return ari.fetch(ari.lineage_directory("/etc/letsencrypt", entry["name"]),
+                                 cert, now=now)
+            except (ari.ARIError, OSError, ValueError) as err:
+                logger.warning("cannot get renewal information for %s: %s",
+                               entry["name"], err)
+                return None
+
+        for entry, window in zip(stale, self._run_pool(
+                fetch, stale, self.model.config["renewal-concurrency"])):
+            if window is None:
+                info.failed(entry["name"], entry["serial"], now)
+            else:
+                info.update(entry["name"], entry["serial"], window, now)
+        info.retain([e["name"] for e in entries])
+        info.save()
+        renew_at = {}
+        for entry in entries:
+            t = info.renew_at(entry["name"], entry["serial"])
+            if t is not None:
+                renew_at[entry["name"]] = t
+        return renew_at
+
+    def _renew_isolated(self, worker: int, lock: threading.Lock, name: str,
+                        domains: List[str], key: dict = None) -> dict:
+        """Renew a lineage using isolated certbot directories.
+
+        The lineage is copied to the worker's directories, renewed there
+        and merged back into the live configuration before the deploy
+        hook is run.
+
+        Args:
+            worker: Index of the worker, each concurrently running
+              worker must have a different index.
+            lock: Lock serializing changes to the live configuration.
+            name: Name of the lineage to renew.
+            domains: The names on the certificate.
+            key: Parameters requesting the lineage's key type, used if a
+              new certificate has to be requested.
+
+        Returns:
+            The result of the renewal, with timings.
+        """
+        conf = os.path.join("/etc/letsencrypt/renewal", name + ".conf")
+        if not _host.exists(conf) and _host.exists(self._pool_marker(name)):
+            # certbot cannot renew a certificate issued for a CSR, request
+            # a new one with a fresh key from the pool.
+            return self._get_isolated_certificate(
+                worker, lock, "renew-{}.cred".format(worker),
+                dict(key or {}, **{"domains": ",".join(domains), "cert-name": name}),
+                renewal=True)
+        start = time.monotonic()
+        result = {"status": "ok"}
+        certbot_seconds = deploy_seconds = None
+        ledger = self._ledger()
+        order = None
+        try:
+            dirs = IsolatedDirs(self._config_path("workers/{}".format(worker)))
+            dirs.prepare("/etc/letsencrypt", name)
+            merge_lineage("/etc/letsencrypt", dirs.config_dir, name)
+            order = ledger.reserve(domains, renewal=True)
+            self._dequeue(name)
+            # The charm has already decided the certificate is due.
+            args = ["renew", "-n", "--cert-name={}".format(name), "--force-renewal"]
+            if self._certbot_supports(NO_RANDOM_SLEEP_VERSION):
+                args.append("--no-random-sleep-on-renew")
+            self._certbot(args + dirs.args(), worker, self._renewal_env(name))
+            certbot_seconds = time.monotonic() - start
+            ledger.finish(order, True)
+            result["certbot-seconds"] = "{:.3f}".format(certbot_seconds)
+            deploy_start = time.monotonic()
+            with lock:
+                merge_lineage(dirs.config_dir, "/etc/letsencrypt", name)
+            if not self._deploy_issued(name, coalesce=True, worker=worker):
+                result["deploy-status"] = "failed"
+            deploy_seconds = time.monotonic() - deploy_start
+            result["deploy-seconds"] = "{:.3f}".format(deploy_seconds)
+        except RateLimited as err:
+            logger.info("queued renewal of %s: %s", name, err)
+            result.update(status="queued", limit=err.limit, eta=err.eta.isoformat())
+            self._enqueue(name, ",".join(domains), err)
+        except Exception as err:
+            logger.error("cannot renew certificate {}: {}".format(name, err))
+            result["status"] = "failed"
+            result["error"] = str(err)
+            if order is not None and certbot_seconds is None:
+                ledger.finish(order, False)
+        result["seconds"] = "{:.3f}".format(time.monotonic() - start)
+        if result["status"] != "queued":
+            self._record_run(name, "renew", result["status"] == "ok", certbot_seconds,
+                             deploy_seconds)
+        return result
+
+    def _certbot_supports(self, version: Tuple[int, ...]) -> bool:
+        """Check whether the installed certbot is at least version."""
+        installed = _host.certbot_version()
+        return installed is not None and installed >= version
+
+    def _http_01_args(self, params: dict) -> List[str]:
+        """Calculate arguments for the http-01 plugin.
+
+        The challenges are written to the webroot by certbot's webroot
+        plugin, and served by the principal's web server or the charm's
+        responder.
+
+        Args:
+            params: Plugin-specific parameters that will be converted to
+              arguments or environment variables.
+        """
+        return ["--webroot-path={}".format(params.get("webroot-path", self._http01_webroot()))]
+
     def _dns_google_args(self, params: dict) -> List[str]:
         """Calculate arguments for the dns-google plugin.
 
@@ -167,29 +1627,99 @@ class CertbotCharm(CharmBase):
         """
         propagation = params.get("propagation-seconds",
                                  self.model.config["propagation-seconds"])
-        aws_access_key_id = params.get(
-            "aws-access-key-id", self.model.config["dns-route53-aws-access-key-id"])
-        aws_secret_access_key = params.get(
-            "aws-secret-access-key", self.model.config["dns-route53-aws-secret-access-key"])
-
-        if aws_access_key_id and aws_secret_access_key:
-            config = configparser.ConfigParser()
-            config.read(self._aws_config_file)
-            try:
-                config.add_section("default")
-            except configparser.DuplicateSectionError:
-                pass
-            config.set("default", "aws_access_key_id", aws_access_key_id)
-            config.set("default", "aws_secret_access_key", aws_secret_access_key)
-            if not self._aws_config_file.parent.exists():
-                self._aws_config_file.parent.mkdir()
-            with open(self._aws_config_file, "w") as f:
-                config.write(f)
-
         return [
             "--dns-route53-propagation-seconds={}".format(propagation),
         ]
 
+    def _dns_route53_env(self, params: dict) -> Dict[str, str]:
+        """Calculate environment variables for the dns-route53 plugin.
+
+        The AWS credentials are selected with an AWS configuration file
+        holding only them, so that requests with different credentials
+        can run concurrently. Without credentials the plugin uses AWS's
+        default configuration.
+
+        Args:
+            params: Plugin-specific parameters that will be converted to
+              arguments or environment variables.
+
+        Raises:
+            ValueError: The parameters give credentials other than the
+              configured ones, which only the renewal-scheduler can
+              renew with.
+        """
+        configured = (self.model.config["dns-route53-aws-access-key-id"],
+                      self.model.config["dns-route53-aws-secret-access-key"])
+        aws_access_key_id = params.get("aws-access-key-id", configured[0])
+        aws_secret_access_key = params.get("aws-secret-access-key", configured[1])
+        if not (aws_access_key_id and aws_secret_access_key):
+            return {}
+        if (aws_access_key_id, aws_secret_access_key) != configured and \
+                not self.model.config["renewal-scheduler"]:
+            raise ValueError("dns-route53 credentials other than the configured ones "
+                             "require renewal-scheduler")
+        path = self._aws_profile(aws_access_key_id, aws_secret_access_key)
+        return {"AWS_CONFIG_FILE": path, "AWS_SHARED_CREDENTIALS_FILE": path,
+                "AWS_PROFILE": "default"}
+
+    def _aws_profile(self, aws_access_key_id: str, aws_secret_access_key: str) -> str:
+        """Find the AWS configuration file holding a set of credentials.
+
+        Each file is named after a fingerprint of its credentials, and
+        is only written if it does not exist yet.
+
+        Returns:
+            The location of the file.
+        """
+        fingerprint = hashlib.sha256(json.dumps(
+            [aws_access_key_id, aws_secret_access_key]).encode("utf-8")).hexdigest()
+        path = self._config_path(os.path.join("aws", fingerprint))
+        with self._aws_lock:
+            if path not in self._aws_profiles:
+                if not _host.exists(path):
+                    _host.write_file(path, "[default]\naws_access_key_id = {}\n"
+                                     "aws_secret_access_key = {}\n".format(
+                                         aws_access_key_id, aws_secret_access_key).encode("utf-8"))
+                self._aws_profiles.add(path)
+        return path
+
+    def _own_env(self, plugin: str, env: Mapping[str, str]) -> Optional[Dict[str, str]]:
+        """Find the environment a lineage must be renewed with.
+
+        Args:
+            plugin: Name of the plugin the lineage was issued with.
+            env: Environment the lineage was issued with.
+
+        Returns:
+            The environment, or None if it is the plugin's default
+            environment, which certbot's timer also renews with.
+        """
+        if not env or env == self._plugin_env(plugin, {}):
+            return None
+        return dict(env)
+
+    def _renewal_env_path(self, name: str) -> str:
+        """Calculate the location of a lineage's renewal environment."""
+        return self._config_path(os.path.join("renewal-env", name + ".json"))
+
+    def _renewal_env(self, name: str) -> Optional[Dict[str, str]]:
+        """Get the environment to renew a lineage with, if it is not the
+        plugin's default."""
+        return state.load_json(self._renewal_env_path(name))
+
+    def _save_renewal_env(self, name: str, env: Optional[Mapping[str, str]]) -> None:
+        """Record the environment to renew a lineage with.
+
+        Args:
+            name: Name of the lineage.
+            env: The environment, or None for the plugin's default.
+        """
+        path = self._renewal_env_path(name)
+        if env:
+            _host.write_file(path, json.dumps(env, sort_keys=True).encode("utf-8"))
+        elif self._renewal_env(name) is not None:
+            _host.unlink(path)
+
     def _get_certificate(self, plugin: str, agree_tos: bool, email: str, domains: str,
                          params: dict = {}) -> None:
         """Get and install a certificate.
@@ -209,33 +1739,205 @@ class CertbotCharm(CharmBase):
         Raises:
             UnsupportedPluginError: The requested plugin is not supported
               by this charm.
+            PreflightError: The plugin cannot get the certificate.
+            RateLimited: Acquiring the certificate would exceed a rate
+              limit.
+            ValueError: The key parameters are not valid.
 
         """
+        args = self._plugin_args(plugin, params)
+        env = self._plugin_env(plugin, params)
+        domain = domains.split(",")[0]
+        if self.model.config["preflight"]:
+            self._preflight(plugin, params, domains)
+        undeployed = []
+        for variant in self._variants(dict(params, domains=domains)):
+            name = variant.get("cert-name") or domain
+            key = self._key_spec(variant)
+            certbot_args = list(args)
+            if name != domain:
+                certbot_args.append("--cert-name={}".format(name))
+            ledger = self._ledger()
+            order = ledger.reserve(domains.split(","))
+            start = time.monotonic()
+            certbot_seconds = None
+            try:
+                self._run_certbot(plugin, agree_tos, email, domains, certbot_args, key=key,
+                                  env=env)
+                certbot_seconds = time.monotonic() - start
+                ledger.finish(order, True)
+            except Exception:
+                if certbot_seconds is None:
+                    ledger.finish(order, False)
+                self._record_run(name, "issue", False, certbot_seconds)
+                raise
+            if not self._deploy_issued(name):
+                undeployed.append(name)
+            self._record_run(name, "issue", True, certbot_seconds,
+                             time.monotonic() - start - certbot_seconds)
+        if undeployed:
+            self.model.unit.status = BlockedStatus("deploy command failed for {}.".format(
+                ", ".join(undeployed)))
+            return
+        self.model.unit.status = ActiveStatus("maintaining certificate for {}.".format(domain))
+
+    def _plugin_args(self, plugin: str, params: dict) -> List[str]:
+        """Calculate the certbot arguments for a plugin.
+
+        Args:
+            plugin: Name of the plugin to use to acquire the certificate.
+            params: Additional plugin-specific parameters.
+
+        Raises:
+            UnsupportedPluginError: The requested plugin is not supported
+              by this charm.
+        """
         try:
-            args = getattr(self, "_{}_args".format(plugin.replace("-", "_")))(params)
+            return getattr(self, "_{}_args".format(plugin.replace("-", "_")))(params)
         except (AttributeError, TypeError):
             raise UnsupportedPluginError('plugin "{}" not supported'.format(plugin))
 
-        self._run_certbot(plugin, agree_tos, email, domains, args)
+    def _plugin_env(self, plugin: str, params: dict) -> Dict[str, str]:
+        """Calculate the environment variables certbot needs for a plugin.
 
-        domain = domains.split(",")[0]
-        self._deploy(domain)
-        self.model.unit.status = ActiveStatus("maintaining certificate for {}.".format(domain))
+        Args:
+            plugin: Name of the plugin to use to acquire the certificate.
+            params: Additional plugin-specific parameters.
+
+        Returns:
+            The variables to add to certbot's environment.
+        """
+        env = getattr(self, "_{}_env".format(plugin.replace("-", "_")), None)
+        return env(params) if env else {}
+
+    def _preflight(self, plugin: str, params: dict, domains: str) -> Dict[str, str]:
+        """Run the preflight checks of a plugin.
+
+        Args:
+            plugin: Name of the plugin to check.
+            params: Plugin-specific parameters, as for _plugin_args.
+            domains: Comma separated list of domains to check.
+
+        Returns:
+            Details of what was checked.
+
+        Raises:
+            PreflightError: The plugin cannot get a certificate for the
+              domains.
+        """
+        start = time.monotonic()
+        credfile = {"dns-google": "dns-google.json", "dns-rfc2136": "dns-rfc2136.ini"}.get(plugin)
+        key_id = params.get("aws-access-key-id",
+                            self.model.config["dns-route53-aws-access-key-id"])
+        secret = params.get("aws-secret-access-key",
+                            self.model.config["dns-route53-aws-secret-access-key"])
+        if plugin == "dns-route53" and not (key_id and secret):
+            config = configparser.ConfigParser()
+            config.read(self._aws_config_file)
+            key_id = config.get("default", "aws_access_key_id", fallback=None)
+            secret = config.get("default", "aws_secret_access_key", fallback=None)
+        details = preflight.check(
+            plugin, domains.split(","),
+            credentials_path=params.get("credentials-path",
+                                        credfile and self._config_path(credfile)),
+            aws_access_key_id=key_id, aws_secret_access_key=secret,
+            resolver=self.model.config["propagation-resolver"] or None)
+        if details.get("warnings"):
+            logger.warning("preflight of %s for %s: %s", plugin, domains, details["warnings"])
+        logger.info("preflight of %s for %s passed in %.3fs", plugin, domains,
+                    time.monotonic() - start)
+        return details
 
-    def _deploy(self, domain: str) -> None:
+    def _record_run(self, domain: str, operation: str, ok: bool, certbot_seconds: float = None,
+                    deploy_seconds: float = None) -> None:
+        """Record an issuance or renewal in the exported metrics.
+
+        Failures to record metrics are logged, they never fail the
+        operation being recorded.
+        """
+        try:
+            self._metrics().record_run(domain, operation, ok, certbot_seconds, deploy_seconds)
+        except Exception as err:
+            logger.error("cannot update metrics: {}".format(err))
+
+    def _metrics(self) -> Metrics:
+        """Get the recorder for the exported metrics."""
+        return Metrics(self._config_path("metrics.json"), self.model.config["metrics-textfile"])
+
+    def _deploy(self, domain: str, coalesce: bool = False, worker: int = 0) -> None:
         """Run the deploy hook.
 
         Args:
             domain: primary domain of the certificate to run the hook for.
+            coalesce: If deploy-coalesce is enabled, leave the deploy
+              command pending for a later call to _run_pending_deploys.
+            worker: Index of the certbot worker to use, if the
+              certbot-engine is "worker".
         """
+        lineage = os.path.join("/etc/letsencrypt/live", domain)
+        flush = self.model.config["deploy-coalesce"] and not coalesce
+        if self.model.config["certbot-engine"] == "worker":
+            self._certbot_worker(worker).deploy(lineage, flush=flush)
+            return
         cmd = ["/etc/letsencrypt/renewal-hooks/deploy/certbot-charm"]
         env = {
-            "RENEWED_LINEAGE": os.path.join("/etc/letsencrypt/live", domain),
+            "RENEWED_LINEAGE": lineage,
         }
         _host.run(cmd, env=env)
+        if flush:
+            self._run_pending_deploys()
+
+    def _deploy_issued(self, domain: str, **kwargs) -> bool:
+        """Run the deploy hook for a lineage that has just been issued.
+
+        The certificate has been acquired whether or not the deploy
+        hook succeeds, so a failure is logged rather than raised. The
+        deploy command's failure is recorded in the deploy metrics by
+        the hook.
+
+        Args:
+            domain: primary domain of the certificate to run the hook for.
+            kwargs: Other arguments, as for _deploy.
+
+        Returns:
+            False if the deploy hook failed.
+        """
+        try:
+            self._deploy(domain, **kwargs)
+        except Exception as err:
+            logger.error("cannot deploy certificate {}: {}".format(domain, err))
+            return False
+        return True
+
+    def _refresh_ocsp(self, entries: List[dict]) -> None:
+        """Refresh the OCSP staples of the lineages that are due.
+
+        The deploy command is run once if any staple changed.
+
+        Args:
+            entries: The certificate index entries of the lineages.
+        """
+        if not self.model.config["ocsp-path"] or not entries:
+            return
+        cmd = [os.path.join(self.charm_dir, "bin/deploy.py"), "ocsp"]
+        cmd.extend(os.path.join("/etc/letsencrypt/live", e["name"]) for e in entries)
+        try:
+            _host.run(cmd, category="deploy")
+        except (CommandError, subprocess.TimeoutExpired) as err:
+            logger.error("cannot refresh OCSP staples: {}".format(err))
+
+    def _run_pending_deploys(self) -> None:
+        """Run the post hook to run any coalesced deploy command."""
+        if not self.model.config["deploy-coalesce"]:
+            return
+        if self.model.config["certbot-engine"] == "worker":
+            self._certbot_worker(0).flush()
+        else:
+            _host.run(["/etc/letsencrypt/renewal-hooks/post/certbot-charm"])
 
     def _run_certbot(self, plugin: str, agree_tos: bool, email: str, domains: str,
-                     args: List[str] = None) -> None:
+                     args: List[str] = None, worker: int = 0, key: str = None,
+                     env: Mapping[str, str] = None) -> None:
         """Run the certbot command.
 
         Runs a non-interactive certbot certonly command.
@@ -247,18 +1949,245 @@ class CertbotCharm(CharmBase):
             domains: Comma separated list of domains the certificate is for.
             args: Additional, plugin-specific, arguments to add to the
               certbot command.
+            worker: Index of the certbot worker to use, if the
+              certbot-engine is "worker".
+            key: Specification of the key to request, as for
+              keypool.parse_spec, or None for certbot's default.
+            env: Environment variables to add to certbot's environment.
         """
-        cmd = ["certbot", "certonly", "-n", "--no-eff-email"]
-        cmd.append("--{}".format(plugin))
+        name = domains.split(",")[0]
+        for arg in args or []:
+            option, _, value = arg.partition("=")
+            if option == "--cert-name":
+                name = value
+        pool = self._key_pool(key)
+        if pool is None:
+            self._certbot(self._certonly_args(plugin, agree_tos, email, domains, args, key),
+                          worker, env)
+            self._save_renewal_env(name, self._own_env(plugin, env))
+            return
+        # certbot does not create a lineage for a CSR, so the charm
+        # installs the certificate into the lineage itself.
+        config_dir = "/etc/letsencrypt"
+        certbot_args = []
+        for arg in args or []:
+            option, _, value = arg.partition("=")
+            if option == "--cert-name":
+                continue
+            if option == "--config-dir":
+                config_dir = value
+            certbot_args.append(arg)
+        work_dir, csr_args = self._csr_request(pool, name, domains, str(worker))
+        try:
+            self._certbot(self._certonly_args(plugin, agree_tos, email, domains,
+                                              certbot_args + csr_args), worker, env)
+            keypool.install_issued(work_dir, config_dir, name)
+            _host.write_file(self._pool_marker(name), b"", mode=0o644)
+            self._save_renewal_env(name, self._own_env(plugin, env))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _certonly_args(self, plugin: str, agree_tos: bool, email: str, domains: str,
+                       args: List[str] = None, key: str = None) -> List[str]:
+        """Calculate the arguments for a non-interactive certbot certonly
+        command."""
+        cmd = ["certonly", "-n", "--no-eff-email"]
+        cmd.append("--{}".format(AUTHENTICATORS.get(plugin, plugin)))
         if agree_tos:
             cmd.append("--agree-tos")
         if email:
             cmd.append("--email={}".format(email))
         if domains:
             cmd.append("--domains={}".format(domains))
+        if key:
+            cmd.extend(keypool.certbot_args(key))
         if args:
             cmd.extend(args)
-        _host.run(cmd)
+        return cmd
+
+    def _certbot(self, args: List[str], worker: int = 0,
+                 env: Mapping[str, str] = None) -> None:
+        """Run certbot with the configured certbot-engine.
+
+        Args:
+            args: Arguments to pass to certbot.
+            worker: Index of the certbot worker to use, if the
+              certbot-engine is "worker".
+            env: Environment variables to add to certbot's environment.
+        """
+        if self.model.config["certbot-engine"] == "worker":
+            self._certbot_worker(worker).certbot(args, env=env)
+        elif env:
+            _host.run(self._certbot_command() + args, env=dict(os.environ, **env))
+        else:
+            _host.run(self._certbot_command() + args)
+
+    def _certbot_worker(self, index: int) -> CertbotWorker:
+        """Get a long-lived certbot worker.
+
+        Each concurrent user must use a different index. Workers exit
+        when the hook process exits.
+        """
+        if index not in self._workers:
+            cmd = [os.path.join(self.charm_dir, "bin/certbot_worker.py")]
+            if self.model.config["propagation-mode"] == "poll":
+                cmd.append("--poll")
+                if self.model.config["propagation-resolver"]:
+                    cmd.append("--resolver={}".format(
+                        self.model.config["propagation-resolver"]))
+            self._workers[index] = CertbotWorker(cmd, _host.timeouts)
+        return self._workers[index]
+
+    def _certbot_command(self) -> List[str]:
+        """Calculate the command used to run certbot.
+
+        If the propagation-mode is "poll" certbot is run through a
+        wrapper that polls the authoritative DNS servers rather than
+        waiting for the full propagation-seconds.
+        """
+        if self.model.config["propagation-mode"] != "poll":
+            return ["certbot"]
+        cmd = [os.path.join(self.charm_dir, "bin/propagation.py")]
+        if self.model.config["propagation-resolver"]:
+            cmd.append("--resolver={}".format(self.model.config["propagation-resolver"]))
+        cmd.append("--")
+        return cmd
+
+    def _key_pool(self, key: str = None) -> KeyPool:
+        """Get the pool of pre-generated private keys.
+
+        Args:
+            key: Specification of the keys to draw, if not those of
+              key-pool-key. Only key-pool-key keys are generated in
+              advance.
+
+        Returns:
+            The pool, or None if key-pool-size is 0 or the
+            renewal-scheduler, the only renewer of certificates issued
+            with pooled keys, is disabled.
+
+        Raises:
+            ValueError: The key-pool-key value is not valid.
+        """
+        if self.model.config["key-pool-size"] <= 0 or not self.model.config["renewal-scheduler"]:
+            return None
+        return KeyPool(self._config_path("keys"), key or self.model.config["key-pool-key"])
+
+    def _key_spec(self, params: dict) -> Optional[str]:
+        """Find the key to request a certificate with.
+
+        Args:
+            params: Certificate parameters, any key-type, rsa-key-size
+              or elliptic-curve not given default to the configuration.
+
+        Returns:
+            The key specification, as for keypool.parse_spec, or None if
+            certbot's default key should be used.
+
+        Raises:
+            ValueError: The key parameters are not valid, or the
+              installed certbot cannot request a key type.
+        """
+        key_type = params.get("key-type", self.model.config["key-type"])
+        if not key_type:
+            return None
+        if key_type == "rsa":
+            param = params.get("rsa-key-size", self.model.config["rsa-key-size"])
+        else:
+            param = params.get("elliptic-curve", self.model.config["elliptic-curve"])
+        spec = "{}:{}".format(key_type, param)
+        keypool.parse_spec(spec)
+        if not self._certbot_supports(KEY_TYPE_VERSION):
+            raise ValueError("key-type requires certbot {} or later".format(
+                ".".join(str(n) for n in KEY_TYPE_VERSION)))
+        return spec
+
+    def _variants(self, spec: dict) -> List[dict]:
+        """Expand a certificate request into a request for each lineage.
+
+        With dual-issuance an ECDSA certificate is requested for the
+        lineage and an RSA certificate for a companion lineage, named
+        with "-rsa" appended.
+
+        Args:
+            spec: Certificate parameters, as for the get-certificate
+              action, including the domains.
+        """
+        if not self.model.config["dual-issuance"]:
+            return [spec]
+        name = spec.get("cert-name") or spec["domains"].split(",")[0]
+        return [dict(spec, **{"key-type": "ecdsa"}),
+                dict(spec, **{"key-type": "rsa", "cert-name": name + "-rsa"})]
+
+    def _refill_key_pool(self) -> None:
+        """Start filling the key pool in the background if it is short
+        of keys."""
+        try:
+            pool = self._key_pool()
+        except ValueError as err:
+            logger.error("invalid key-pool-key value: {}".format(err))
+            return
+        size = self.model.config["key-pool-size"]
+        if pool is None or pool.count() >= size:
+            return
+        _host.spawn([os.path.join(self.charm_dir, "bin/keypool.py"), self._config_path("keys"),
+                     pool.spec, str(size)], self._config_path("keypool.log"))
+
+    def _csr_request(self, pool: KeyPool, name: str, domains: str,
+                     tag: str) -> Tuple[str, List[str]]:
+        """Prepare a certbot --csr request using a key from the pool.
+
+        If the pool is empty a key is generated immediately.
+
+        Args:
+            pool: The key pool.
+            name: Name of the lineage the certificate is for.
+            domains: Comma separated list of domains the certificate is for.
+            tag: Distinguishes concurrent requests for the same lineage.
+
+        Returns:
+            The directory in which the request's files are written, and
+            the arguments to add to the certbot command.
+        """
+        key = pool.take()
+        if key is None:
+            logger.warning("key pool is empty, generating a %s key for %s", pool.spec, name)
+            key = keypool.generate_key(pool.spec, timeout=_host.timeouts.get("certbot"))
+        self._refill_key_pool()
+        work_dir = self._config_path(os.path.join("csr", "{}-{}".format(name, tag)))
+        return work_dir, keypool.prepare_request(work_dir, key, domains.split(","))
+
+    def _pool_marker(self, name: str) -> str:
+        """Calculate the location of the file marking a lineage as issued
+        for a key from the pool."""
+        return self._config_path(os.path.join("pooled", name))
+
+    def _update_artifact(self, filename: str, inputs: Any, write: Callable[[str], None],
+                         path: str = None) -> bool:
+        """Write a configuration file if its inputs have changed.
+
+        A fingerprint of the inputs of each file is kept in the charm's
+        state, the file is only written if the fingerprint differs from
+        that of the last write, or the file is missing.
+
+        Args:
+            filename: Name of the file, as for _config_path.
+            inputs: The JSON serializable values the file is made from.
+            write: Function writing the file to the given path.
+            path: Location of the file, if it is not in the charm's
+              configuration directory.
+
+        Returns:
+            True if the file was written.
+        """
+        path = path or self._config_path(filename)
+        fingerprint = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+        if self._stored.artifacts.get(filename) == fingerprint and _host.exists(path):
+            return False
+        write(path)
+        self._stored.artifacts[filename] = fingerprint
+        return True
 
     def _config_path(self, filename: str) -> str:
         """Calculate the location where the charm's configuration files
@@ -277,30 +2206,187 @@ class Host:
     of the charm. This class can be easily mocked for tests.
     """
 
+    # Default number of seconds each category of command may run for.
+    TIMEOUTS = {
+        "apt": 1800,
+        "certbot": 1800,
+        "deploy": 600,
+    }
+
     def __init__(self, *args):
         super().__init__(*args)
+        self.timeouts = dict(self.TIMEOUTS)
+        self._certbot_version = None
+
+    def certbot_version(self) -> Optional[Tuple[int, ...]]:
+        """Find the version of the installed certbot.
+
+        Returns:
+            The version numbers, or None if it cannot be determined.
+        """
+        if self._certbot_version is None:
+            try:
+                proc = self.run(["certbot", "--version"])
+            except (CommandError, subprocess.TimeoutExpired, OSError) as err:
+                logger.warning("cannot find certbot version: {}".format(err))
+                return None
+            # Older releases print the version to stderr.
+            match = re.search(r"certbot (\d+(?:\.\d+)*)", proc.stdout + proc.stderr)
+            if match is None:
+                logger.warning("cannot find certbot version in %r", proc.stdout + proc.stderr)
+                return None
+            self._certbot_version = tuple(int(n) for n in match.group(1).split("."))
+        return self._certbot_version
 
     def exists(self, path: str):
         """Wrapper for os.path.exists."""
         return os.path.exists(path)
 
-    def install_packages(self, packages: List[str]):
+    def has_account(self, config_dir: str) -> bool:
+        """Check whether a certbot configuration has an ACME account."""
+        for _, _, files in os.walk(os.path.join(config_dir, "accounts")):
+            if "regr.json" in files:
+                return True
+        return False
+
+    def install_packages(self, packages: List[str], debs: List[str] = None) -> str:
         """Install apt packages.
 
+        The packages are installed from the local debs, if any, and
+        otherwise, or if that leaves some missing, from the apt mirror.
+
         Args:
-            packages: List of packages to install.
+            packages: List of packages to install, as found by
+              missing_packages.
+            debs: Paths of local .deb files to install from.
+
+        Returns:
+            Where the packages came from: "installed" if there were
+            none to install, "local" or "apt".
         """
-        self.run(["apt-get", "update", "-q"])
+        missing = list(packages)
+        if not missing:
+            return "installed"
+        if debs:
+            try:
+                self.run(["apt-get", "install", "-q", "-y"] + debs)
+                missing = self.missing_packages(missing)
+            except (CommandError, subprocess.TimeoutExpired) as err:
+                logger.warning("cannot install local packages: {}".format(err))
+            if not missing:
+                return "local"
+        # apt commands commonly fail because of a held lock, or an
+        # unreachable mirror, so retry them.
+        self.run(["apt-get", "update", "-q"], retries=3)
         cmd = ["apt-get", "install", "-q", "-y"]
-        cmd.extend(packages)
-        self.run(cmd)
+        cmd.extend(missing)
+        self.run(cmd, retries=3)
+        return "apt"
+
+    def missing_packages(self, packages: List[str]) -> List[str]:
+        """Find the packages that dpkg does not report installed."""
+        proc = self.run(["dpkg-query", "-W", "-f=${Package} ${db:Status-Abbrev}\\n"] + packages,
+                        check=False)
+        installed = set()
+        for line in proc.stdout.splitlines():
+            name, _, status = line.partition(" ")
+            if status.startswith("ii"):
+                installed.add(name)
+        return [p for p in packages if p not in installed]
+
+    def run(self, cmd: List[str], env: Mapping[str, str] = None, check: bool = True,
+            timeout: float = None, retries: int = 0, backoff: float = 5.0,
+            category: str = None) -> subprocess.CompletedProcess:
+        """Run a command.
+
+        The output of the command is captured. Each attempt is logged
+        with its category, exit status and wall time.
+
+        Args:
+            cmd: The command to run.
+            env: Environment for the command.
+            check: Raise an error if the command exits with a non-zero
+              status.
+            timeout: Number of seconds after which the command is
+              killed. If this is not specified the timeout for the
+              command's category is used, if there is one.
+            retries: Number of times to retry a failed command.
+            backoff: Number of seconds to wait before the first retry,
+              the wait is doubled for every subsequent retry.
+            category: Category of the command, used to select the
+              timeout and for logging. If this is not specified it is
+              derived from the command.
+
+        Returns:
+            The completed process.
+
+        Raises:
+            CommandError: The command exited with a non-zero status and
+              check was set.
+            subprocess.TimeoutExpired: The command timed out.
+        """
+        category = category or command_category(cmd)
+        if timeout is None:
+            timeout = self.timeouts.get(category)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            start = time.monotonic()
+            try:
+                proc = subprocess.run(cmd, env=env, timeout=timeout, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE, universal_newlines=True)
+                err = None
+                if check and proc.returncode != 0:
+                    err = CommandError(proc.returncode, cmd, proc.stdout, proc.stderr)
+                status = proc.returncode
+            except subprocess.TimeoutExpired as exc:
+                err, status = exc, "timeout"
+            seconds = time.monotonic() - start
+            logger.log(logging.INFO if err is None else logging.WARNING,
+                       "command category=%s status=%s seconds=%.3f attempt=%d cmd=%s",
+                       category, status, seconds, attempt + 1, cmd[0],
+                       extra={"category": category, "status": status, "seconds": seconds,
+                              "attempt": attempt + 1, "cmd": cmd})
+            if err is None:
+                logger.debug("%s output:\n%s%s", cmd[0], proc.stdout, proc.stderr)
+                return proc
+            logger.debug("%s output:\n%s%s", cmd[0], err.stdout or "", err.stderr or "")
+        raise err
+
+    def spawn(self, cmd: List[str], log: str):
+        """Start a command that continues after the hook exits.
+
+        The command is started in its own session, with its output
+        appended to the log file.
+
+        Args:
+            cmd: The command to run.
+            log: Location of the log file.
+        """
+        os.makedirs(os.path.dirname(log), exist_ok=True)
+        with open(log, "ab") as f:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT,
+                             start_new_session=True)
+        logger.info("started %s", cmd[0])
 
-    def run(self, *args, **kwargs):
-        """Run a subcommand.
+    def set_timeouts(self, spec: str):
+        """Override the default command timeouts.
 
-        This is a wrapper for subprocess.run.
+        Args:
+            spec: Comma separated list of category=seconds pairs.
+              Invalid entries are logged and ignored.
         """
-        subprocess.run(*args, **kwargs)
+        self.timeouts = dict(self.TIMEOUTS)
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            category, _, seconds = item.partition("=")
+            try:
+                seconds = float(seconds)
+            except ValueError:
+                logger.warning("invalid command timeout %r", item)
+                continue
+            self.timeouts[category.strip()] = seconds if seconds > 0 else None
 
     def symlink(self, src: str, dst: str):
         """Create, or update a symbolic link.
@@ -339,8 +2425,9 @@ class Host:
         """Write configuration to file.
 
         Load the configuration file from the given path, if it exists.
-        Update the configuration with the given config. Then write the
-        configuration back to the given path.
+        Update the configuration with the given config. Then replace the
+        file atomically, so that the deploy hook never reads a partially
+        written configuration.
 
         Args:
             path: Location of the config file.
@@ -355,23 +2442,34 @@ class Host:
             for key, value in values.items():
                 cp[section][key] = value
 
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w") as f:
-            cp.write(f)
-        os.chmod(path, mode)
+        content = io.StringIO()
+        cp.write(content)
+        state.write_atomic(path, content.getvalue().encode("utf-8"), mode)
 
     def write_file(self, path: str, content: bytes, mode: int = 0o600):
         """Write a binary file.
 
+        The file is replaced atomically, so concurrent readers never
+        see a partially written file.
+
         Args:
             path: Location of the config file.
             content: The bytes to write to the file.
             mode: Permissions to apply to the after writing it.
         """
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(content)
-        os.chmod(path, mode)
+        state.write_atomic(path, content, mode)
+
+
+def command_category(cmd: List[str]) -> str:
+    """Derive the category of a command from its executable."""
+    name = os.path.basename(cmd[0])
+    if name.startswith("apt"):
+        return "apt"
+    if name in ("certbot", "propagation.py", "certbot_worker.py"):
+        return "certbot"
+    if name in ("certbot-charm", "deploy.py"):
+        return "deploy"
+    return name
 
 
 _host = Host()
@@ -0,0 +1,447 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A minimal DNS client.
+
+This implements just enough of the DNS protocol for the charm to find
+the authoritative servers for a zone and query them directly, and to
+send TSIG signed updates. It only
+depends on the standard library so that it can be used both by the
+charm and by scripts running alongside certbot.
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import random
+import socket
+import struct
+import time
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Record types.
+A = 1
+NS = 2
+CNAME = 5
+SOA = 6
+TXT = 16
+TSIG = 250
+
+# Classes.
+IN = 1
+NONE = 254
+ANY = 255
+
+# Opcodes, in header flag position.
+UPDATE = 5 << 11
+
+# Header flags.
+QR = 0x8000
+AA = 0x0400
+TC = 0x0200
+RD = 0x0100
+RA = 0x0080
+
+# Response codes.
+NOERROR = 0
+NXDOMAIN = 3
+REFUSED = 5
+NOTAUTH = 9
+
+# TSIG algorithm names, and their digests.
+TSIG_ALGORITHMS = {
+    "hmac-md5": ("hmac-md5.sig-alg.reg.int", hashlib.md5),
+    "hmac-sha1": ("hmac-sha1", hashlib.sha1),
+    "hmac-sha224": ("hmac-sha224", hashlib.sha224),
+    "hmac-sha256": ("hmac-sha256", hashlib.sha256),
+    "hmac-sha384": ("hmac-sha384", hashlib.sha384),
+    "hmac-sha512": ("hmac-sha512", hashlib.sha512),
+}
+
+
+class DNSError(Exception):
+    """Raised when a DNS exchange fails."""
+    pass
+
+
+class Record:
+    """A DNS resource record.
+
+    The format of data depends on the record type: a dotted-quad string
+    for A records, a domain name for NS and CNAME records, a string for
+    TXT records, a tuple of (mname, rname, serial, refresh, retry,
+    expire, minimum) for SOA records and raw bytes for anything else.
+    """
+
+    def __init__(self, name: str, rtype: int, data, ttl: int = 0, rclass: int = IN):
+        self.name = name
+        self.type = rtype
+        self.data = data
+        self.ttl = ttl
+        self.rclass = rclass
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self._key() == other._key()
+
+    def _key(self):
+        return (self.name.lower(), self.type, self.data, self.ttl, self.rclass)
+
+    def __repr__(self):
+        return "Record({!r}, {!r}, {!r}, ttl={!r}, rclass={!r})".format(
+            self.name, self.type, self.data, self.ttl, self.rclass)
+
+
+class Message:
+    """A DNS message.
+
+    Args:
+        id: Message ID.
+        flags: Header flags, including the opcode and rcode.
+        question: List of (name, type, class) tuples.
+        answer: List of answer section records.
+        authority: List of authority section records.
+        additional: List of additional section records.
+    """
+
+    def __init__(self, id: int = 0, flags: int = 0,
+                 question: List[Tuple[str, int, int]] = None,
+                 answer: List[Record] = None, authority: List[Record] = None,
+                 additional: List[Record] = None):
+        self.id = id
+        self.flags = flags
+        self.question = question or []
+        self.answer = answer or []
+        self.authority = authority or []
+        self.additional = additional or []
+
+    @property
+    def rcode(self) -> int:
+        return self.flags & 0xf
+
+    def to_wire(self) -> bytes:
+        """Encode the message in DNS wire format."""
+        out = struct.pack("!HHHHHH", self.id, self.flags, len(self.question),
+                          len(self.answer), len(self.authority), len(self.additional))
+        for name, rtype, rclass in self.question:
+            out += encode_name(name) + struct.pack("!HH", rtype, rclass)
+        for rr in self.answer + self.authority + self.additional:
+            rdata = _encode_rdata(rr)
+            out += encode_name(rr.name)
+            out += struct.pack("!HHIH", rr.type, rr.rclass, rr.ttl, len(rdata)) + rdata
+        return out
+
+    @classmethod
+    def from_wire(cls, data: bytes) -> "Message":
+        """Decode a message in DNS wire format."""
+        try:
+            id, flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHHH", data)
+            offset = 12
+            question = []
+            for _ in range(qdcount):
+                name, offset = decode_name(data, offset)
+                rtype, rclass = struct.unpack_from("!HH", data, offset)
+                offset += 4
+                question.append((name, rtype, rclass))
+            sections = []
+            for count in (ancount, nscount, arcount):
+                records = []
+                for _ in range(count):
+                    rr, offset = _decode_record(data, offset)
+                    records.append(rr)
+                sections.append(records)
+        except (struct.error, IndexError, UnicodeDecodeError) as err:
+            raise DNSError("malformed message: {}".format(err))
+        return cls(id, flags, question, *sections)
+
+
+class TSIGKey:
+    """A TSIG key used to sign messages (RFC 8945).
+
+    Args:
+        name: Name of the key.
+        secret: Base64 encoded key secret.
+        algorithm: Name of the HMAC algorithm, one of TSIG_ALGORITHMS.
+
+    Raises:
+        DNSError: The secret or algorithm is not valid.
+    """
+
+    def __init__(self, name: str, secret: str, algorithm: str = "hmac-md5"):
+        algorithm = algorithm.lower().rstrip(".")
+        for short, (long, _) in TSIG_ALGORITHMS.items():
+            if algorithm == long:
+                algorithm = short
+        if algorithm not in TSIG_ALGORITHMS:
+            raise DNSError("unsupported TSIG algorithm {}".format(algorithm))
+        try:
+            self.secret = base64.b64decode(secret, validate=True)
+        except ValueError as err:
+            raise DNSError("invalid TSIG secret: {}".format(err))
+        self.name = name
+        self.algorithm = algorithm
+
+    def sign(self, message: Message, now: int = None, fudge: int = 300) -> bytes:
+        """Sign a message.
+
+        Returns:
+            The message, with its TSIG record, in DNS wire format.
+        """
+        algorithm, digest = TSIG_ALGORITHMS[self.algorithm]
+        now = int(time.time()) if now is None else now
+        timers = struct.pack("!HIH", now >> 32, now & 0xffffffff, fudge)
+        variables = b"".join([
+            encode_name(self.name.lower()), struct.pack("!HI", ANY, 0),
+            encode_name(algorithm), timers, struct.pack("!HH", 0, 0)])
+        mac = hmac.new(self.secret, message.to_wire() + variables, digest).digest()
+        rdata = b"".join([encode_name(algorithm), timers, struct.pack("!H", len(mac)), mac,
+                          struct.pack("!HHH", message.id, 0, 0)])
+        signed = Message(message.id, message.flags, message.question, message.answer,
+                         message.authority,
+                         message.additional + [Record(self.name, TSIG, rdata, 0, ANY)])
+        return signed.to_wire()
+
+
+def encode_name(name: str) -> bytes:
+    """Encode a domain name in DNS wire format, without compression."""
+    out = b""
+    for label in name.rstrip(".").split("."):
+        if label:
+            raw = label.encode("ascii")
+            if len(raw) > 63:
+                raise DNSError("label too long: {}".format(label))
+            out += bytes([len(raw)]) + raw
+    return out + b"\0"
+
+
+def decode_name(data: bytes, offset: int) -> Tuple[str, int]:
+    """Decode a, possibly compressed, domain name.
+
+    Returns:
+        The name and the offset of the first byte following it.
+    """
+    labels = []
+    end = None
+    seen = set()
+    while True:
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3fff
+            if offset in seen:
+                raise DNSError("compression loop")
+            seen.add(offset)
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode("ascii"))
+        offset += length
+    return ".".join(labels), end if end is not None else offset
+
+
+def _encode_rdata(rr: Record) -> bytes:
+    if rr.data is None:
+        return b""
+    if rr.type == A:
+        return socket.inet_aton(rr.data)
+    if rr.type in (NS, CNAME):
+        return encode_name(rr.data)
+    if rr.type == TXT:
+        raw = rr.data.encode("utf-8")
+        chunks = [raw[i:i + 255] for i in range(0, len(raw), 255)] or [b""]
+        return b"".join(bytes([len(c)]) + c for c in chunks)
+    if rr.type == SOA:
+        return b"".join([encode_name(rr.data[0]), encode_name(rr.data[1]),
+                         struct.pack("!IIIII", *rr.data[2:])])
+    return rr.data
+
+
+def _decode_record(data: bytes, offset: int) -> Tuple[Record, int]:
+    name, offset = decode_name(data, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+    offset += 10
+    end = offset + rdlength
+    if end > len(data):
+        raise DNSError("truncated record")
+    if rdlength == 0:
+        rdata = None
+    elif rtype == A:
+        rdata = socket.inet_ntoa(data[offset:end])
+    elif rtype in (NS, CNAME):
+        rdata = decode_name(data, offset)[0]
+    elif rtype == TXT:
+        parts = []
+        i = offset
+        while i < end:
+            parts.append(data[i + 1:i + 1 + data[i]])
+            i += 1 + data[i]
+        rdata = b"".join(parts).decode("utf-8", "replace")
+    elif rtype == SOA:
+        mname, i = decode_name(data, offset)
+        rname, i = decode_name(data, i)
+        rdata = (mname, rname) + struct.unpack_from("!IIIII", data, i)
+    else:
+        rdata = data[offset:end]
+    return Record(name, rtype, rdata, ttl, rclass), end
+
+
+def exchange(message: Message, server: str, port: int = 53, timeout: float = 2.0,
+             key: TSIGKey = None) -> Message:
+    """Send a message to a server and wait for the response.
+
+    The message is sent over UDP, if the response is truncated then
+    the message is resent over TCP. If a key is given the message is
+    signed with it, the signature of the response is not checked.
+
+    Raises:
+        DNSError: No valid response was received.
+    """
+    wire = key.sign(message) if key else message.to_wire()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(wire, (server, port))
+            while True:
+                data, _ = sock.recvfrom(65535)
+                response = Message.from_wire(data)
+                if response.id == message.id:
+                    break
+        if response.flags & TC:
+            with socket.create_connection((server, port), timeout=timeout) as sock:
+                sock.sendall(struct.pack("!H", len(wire)) + wire)
+                length = struct.unpack("!H", _recv_exactly(sock, 2))[0]
+                response = Message.from_wire(_recv_exactly(sock, length))
+    except OSError as err:
+        raise DNSError("cannot query {}:{}: {}".format(server, port, err))
+    return response
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise DNSError("connection closed")
+        data += chunk
+    return data
+
+
+def query(name: str, rtype: int, server: str, port: int = 53, timeout: float = 2.0,
+          recursion: bool = True) -> Message:
+    """Query a server for records.
+
+    Args:
+        name: Domain name to query.
+        rtype: Record type to query.
+        server: IP address of the server to query.
+        port: Port of the server to query.
+        timeout: Number of seconds to wait for a response.
+        recursion: Whether to request recursion.
+    """
+    message = Message(random.getrandbits(16), RD if recursion else 0, [(name, rtype, IN)])
+    return exchange(message, server, port, timeout)
+
+
+def resolvers(path: str = "/etc/resolv.conf") -> List[str]:
+    """List the nameservers configured in resolv.conf."""
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    servers.append(fields[1])
+    except FileNotFoundError:
+        pass
+    return servers
+
+
+def find_zone(name: str, resolver: str, port: int = 53, timeout: float = 2.0) -> str:
+    """Find the zone containing a name.
+
+    Raises:
+        DNSError: The zone could not be found.
+    """
+    response = query(name, SOA, resolver, port, timeout)
+    for rr in response.answer + response.authority:
+        if rr.type == SOA:
+            return rr.name
+    raise DNSError("cannot find zone for {}".format(name))
+
+
+def authoritative_servers(name: str, resolver: str, port: int = 53) -> List[str]:
+    """Find the addresses of the authoritative servers for a name.
+
+    Args:
+        name: Domain name to find the authoritative servers for.
+        resolver: Recursive resolver used to look up the zone.
+        port: DNS port used by all servers.
+
+    Raises:
+        DNSError: The servers could not be found.
+    """
+    zone = find_zone(name, resolver, port)
+    hosts = [rr.data for rr in query(zone, NS, resolver, port).answer if rr.type == NS]
+    addresses = []
+    for host in hosts:
+        addresses.extend(rr.data for rr in query(host, A, resolver, port).answer if rr.type == A)
+    if not addresses:
+        raise DNSError("cannot find nameservers for {}".format(zone))
+    return sorted(set(addresses))
+
+
+def wait_for_txt(records: Iterable[Tuple[str, str]], timeout: float,
+                 resolver: Optional[str] = None, port: int = 53,
+                 interval: float = 2.0) -> bool:
+    """Wait for TXT records to be published.
+
+    Poll every authoritative server of the zones containing the given
+    records until they all serve the expected values, or until the
+    timeout expires.
+
+    Args:
+        records: (name, value) pairs of the expected TXT records.
+        timeout: Maximum number of seconds to wait.
+        resolver: Recursive resolver used to find the authoritative
+          servers. If this is not specified the first nameserver in
+          /etc/resolv.conf will be used.
+        port: DNS port used by all servers.
+        interval: Number of seconds to wait between polls.
+
+    Returns:
+        True if all the records were found before the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    pending = set()
+    try:
+        resolver = resolver or resolvers()[0]
+        for name, value in records:
+            for server in authoritative_servers(name, resolver, port):
+                pending.add((name, value, server))
+    except (DNSError, IndexError) as err:
+        logger.warning("cannot poll for DNS propagation, waiting %.0fs: %s", timeout, err)
+        time.sleep(max(0, deadline - time.monotonic()))
+        return False
+
+    while True:
+        for name, value, server in sorted(pending):
+            try:
+                response = query(name, TXT, server, port, recursion=False)
+            except DNSError as err:
+                logger.debug("%s", err)
+                continue
+            if any(rr.type == TXT and rr.data == value for rr in response.answer):
+                pending.discard((name, value, server))
+        remaining = deadline - time.monotonic()
+        if not pending:
+            logger.info("DNS records propagated with %.1fs to spare", remaining)
+            return True
+        if remaining <= 0:
+            logger.warning("DNS records not propagated to %s",
+                           ", ".join(sorted({p[2] for p in pending})))
+            return False
+        time.sleep(min(interval, remaining))
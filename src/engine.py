@@ -0,0 +1,125 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Client for the long-lived certbot worker in bin/certbot_worker.py."""
+
+import json
+import subprocess
+import threading
+from typing import List, Mapping, Optional
+
+
+class WorkerError(Exception):
+    """Raised when a request to the certbot worker fails."""
+    pass
+
+
+class CertbotWorker:
+    """A certbot worker process.
+
+    The worker is started when the first request is made. It exits when
+    its stdin is closed, either by close or by this process exiting. A
+    worker that does not answer a request within the timeout of the
+    request's command category is killed, and a new one is started for
+    the next request.
+
+    Args:
+        cmd: Command to start the worker.
+        timeouts: Number of seconds "certbot" and "deploy" requests may
+          take, no timeout if a category is missing or None.
+    """
+
+    def __init__(self, cmd: List[str], timeouts: Mapping[str, Optional[float]] = None):
+        self._cmd = cmd
+        self._timeouts = timeouts or {}
+        self._proc = None
+
+    def certbot(self, args: List[str], env: Mapping[str, str] = None) -> dict:
+        """Run certbot with the given arguments.
+
+        Args:
+            args: Arguments to pass to certbot.
+            env: Environment variables to set for this run only.
+        """
+        request = {"certbot": args}
+        if env:
+            request["env"] = dict(env)
+        return self.request(request, self._timeouts.get("certbot"))
+
+    def deploy(self, lineage: str, flush: bool = False) -> dict:
+        """Run the deploy hook for a lineage.
+
+        Args:
+            lineage: Path of the lineage to deploy.
+            flush: Also run the deploy command for any coalesced
+              deployments.
+        """
+        return self.request({"deploy": lineage, "flush": flush}, self._timeouts.get("deploy"))
+
+    def flush(self) -> dict:
+        """Run the deploy command for any coalesced deployments."""
+        return self.request({"flush": True}, self._timeouts.get("deploy"))
+
+    def request(self, request: dict, timeout: float = None) -> dict:
+        """Send a request to the worker and wait for the response.
+
+        Args:
+            request: The request.
+            timeout: Number of seconds to wait for the response.
+
+        Raises:
+            WorkerError: The request failed, or the worker exited.
+            subprocess.TimeoutExpired: The worker did not respond in
+              time, and has been killed.
+        """
+        if self._proc is None:
+            self._proc = subprocess.Popen(self._cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            self._proc.stdin.write(json.dumps(request) + "\n")
+            self._proc.stdin.flush()
+            line = self._readline(timeout)
+        except BrokenPipeError:
+            line = ""
+        if not line:
+            self.close()
+            raise WorkerError("certbot worker exited")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise WorkerError(response.get("error", "unknown error"))
+        return response
+
+    def _readline(self, timeout: Optional[float]) -> str:
+        """Read a line from the worker, killing it if that takes too long."""
+        lines = []
+        reader = threading.Thread(target=lambda: lines.append(self._proc.stdout.readline()),
+                                  daemon=True)
+        reader.start()
+        reader.join(timeout)
+        if reader.is_alive():
+            proc, self._proc = self._proc, None
+            proc.kill()
+            proc.wait()
+            # The reader sees the end of the output once the worker is
+            # gone.
+            reader.join()
+            proc.stdin.close()
+            proc.stdout.close()
+            raise subprocess.TimeoutExpired(self._cmd, timeout)
+        return lines[0]
+
+    def close(self):
+        """Stop the worker."""
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
@@ -0,0 +1,51 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Consistent hashing of lineages onto units.
+
+Every unit is placed on a ring at a number of pseudo-random points and
+each key belongs to the unit at the first point following the key's own
+hash. Adding or removing one of N units only moves about 1/N of the
+keys. Units only need to agree on the set of unit names to agree on the
+owner of every key.
+"""
+
+import bisect
+import hashlib
+from typing import Iterable, List
+
+
+class HashRing:
+    """A consistent hash ring.
+
+    Args:
+        nodes: Names of the nodes on the ring.
+        vnodes: Number of points each node is placed at, more points
+          spread the keys more evenly.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 100):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash("{}#{}".format(node, i)), node)
+                        for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        """Find the node that owns a key.
+
+        Raises:
+            ValueError: The ring has no nodes.
+        """
+        if not self._owners:
+            raise ValueError("no nodes on the ring")
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._owners)
+        return self._owners[i]
+
+    def owned(self, node: str, keys: Iterable[str]) -> List[str]:
+        """Select the keys owned by a node."""
+        return [key for key in keys if self.owner(key) == node]
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "big")
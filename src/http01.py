@@ -0,0 +1,113 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A minimal HTTP server for ACME http-01 challenges.
+
+certbot's webroot plugin writes the response to each challenge to
+<webroot>/.well-known/acme-challenge/<token>. This server answers
+requests for those paths, and nothing else, so that certificates can be
+validated on hosts without a web server, or behind one that proxies the
+challenge path to it.
+"""
+
+import asyncio
+import os
+import re
+from typing import Tuple
+
+CHALLENGE_PATH = "/.well-known/acme-challenge/"
+
+# ACME tokens are base64url encoded.
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# Maximum number of request headers read before giving up.
+_MAX_HEADERS = 100
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class Responder:
+    """Serves the challenge responses in a webroot.
+
+    Args:
+        webroot: The directory certbot's webroot plugin writes to.
+        timeout: Number of seconds a client has to send its request.
+    """
+
+    def __init__(self, webroot: str, timeout: float = 10.0):
+        self.webroot = webroot
+        self.timeout = timeout
+
+    def respond(self, method: str, target: str) -> Tuple[int, bytes]:
+        """Find the response to a request.
+
+        Returns:
+            The HTTP status and body.
+        """
+        if method not in ("GET", "HEAD"):
+            return 405, b""
+        path = target.split("?", 1)[0]
+        if not path.startswith(CHALLENGE_PATH):
+            return 404, b""
+        token = path[len(CHALLENGE_PATH):]
+        if not _TOKEN_RE.match(token):
+            return 404, b""
+        try:
+            with open(os.path.join(self.webroot, CHALLENGE_PATH.strip("/"), token), "rb") as f:
+                return 200, f.read()
+        except OSError:
+            return 404, b""
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer a single request on a connection."""
+        try:
+            try:
+                method, target = await asyncio.wait_for(self._read_request(reader),
+                                                        self.timeout)
+                status, body = self.respond(method, target)
+            except ValueError:
+                method, status, body = "GET", 400, b""
+            writer.write("HTTP/1.1 {} {}\r\n".format(status, _REASONS[status]).encode("ascii"))
+            writer.write(b"Content-Type: text/plain\r\n")
+            writer.write("Content-Length: {}\r\n".format(len(body)).encode("ascii"))
+            writer.write(b"Connection: close\r\n\r\n")
+            if method != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str]:
+        """Read a request line and headers.
+
+        Returns:
+            The method and request target.
+
+        Raises:
+            ValueError: The request is not valid HTTP.
+        """
+        line = await reader.readline()
+        try:
+            method, target, version = line.decode("ascii").split()
+        except (UnicodeDecodeError, ValueError):
+            raise ValueError("invalid request line")
+        if not version.startswith("HTTP/"):
+            raise ValueError("invalid request line")
+        for _ in range(_MAX_HEADERS):
+            if (await reader.readline()).strip() == b"":
+                return method, target
+        raise ValueError("too many headers")
+
+    async def start(self, host: str = None, port: int = 80) -> asyncio.AbstractServer:
+        """Start serving on the port, on every address if host is None."""
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def run(webroot: str, port: int, host: str = None) -> None:
+    """Serve the challenges in webroot until the process is stopped."""
+    # asyncio.run and Server.serve_forever need Python 3.7.
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Responder(webroot).start(host, port))
+    loop.run_forever()
@@ -0,0 +1,241 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A pool of pre-generated private keys.
+
+Generating an RSA key takes from hundreds of milliseconds to seconds of
+CPU, which certbot would otherwise spend while a certificate request is
+waiting. Keys are generated in advance, by bin/keypool.py outside of
+the hooks, and a certificate is requested with a CSR for a key drawn
+from the pool.
+
+Keys and CSRs are made with the openssl command, as no cryptography
+library is available in the charm's environment.
+"""
+
+import os
+import shutil
+import subprocess
+import uuid
+from typing import List, Optional, Tuple
+
+from lineage import install_version
+
+# Elliptic curves certbot supports, and their openssl names.
+CURVES = {
+    "secp256r1": "prime256v1",
+    "secp384r1": "secp384r1",
+    "secp521r1": "secp521r1",
+}
+
+# Files written by certbot --csr, named after the lineage files they become.
+CERTBOT_FILES = ("cert", "chain", "fullchain")
+
+
+def parse_spec(spec: str) -> Tuple[str, str]:
+    """Parse a key specification.
+
+    Args:
+        spec: Either "rsa:BITS" or "ecdsa:CURVE".
+
+    Returns:
+        The key type and its size or curve.
+
+    Raises:
+        ValueError: The specification is not valid.
+    """
+    kind, _, param = spec.strip().lower().partition(":")
+    if kind == "rsa":
+        if not param.isdigit() or int(param) < 2048:
+            raise ValueError("invalid RSA key size {!r}".format(param))
+    elif kind == "ecdsa":
+        if param not in CURVES:
+            raise ValueError("unsupported elliptic curve {!r}".format(param))
+    else:
+        raise ValueError("invalid key type {!r}".format(kind))
+    return kind, param
+
+
+def certbot_args(spec: str) -> List[str]:
+    """Calculate the certbot arguments to request a key.
+
+    Args:
+        spec: Key specification, as for parse_spec.
+    """
+    kind, param = parse_spec(spec)
+    if kind == "rsa":
+        return ["--key-type=rsa", "--rsa-key-size={}".format(param)]
+    return ["--key-type=ecdsa", "--elliptic-curve={}".format(param)]
+
+
+def generate_key(spec: str, timeout: float = None) -> bytes:
+    """Generate a private key.
+
+    Args:
+        spec: Key specification, as for parse_spec.
+        timeout: Number of seconds after which openssl is killed.
+
+    Returns:
+        The key, PEM encoded.
+    """
+    kind, param = parse_spec(spec)
+    if kind == "rsa":
+        opts = ["-algorithm", "RSA", "-pkeyopt", "rsa_keygen_bits:" + param]
+    else:
+        opts = ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:" + CURVES[param],
+                "-pkeyopt", "ec_param_enc:named_curve"]
+    proc = subprocess.run(["openssl", "genpkey"] + opts, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, timeout=timeout, check=True)
+    return proc.stdout
+
+
+def make_csr(key_path: str, domains: List[str], timeout: float = None) -> bytes:
+    """Make a certificate signing request.
+
+    The names are requested as subject alternative names, the first is
+    also the common name if it fits.
+
+    Args:
+        key_path: Location of the private key.
+        domains: The names on the certificate.
+        timeout: Number of seconds after which openssl is killed.
+
+    Returns:
+        The CSR, PEM encoded.
+    """
+    subject = "/CN={}".format(domains[0]) if len(domains[0]) <= 64 else "/"
+    san = "subjectAltName=" + ",".join("DNS:" + d for d in domains)
+    proc = subprocess.run(["openssl", "req", "-new", "-key", key_path, "-subj", subject,
+                           "-addext", san], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          timeout=timeout, check=True)
+    return proc.stdout
+
+
+class KeyPool:
+    """A directory of pre-generated private keys.
+
+    Keys of each specification are kept in their own subdirectory, so
+    changing the specification never hands out a key of the old one.
+
+    Args:
+        path: Base directory of the pool.
+        spec: Specification of the keys, as for parse_spec.
+    """
+
+    def __init__(self, path: str, spec: str):
+        kind, param = parse_spec(spec)
+        self.spec = "{}:{}".format(kind, param)
+        self.path = os.path.join(path, "{}-{}".format(kind, param))
+
+    def count(self) -> int:
+        """Count the keys in the pool."""
+        try:
+            return len([name for name in os.listdir(self.path) if name.endswith(".pem")])
+        except FileNotFoundError:
+            return 0
+
+    def add(self, key: bytes) -> None:
+        """Add a key to the pool.
+
+        The key is written under a temporary name and renamed into
+        place, so a partially written key is never taken.
+        """
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        name = uuid.uuid4().hex
+        tmp = os.path.join(self.path, name + ".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, os.path.join(self.path, name + ".pem"))
+
+    def take(self) -> Optional[bytes]:
+        """Remove a key from the pool.
+
+        Keys are claimed by renaming them, so concurrent callers, in
+        this or another process, never get the same key.
+
+        Returns:
+            The key, or None if the pool is empty.
+        """
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith(".pem"))
+        except FileNotFoundError:
+            return None
+        for name in names:
+            claimed = os.path.join(self.path, "{}.{}.taken".format(name, uuid.uuid4().hex))
+            try:
+                os.rename(os.path.join(self.path, name), claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed, "rb") as f:
+                key = f.read()
+            os.unlink(claimed)
+            return key
+        return None
+
+    def fill(self, size: int, generate=generate_key) -> int:
+        """Generate keys until the pool holds size keys.
+
+        Args:
+            size: Number of keys the pool should hold.
+            generate: Function to generate a key from its specification.
+
+        Returns:
+            The number of keys added.
+        """
+        added = 0
+        while self.count() < size:
+            self.add(generate(self.spec))
+            added += 1
+        return added
+
+
+def install_issued(work_dir: str, config_dir: str, name: str) -> bool:
+    """Install a certificate issued for a CSR as a new lineage version.
+
+    Args:
+        work_dir: Directory containing privkey.pem and the cert.pem,
+          chain.pem and fullchain.pem files written by certbot.
+        config_dir: certbot configuration directory to install into.
+        name: Name of the lineage.
+
+    Returns:
+        True if a new version was installed.
+    """
+    files = {}
+    for kind in CERTBOT_FILES + ("privkey",):
+        with open(os.path.join(work_dir, kind + ".pem"), "rb") as f:
+            files[kind] = f.read()
+    return install_version(config_dir, name, files)
+
+
+def prepare_request(work_dir: str, key: bytes, domains: List[str]) -> List[str]:
+    """Prepare the files for a certbot --csr request.
+
+    Any previous request in the directory is removed, as certbot will
+    not overwrite an existing certificate file.
+
+    Args:
+        work_dir: Directory in which to write the key and CSR, certbot
+          writes the certificate files here too.
+        key: The private key, PEM encoded.
+        domains: The names on the certificate.
+
+    Returns:
+        The arguments to add to the certbot certonly command.
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir, mode=0o700)
+    key_path = os.path.join(work_dir, "privkey.pem")
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    csr_path = os.path.join(work_dir, "csr.pem")
+    with open(csr_path, "wb") as f:
+        f.write(make_csr(key_path, domains))
+    args = ["--csr={}".format(csr_path)]
+    for kind in CERTBOT_FILES:
+        args.append("--{}-path={}".format(kind, os.path.join(work_dir, kind + ".pem")))
+    return args
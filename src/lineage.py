@@ -0,0 +1,216 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Helpers for manipulating certbot lineages on disk.
+
+Certbot holds a lock on its configuration, work and log directories
+for the duration of a run, so concurrent runs have to use their own
+isolated directories. The functions in this module move lineages
+between such a configuration directory and the live tree.
+"""
+
+import os
+import re
+import shutil
+from typing import Dict, List, Mapping
+
+LINEAGE_FILES = ("cert", "chain", "fullchain", "privkey")
+
+_VERSION_RE = re.compile(r"^cert(\d+)\.pem$")
+
+
+class IsolatedDirs:
+    """A set of private certbot directories.
+
+    Args:
+        path: Base directory, the config, work and logs directories
+          will be created under this path.
+    """
+
+    def __init__(self, path: str):
+        self.config_dir = os.path.join(path, "config")
+        self.work_dir = os.path.join(path, "work")
+        self.logs_dir = os.path.join(path, "logs")
+
+    def args(self) -> List[str]:
+        """Calculate the certbot arguments to use these directories."""
+        return [
+            "--config-dir={}".format(self.config_dir),
+            "--work-dir={}".format(self.work_dir),
+            "--logs-dir={}".format(self.logs_dir),
+        ]
+
+    def prepare(self, live_config_dir: str, name: str):
+        """Prepare the directories for a certbot run.
+
+        Create the directories, remove any stale copy of the named
+        lineage and copy the ACME accounts from the live configuration
+        so that no new accounts get registered.
+
+        Args:
+            live_config_dir: The main certbot configuration directory.
+            name: Name of the lineage that will be acquired.
+        """
+        for path in (self.config_dir, self.work_dir, self.logs_dir):
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        remove_lineage(self.config_dir, name)
+        copy_missing(os.path.join(live_config_dir, "accounts"),
+                     os.path.join(self.config_dir, "accounts"))
+
+
+def copy_missing(src: str, dst: str):
+    """Copy any files in the src tree that don't exist in the dst tree.
+
+    It is not an error if src does not exist.
+    """
+    for root, _, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(target, mode=0o700, exist_ok=True)
+        for f in files:
+            if not os.path.exists(os.path.join(target, f)):
+                shutil.copy2(os.path.join(root, f), os.path.join(target, f))
+
+
+def current_files(config_dir: str, name: str) -> Dict[str, bytes]:
+    """Read the current version of a lineage.
+
+    Args:
+        config_dir: certbot configuration directory containing the
+          lineage.
+        name: Name of the lineage.
+
+    Returns:
+        The contents of each of the lineage's files, keyed by kind.
+    """
+    live = os.path.join(config_dir, "live", name)
+    files = {}
+    for kind in LINEAGE_FILES:
+        with open(os.path.join(live, kind + ".pem"), "rb") as f:
+            files[kind] = f.read()
+    return files
+
+
+def latest_version(config_dir: str, name: str) -> int:
+    """Find the most recent version number in a lineage's archive.
+
+    Returns:
+        The version number, or 0 if there are no versions.
+    """
+    try:
+        names = os.listdir(os.path.join(config_dir, "archive", name))
+    except FileNotFoundError:
+        return 0
+    versions = [int(m.group(1)) for m in map(_VERSION_RE.match, names) if m]
+    return max(versions, default=0)
+
+
+def install_version(config_dir: str, name: str, files: Mapping[str, bytes]) -> bool:
+    """Install a new version of a lineage.
+
+    The files are written to the lineage's archive directory with the
+    next version number, and the live symbolic links are updated to
+    point at them. Nothing is written if the files are identical to the
+    current version.
+
+    Args:
+        config_dir: certbot configuration directory to install into.
+        name: Name of the lineage.
+        files: Contents of each of the lineage's files, keyed by kind.
+
+    Returns:
+        True if a new version was installed.
+    """
+    try:
+        if current_files(config_dir, name) == dict(files):
+            return False
+    except FileNotFoundError:
+        pass
+
+    archive = os.path.join(config_dir, "archive", name)
+    live = os.path.join(config_dir, "live", name)
+    os.makedirs(archive, mode=0o700, exist_ok=True)
+    os.makedirs(live, mode=0o755, exist_ok=True)
+    version = latest_version(config_dir, name) + 1
+    for kind in LINEAGE_FILES:
+        filename = "{}{}.pem".format(kind, version)
+        path = os.path.join(archive, filename)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600 if kind == "privkey" else 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(files[kind])
+        _relink(os.path.join("..", "..", "archive", name, filename),
+                os.path.join(live, kind + ".pem"))
+    return True
+
+
+def merge_lineage(src: str, dst: str, name: str) -> bool:
+    """Merge the current version of a lineage into another configuration.
+
+    The current certificate and key of the lineage in the src
+    configuration directory are installed as a new version in the dst
+    configuration directory. The lineage's renewal configuration is
+    copied with any paths rewritten to refer to dst, along with the ACME
+    account it refers to if dst does not have it, as happens when a run
+    in an isolated directory registered a new account.
+
+    Args:
+        src: certbot configuration directory to merge from.
+        dst: certbot configuration directory to merge into.
+        name: Name of the lineage.
+
+    Returns:
+        True if a new version was installed in dst.
+    """
+    changed = install_version(dst, name, current_files(src, name))
+    conf = os.path.join(src, "renewal", name + ".conf")
+    if os.path.exists(conf):
+        with open(conf) as f:
+            lines = f.readlines()
+        # The work and logs directories are specific to the source
+        # configuration, let the destination use its defaults.
+        lines = [line.replace(src, dst) for line in lines
+                 if line.split("=")[0].strip() not in ("work_dir", "logs_dir")]
+        os.makedirs(os.path.join(dst, "renewal"), mode=0o755, exist_ok=True)
+        with open(os.path.join(dst, "renewal", name + ".conf"), "w") as f:
+            f.writelines(lines)
+        for line in lines:
+            key, _, value = line.partition("=")
+            if key.strip() == "account":
+                copy_account(src, dst, value.strip())
+    return changed
+
+
+def copy_account(src: str, dst: str, account_id: str):
+    """Copy an ACME account into another configuration directory.
+
+    Accounts are stored under accounts/<server>/directory/<account_id>,
+    the account is copied to the same place in dst. Any of its files
+    that dst already has are left alone.
+    """
+    accounts = os.path.join(src, "accounts")
+    for root, dirs, _ in os.walk(accounts):
+        if account_id in dirs:
+            account = os.path.join(root, account_id)
+            target = os.path.join(dst, "accounts", os.path.relpath(account, accounts))
+            copy_missing(account, target)
+
+
+def remove_lineage(config_dir: str, name: str):
+    """Remove all trace of a lineage from a configuration directory."""
+    shutil.rmtree(os.path.join(config_dir, "archive", name), ignore_errors=True)
+    shutil.rmtree(os.path.join(config_dir, "live", name), ignore_errors=True)
+    try:
+        os.unlink(os.path.join(config_dir, "renewal", name + ".conf"))
+    except FileNotFoundError:
+        pass
+
+
+def _relink(src: str, dst: str):
+    """Atomically point the symbolic link dst at src."""
+    tmp = dst + ".tmp"
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    os.symlink(src, tmp)
+    os.rename(tmp, dst)
@@ -0,0 +1,201 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Prometheus metrics exported through node-exporter's textfile collector.
+
+Metrics are recorded both by the charm and by the deploy hook, which
+may be run by certbot at any time. The current values are kept in a
+JSON state file that is updated under an exclusive lock, and the
+textfile is rendered again, atomically, after every update.
+"""
+
+import contextlib
+import fcntl
+import os
+import time
+from typing import Iterator, Mapping, Optional
+
+import state
+
+# (name, type, help) of every exported metric, in output order.
+_METRICS = [
+    ("certbot_certificate_expiry_timestamp_seconds", "gauge",
+     "Time at which the certificate expires."),
+    ("certbot_run_timestamp_seconds", "gauge",
+     "Time of the last issuance or renewal attempt."),
+    ("certbot_run_success_timestamp_seconds", "gauge",
+     "Time of the last successful issuance or renewal."),
+    ("certbot_run_certbot_seconds", "gauge",
+     "Time spent running certbot in the last issuance or renewal attempt."),
+    ("certbot_run_deploy_seconds", "gauge",
+     "Time spent deploying the certificate in the last issuance or renewal attempt."),
+    ("certbot_runs_total", "counter",
+     "Number of issuance or renewal attempts."),
+    ("certbot_deploy_command_timestamp_seconds", "gauge",
+     "Time the deploy command was last run."),
+    ("certbot_deploy_command_seconds", "gauge",
+     "Duration of the last run of the deploy command."),
+    ("certbot_deploy_command_runs_total", "counter",
+     "Number of runs of the deploy command."),
+    ("certbot_install_seconds", "gauge",
+     "Time spent installing packages in the install hook, by where they came from."),
+]
+
+
+class Metrics:
+    """Recorder for the charm's metrics.
+
+    Recording does nothing if no textfile is configured.
+
+    Args:
+        path: Location of the metrics state file.
+        textfile: Location of the node-exporter textfile.
+    """
+
+    def __init__(self, path: str, textfile: str):
+        self._path = path
+        self._textfile = textfile
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._textfile)
+
+    def record_run(self, domain: str, operation: str, ok: bool,
+                   certbot_seconds: Optional[float] = None,
+                   deploy_seconds: Optional[float] = None):
+        """Record an issuance or renewal attempt.
+
+        Args:
+            domain: Name of the certificate.
+            operation: Either "issue" or "renew".
+            ok: Whether the attempt succeeded.
+            certbot_seconds: Time spent running certbot, if it was run.
+            deploy_seconds: Time spent deploying, if it was deployed.
+        """
+        now = time.time()
+        with self._update() as data:
+            if data is None:
+                return
+            runs = data.setdefault("runs", {}).setdefault(domain, {})
+            run = runs.setdefault(operation, {"success": 0, "failure": 0})
+            run["success" if ok else "failure"] += 1
+            run["timestamp"] = now
+            if ok:
+                run["success-timestamp"] = now
+            run["certbot-seconds"] = certbot_seconds
+            run["deploy-seconds"] = deploy_seconds
+
+    def record_deploy_command(self, ok: bool, seconds: float):
+        """Record a run of the deploy command."""
+        with self._update() as data:
+            if data is None:
+                return
+            command = data.setdefault("deploy-command", {"success": 0, "failure": 0})
+            command["success" if ok else "failure"] += 1
+            command["timestamp"] = time.time()
+            command["seconds"] = seconds
+
+    def record_install(self, source: str, seconds: float):
+        """Record the installation of the charm's packages.
+
+        Args:
+            source: Where the packages came from, as returned by
+              Host.install_packages.
+            seconds: Time spent installing them.
+        """
+        with self._update() as data:
+            if data is None:
+                return
+            data["install"] = {"source": source, "seconds": seconds}
+
+    def set_expiry(self, domain: str, timestamp: float):
+        """Record the expiry time of a certificate."""
+        with self._update() as data:
+            if data is None:
+                return
+            data.setdefault("expiry", {})[domain] = timestamp
+
+    def replace_expiry(self, expiry: Mapping[str, float]):
+        """Replace the expiry times of all certificates.
+
+        Certificates that are not in expiry are no longer reported.
+        """
+        with self._update() as data:
+            if data is None:
+                return
+            data["expiry"] = dict(expiry)
+
+    @contextlib.contextmanager
+    def _update(self) -> Iterator[Optional[dict]]:
+        """Update the metrics state and render the textfile.
+
+        The state is yielded to the caller to update in place, or None
+        if metrics are disabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = state.load_json(self._path, {})
+            yield data
+            state.save_json(self._path, data)
+            state.write_atomic(self._textfile, render(data).encode("utf-8"), 0o644)
+
+
+def render(data: dict) -> str:
+    """Render the metrics state in the Prometheus text format."""
+    samples = {name: [] for name, _, _ in _METRICS}
+    for domain, expiry in sorted(data.get("expiry", {}).items()):
+        samples["certbot_certificate_expiry_timestamp_seconds"].append(
+            ({"domain": domain}, expiry))
+    for domain, runs in sorted(data.get("runs", {}).items()):
+        for operation, run in sorted(runs.items()):
+            labels = {"domain": domain, "operation": operation}
+            for name, key in (("certbot_run_timestamp_seconds", "timestamp"),
+                              ("certbot_run_success_timestamp_seconds", "success-timestamp"),
+                              ("certbot_run_certbot_seconds", "certbot-seconds"),
+                              ("certbot_run_deploy_seconds", "deploy-seconds")):
+                if run.get(key) is not None:
+                    samples[name].append((labels, run[key]))
+            for result in ("success", "failure"):
+                samples["certbot_runs_total"].append(
+                    (dict(labels, result=result), run.get(result, 0)))
+    command = data.get("deploy-command")
+    if command:
+        samples["certbot_deploy_command_timestamp_seconds"].append(({}, command["timestamp"]))
+        samples["certbot_deploy_command_seconds"].append(({}, command["seconds"]))
+        for result in ("success", "failure"):
+            samples["certbot_deploy_command_runs_total"].append(
+                ({"result": result}, command.get(result, 0)))
+    install = data.get("install")
+    if install:
+        samples["certbot_install_seconds"].append(
+            ({"source": install["source"]}, install["seconds"]))
+
+    lines = []
+    for name, kind, description in _METRICS:
+        if not samples[name]:
+            continue
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend("{}{} {}".format(name, _labels(labels), _value(value))
+                     for labels, value in samples[name])
+    return "".join(line + "\n" for line in lines)
+
+
+def _labels(labels: Mapping[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(key, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
@@ -0,0 +1,162 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""OCSP client for fetching staples.
+
+Responses are fetched, and checked, with the "openssl ocsp" command.
+A response is only accepted if its signature verifies against the
+certificate's issuer, or a responder the issuer delegated to, and it is
+for the certificate that was asked about.
+"""
+
+import datetime
+import math
+import os
+import re
+import subprocess
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import x509
+
+# Statuses openssl reports for a certificate.
+STATUSES = ("good", "revoked", "unknown")
+
+# Lines of the openssl error queue, which repeat its messages with
+# internal detail.
+_ERROR_QUEUE_RE = re.compile(r"^[0-9A-Fa-f]+:error:")
+
+
+class OCSPError(ValueError):
+    """Raised when an OCSP response cannot be used."""
+    pass
+
+
+class Response:
+    """A verified OCSP response for a single certificate.
+
+    Attributes:
+        der: The response, as it is stapled.
+        serial: Serial number of the certificate.
+        status: Status of the certificate, "good", "revoked" or
+          "unknown".
+        this_update: Time at which the status was known to be correct.
+        next_update: Time by which newer information will be available,
+          or None if the responder always has newer information.
+    """
+
+    def __init__(self, der: bytes, serial: int, status: str, this_update: datetime.datetime,
+                 next_update: Optional[datetime.datetime]):
+        self.der = der
+        self.serial = serial
+        self.status = status
+        self.this_update = this_update
+        self.next_update = next_update
+
+    def refresh_at(self) -> datetime.datetime:
+        """Calculate when the response should be replaced.
+
+        This is half way through its validity period, leaving the second
+        half to retry failed fetches. A response without a nextUpdate is
+        replaced after a day.
+        """
+        if self.next_update is None:
+            return self.this_update + datetime.timedelta(days=1)
+        return self.this_update + (self.next_update - self.this_update) / 2
+
+
+def parse_response(der: bytes, cert_path: str, issuer_path: str) -> Response:
+    """Verify an OCSP response for a certificate.
+
+    Args:
+        der: The DER encoded OCSPResponse.
+        cert_path: Location of the certificate the response must be for.
+        issuer_path: Location of the certificate's issuer, the first
+          certificate in the file.
+
+    Raises:
+        OCSPError: The response is not successful, is not for the
+          certificate or does not verify.
+    """
+    cert = x509.parse_pem_file(cert_path)
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "response.der")
+        with open(path, "wb") as f:
+            f.write(der)
+        status, times = _ocsp(cert_path, issuer_path, ["-respin", path], x509.OPENSSL_TIMEOUT)
+    return Response(der, cert.serial, status, times["This Update"], times.get("Next Update"))
+
+
+def fetch(cert_path: str, issuer_path: str, timeout: float = 10.0) -> Response:
+    """Fetch the OCSP response for a certificate from its issuer's
+    responder.
+
+    Args:
+        cert_path: Location of the certificate.
+        issuer_path: Location of the certificate's issuer, the first
+          certificate in the file.
+        timeout: Number of seconds to wait for the responder.
+
+    Raises:
+        OCSPError: The certificate has no responder, the responder
+          cannot be reached or the response cannot be used.
+    """
+    cert = x509.parse_pem_file(cert_path)
+    if not cert.ocsp_urls:
+        raise OCSPError("certificate {:x} has no OCSP responder".format(cert.serial))
+    # openssl's timeout is in whole seconds, and applies to each of
+    # connecting and waiting for the response.
+    seconds = max(1, math.ceil(timeout))
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, "response.der")
+        status, times = _ocsp(cert_path, issuer_path,
+                              ["-url", cert.ocsp_urls[0], "-timeout", str(seconds),
+                               "-respout", path], 2 * seconds + x509.OPENSSL_TIMEOUT)
+        with open(path, "rb") as f:
+            der = f.read()
+    return Response(der, cert.serial, status, times["This Update"], times.get("Next Update"))
+
+
+def _ocsp(cert_path: str, issuer_path: str, args: List[str],
+          timeout: float) -> Tuple[str, Dict[str, datetime.datetime]]:
+    """Run "openssl ocsp" for a certificate.
+
+    The issuer is trusted to sign responses for its certificates, and
+    responders it delegated to are trusted through it.
+
+    Returns:
+        The certificate's status, and the response's "This Update" and
+        "Next Update" times.
+    """
+    try:
+        proc = x509.openssl(["ocsp", "-issuer", issuer_path, "-cert", cert_path,
+                             "-VAfile", issuer_path, "-no_nonce"] + args, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as err:
+        raise OCSPError("cannot run openssl ocsp: {}".format(err))
+    # The status is printed even if the response does not verify, so
+    # only the exit status says whether it can be used.
+    if proc.returncode != 0:
+        messages = [line for line in proc.stderr.splitlines()
+                    if line not in ("", "Response verify OK") and not _ERROR_QUEUE_RE.match(line)]
+        messages += [line for line in proc.stdout.splitlines() if "ERROR" in line.upper()]
+        raise OCSPError("unusable OCSP response: {}".format(
+            "; ".join(messages) or "openssl failed"))
+    lines = proc.stdout.splitlines()
+    prefix = cert_path + ": "
+    for i, line in enumerate(lines):
+        if not line.startswith(prefix):
+            continue
+        status = line[len(prefix):]
+        if status not in STATUSES:
+            raise OCSPError("unusable OCSP response: {}".format(status))
+        times = {}
+        for detail in lines[i + 1:]:
+            if not detail.startswith("\t"):
+                break
+            key, _, value = detail.strip().partition(": ")
+            if key in ("This Update", "Next Update"):
+                times[key] = x509.decode_time(value)
+        if "This Update" not in times:
+            raise OCSPError("OCSP response has no thisUpdate")
+        return status, times
+    raise OCSPError("unexpected openssl output: {}".format(proc.stdout.strip()))
@@ -0,0 +1,190 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Packing of hostnames into as few certificates as possible.
+
+A plan maps lineage names to the hostnames on each certificate. Names
+covered by a wildcard in the list are dropped, names of a registered
+domain are kept together where they fit, and no certificate has more
+than the maximum number of names. Plans are made incrementally from the
+previous plan so that a small change to the list of hostnames only
+changes a small number of certificates.
+"""
+
+import re
+from typing import Dict, Iterable, List, Mapping, Set
+
+# ACME servers, including Let's Encrypt, allow at most 100 names.
+MAX_NAMES = 100
+
+# Multi-label public suffixes under which the registered domain has
+# three labels. This is a small subset of the public suffix list, other
+# names are assumed to be registered directly under their TLD.
+_SUFFIXES = frozenset([
+    "ac.uk", "co.uk", "gov.uk", "ltd.uk", "me.uk", "net.uk", "org.uk", "plc.uk",
+    "com.au", "edu.au", "gov.au", "net.au", "org.au",
+    "co.nz", "net.nz", "org.nz",
+    "co.jp", "ne.jp", "or.jp",
+    "com.br", "net.br", "org.br",
+    "com.cn", "net.cn", "org.cn",
+    "co.in", "net.in", "org.in",
+    "co.za", "org.za",
+    "com.mx", "com.tr", "com.sg", "com.hk",
+])
+
+_HOSTNAME_RE = re.compile(r"^(\*\.)?([a-z0-9_]([a-z0-9_-]*[a-z0-9_])?\.)+[a-z0-9-]+$")
+
+
+class Plan:
+    """A plan of certificates.
+
+    Attributes:
+        certificates: The hostnames of each certificate, keyed by
+          lineage name.
+        changed: Names of the certificates that are new or whose
+          hostnames changed, these need to be issued.
+        removed: Names of the certificates in the previous plan that
+          are no longer needed.
+    """
+
+    def __init__(self, certificates: Dict[str, List[str]], changed: List[str],
+                 removed: List[str]):
+        self.certificates = certificates
+        self.changed = changed
+        self.removed = removed
+
+
+def parse_hostnames(text: str) -> List[str]:
+    """Parse a comma, or whitespace, separated list of hostnames.
+
+    Hostnames are lower-cased and duplicates are removed.
+
+    Raises:
+        ValueError: A hostname is not valid.
+    """
+    names = []
+    for name in re.split(r"[\s,]+", text.strip().lower()):
+        name = name.rstrip(".")
+        if not name:
+            continue
+        if not _HOSTNAME_RE.match(name) or len(name) > 253:
+            raise ValueError("invalid hostname {!r}".format(name))
+        names.append(name)
+    return list(dict.fromkeys(names))
+
+
+def registered_domain(name: str) -> str:
+    """Approximate the registered domain of a hostname."""
+    labels = name.split(".")
+    if labels[0] == "*":
+        labels = labels[1:]
+    n = 3 if ".".join(labels[-2:]) in _SUFFIXES else 2
+    return ".".join(labels[-n:])
+
+
+def covered(name: str, wildcards: Iterable[str]) -> bool:
+    """Check whether a hostname is covered by one of the wildcards.
+
+    A wildcard only covers a single label, *.example.com covers
+    www.example.com but not example.com or a.b.example.com.
+    """
+    if name.startswith("*."):
+        return False
+    parent = name.partition(".")[2]
+    return "*." + parent in wildcards
+
+
+def plan(hostnames: Iterable[str], previous: Mapping[str, List[str]] = None,
+         max_names: int = MAX_NAMES, isolate: bool = False,
+         reserved: Iterable[str] = ()) -> Plan:
+    """Plan the certificates for a list of hostnames.
+
+    Certificates in the previous plan keep the wanted hostnames they
+    already have. New hostnames are added to a certificate already
+    holding names of the same registered domain if there is room, and
+    the rest are packed into the fewest certificates, preferring
+    certificates that already need to be issued.
+
+    Args:
+        hostnames: Every hostname that needs a certificate.
+        previous: The certificates of the previous plan.
+        max_names: Maximum number of names on a certificate.
+        isolate: Never put names of different registered domains on
+          the same certificate.
+        reserved: Lineage names that must not be used for new
+          certificates.
+
+    Returns:
+        The new plan.
+    """
+    max_names = max(1, min(max_names, MAX_NAMES))
+    names = list(dict.fromkeys(hostnames))
+    wildcards = {n for n in names if n.startswith("*.")}
+    wanted = [n for n in names if not covered(n, wildcards)]
+    wanted_set = set(wanted)
+
+    certs = {}
+    placed = set()
+    for lineage, domains in sorted((previous or {}).items()):
+        keep = [d for d in domains if d in wanted_set and d not in placed]
+        if keep:
+            certs[lineage] = keep[:max_names]
+            placed.update(certs[lineage])
+    changed = {lineage for lineage in certs if certs[lineage] != list(previous[lineage])}
+
+    groups = {}
+    for name in wanted:
+        if name not in placed:
+            groups.setdefault(registered_domain(name), []).append(name)
+
+    # Add to certificates already holding the registered domain.
+    for group, members in sorted(groups.items()):
+        holders = sorted((lineage for lineage, domains in certs.items()
+                          if any(registered_domain(d) == group for d in domains)),
+                         key=lambda lineage: (lineage not in changed, lineage))
+        for lineage in holders:
+            room = max_names - len(certs[lineage])
+            if room > 0 and members:
+                certs[lineage].extend(members[:room])
+                del members[:room]
+                changed.add(lineage)
+
+    # Pack the remaining names, keeping registered domains together
+    # unless they don't fit on one certificate.
+    chunks = []
+    for group, members in sorted(groups.items()):
+        members.sort()
+        chunks.extend(members[i:i + max_names] for i in range(0, len(members), max_names))
+    chunks.sort(key=lambda chunk: (-len(chunk), chunk[0]))
+    for chunk in chunks:
+        candidates = [lineage for lineage in sorted(certs, key=lambda lineage: (
+            lineage not in changed, lineage)) if len(certs[lineage]) + len(chunk) <= max_names]
+        if isolate:
+            group = registered_domain(chunk[0])
+            candidates = [lineage for lineage in candidates
+                          if registered_domain(certs[lineage][0]) == group]
+        if candidates:
+            lineage = candidates[0]
+            certs[lineage].extend(chunk)
+        else:
+            lineage = _lineage_name(chunk[0], set(certs) | set(previous or {}) | set(reserved))
+            certs[lineage] = list(chunk)
+        changed.add(lineage)
+
+    for lineage, domains in certs.items():
+        # The lineage's own name first, then the rest in order.
+        rest = sorted(d for d in domains if d != lineage)
+        certs[lineage] = ([lineage] if lineage in domains else []) + rest
+    removed = sorted(set(previous or {}) - set(certs))
+    return Plan(dict(sorted(certs.items())), sorted(changed), removed)
+
+
+def _lineage_name(name: str, used: Set[str]) -> str:
+    """Choose an unused lineage name based on a hostname."""
+    base = name[2:] if name.startswith("*.") else name
+    candidate = base
+    i = 1
+    while candidate in used:
+        candidate = "{}-{:04d}".format(base, i)
+        i += 1
+    return candidate
@@ -0,0 +1,330 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Preflight checks of DNS plugin credentials and zones.
+
+A certificate request with bad credentials, or for a zone the plugin
+cannot update, is otherwise only discovered after certbot has created
+an ACME order and waited for the challenge to propagate. These checks
+find most such problems in a few seconds at most, without creating an
+order.
+
+The nameservers of a zone are only a heuristic for its provider, vanity
+nameservers and zones delegated through CNAMEs are common, so a zone
+that does not look like the plugin's only adds a "warnings" detail.
+A check that cannot reach a resolver, DNS server or the STS endpoint
+proves nothing about the credentials either, so such failures are also
+warnings. Only credentials that are invalid or rejected, and updates
+that a server refuses, fail the check.
+
+dns-rfc2136
+  The credentials file is parsed and a signed update, that changes
+  nothing, is sent to the configured server for the zone of each
+  domain.
+dns-google
+  The credentials must be a service account key. A warning is given
+  for the zone of any domain that does not appear to be served by
+  Google Cloud DNS.
+dns-route53
+  Explicit credentials are checked with an STS GetCallerIdentity
+  request, the default credentials of the instance or environment are
+  left to certbot. A warning is given for the zone of any domain that
+  does not appear to be served by Route53.
+http-01
+  No domain may be a wildcard, those can only be validated with DNS.
+"""
+
+import configparser
+import datetime
+import hashlib
+import hmac
+import json
+import random
+import socket
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import xml.etree.ElementTree as ET
+from typing import Dict, List
+
+import dnsquery
+
+# Endpoint of the AWS Security Token Service.
+STS_ENDPOINT = "https://sts.amazonaws.com/"
+
+# Number of seconds to wait for the STS response, which is a TLS
+# connection to a remote service rather than a single DNS exchange.
+STS_TIMEOUT = 10.0
+
+_STS_BODY = "Action=GetCallerIdentity&Version=2011-06-15"
+
+
+class PreflightError(Exception):
+    """Raised when a preflight check fails."""
+    pass
+
+
+def check(plugin: str, domains: List[str], credentials_path: str = None,
+          aws_access_key_id: str = None, aws_secret_access_key: str = None,
+          resolver: str = None, port: int = 53, timeout: float = 1.0,
+          sts_endpoint: str = STS_ENDPOINT, sts_timeout: float = STS_TIMEOUT) -> Dict[str, str]:
+    """Check that a plugin can prove control of the domains.
+
+    Plugins without a preflight check always pass.
+
+    Args:
+        plugin: Name of the certbot plugin.
+        domains: The names on the certificate.
+        credentials_path: Location of the credentials file of the
+          dns-google and dns-rfc2136 plugins.
+        aws_access_key_id: Access key of the dns-route53 plugin, if
+          it does not use the default credentials.
+        aws_secret_access_key: Secret key of the dns-route53 plugin.
+        resolver: Recursive resolver used to find zones. If this is not
+          specified the first nameserver in /etc/resolv.conf is used.
+        port: DNS port used by all servers.
+        timeout: Number of seconds to wait for each DNS response.
+        sts_endpoint: URL of the AWS Security Token Service.
+        sts_timeout: Number of seconds to wait for the STS response.
+
+    Returns:
+        Details of what was checked, keyed by name. Problems that may
+        not stop the plugin are given in "warnings".
+
+    Raises:
+        PreflightError: The plugin cannot get a certificate for the
+          domains.
+    """
+    if plugin == "dns-rfc2136":
+        return check_rfc2136(_read(credentials_path), domains, timeout)
+    if plugin == "dns-google":
+        return check_google(_read(credentials_path), domains, _resolver(resolver), port,
+                            timeout)
+    if plugin == "dns-route53":
+        return check_route53(aws_access_key_id, aws_secret_access_key, domains,
+                             _resolver(resolver), port, timeout, sts_endpoint, sts_timeout)
+    if plugin == "http-01":
+        return check_http01(domains)
+    return {}
+
+
+def check_http01(domains: List[str]) -> Dict[str, str]:
+    """Check that http-01 challenges can validate the domains."""
+    wildcards = [d for d in domains if d.startswith("*.")]
+    if wildcards:
+        raise PreflightError("http-01 cannot validate wildcard names: {}".format(
+            ", ".join(wildcards)))
+    return {"domains": ",".join(domains)}
+
+
+def check_rfc2136(credentials: bytes, domains: List[str],
+                  timeout: float = 1.0) -> Dict[str, str]:
+    """Check dns-rfc2136 credentials.
+
+    The update deletes a TXT record, with a random value, that does not
+    exist. The server must authenticate the key and authorise the
+    update for it to succeed.
+    """
+    cp = configparser.ConfigParser()
+    try:
+        cp.read_string("[rfc2136]\n" + credentials.decode("utf-8"))
+        section = cp["rfc2136"]
+        server = section["dns_rfc2136_server"]
+        port = int(section.get("dns_rfc2136_port", "53"))
+        key = dnsquery.TSIGKey(section["dns_rfc2136_name"], section["dns_rfc2136_secret"],
+                               section.get("dns_rfc2136_algorithm", "HMAC-MD5"))
+    except KeyError as err:
+        raise PreflightError("invalid credentials: missing {}".format(err))
+    except (configparser.Error, UnicodeDecodeError, ValueError, dnsquery.DNSError) as err:
+        raise PreflightError("invalid credentials: {}".format(err))
+    zones = {}
+    warnings = []
+    for domain in domains:
+        name = _challenge_name(domain)
+        try:
+            zone = dnsquery.find_zone(name, server, port, timeout)
+            message = dnsquery.Message(
+                random.getrandbits(16), dnsquery.UPDATE, [(zone, dnsquery.SOA, dnsquery.IN)],
+                authority=[dnsquery.Record(name, dnsquery.TXT, uuid.uuid4().hex, 0,
+                                           dnsquery.NONE)])
+            response = dnsquery.exchange(message, server, port, timeout, key=key)
+        except dnsquery.DNSError as err:
+            # The server is unreachable, the other zones are not tried.
+            warnings.append("cannot update zone of {} on {}: {}".format(domain, server, err))
+            break
+        if response.rcode != dnsquery.NOERROR:
+            raise PreflightError("update of zone {} refused by {}: rcode {}".format(
+                zone, server, response.rcode))
+        zones[domain] = zone
+    details = {"server": server, "zones": _join(zones)}
+    if warnings:
+        details["warnings"] = "; ".join(warnings)
+    return details
+
+
+def check_google(credentials: bytes, domains: List[str], resolver: str, port: int = 53,
+                 timeout: float = 1.0) -> Dict[str, str]:
+    """Check dns-google credentials."""
+    try:
+        account = json.loads(credentials.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as err:
+        raise PreflightError("invalid credentials: {}".format(err))
+    if not isinstance(account, dict) or account.get("type") != "service_account":
+        raise PreflightError("invalid credentials: not a service account key")
+    for field in ("project_id", "client_email", "private_key"):
+        if not account.get(field):
+            raise PreflightError("invalid credentials: missing {}".format(field))
+    if "PRIVATE KEY-----" not in account["private_key"]:
+        raise PreflightError("invalid credentials: private_key is not a PEM key")
+    details = {"account": account["client_email"]}
+    details.update(_check_zones(domains, resolver, port, timeout, ".googledomains.com",
+                                "Google Cloud DNS"))
+    return details
+
+
+def check_route53(aws_access_key_id: str, aws_secret_access_key: str, domains: List[str],
+                  resolver: str, port: int = 53, timeout: float = 1.0,
+                  sts_endpoint: str = STS_ENDPOINT,
+                  sts_timeout: float = STS_TIMEOUT) -> Dict[str, str]:
+    """Check dns-route53 credentials.
+
+    Without an access key the plugin uses the default credentials of
+    the instance or environment, which are not checked.
+    """
+    details = {}
+    warning = None
+    if aws_access_key_id and aws_secret_access_key:
+        request = sts_request(aws_access_key_id, aws_secret_access_key, sts_endpoint)
+        try:
+            with urllib.request.urlopen(request, timeout=sts_timeout) as response:
+                body = response.read()
+        except urllib.error.HTTPError as err:
+            if err.code < 500:
+                raise PreflightError("invalid credentials: {}".format(
+                    _sts_error(err.read()) or err))
+            warning = "cannot check credentials with {}: {}".format(sts_endpoint, err)
+        except (urllib.error.URLError, socket.timeout) as err:
+            warning = "cannot reach {}: {}".format(sts_endpoint, err)
+        else:
+            details["identity"] = _find_text(body, "Arn") or ""
+    details.update(_check_zones(domains, resolver, port, timeout, ".awsdns-", "Route53"))
+    if warning:
+        details["warnings"] = "; ".join(filter(None, [warning, details.get("warnings")]))
+    return details
+
+
+def sts_request(aws_access_key_id: str, aws_secret_access_key: str, endpoint: str,
+                now: datetime.datetime = None) -> urllib.request.Request:
+    """Build a GetCallerIdentity request signed with AWS Signature V4."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    url = urllib.parse.urlsplit(endpoint)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    headers = {
+        "content-type": "application/x-www-form-urlencoded; charset=utf-8",
+        "host": url.netloc,
+        "x-amz-date": amz_date,
+    }
+    signed_headers = ";".join(sorted(headers))
+    canonical = "\n".join([
+        "POST", url.path or "/", "",
+        "".join("{}:{}\n".format(k, headers[k]) for k in sorted(headers)),
+        signed_headers, _sha256(_STS_BODY)])
+    scope = "{}/us-east-1/sts/aws4_request".format(now.strftime("%Y%m%d"))
+    to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, _sha256(canonical)])
+    key = ("AWS4" + aws_secret_access_key).encode("utf-8")
+    for part in scope.split("/"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    signature = hmac.new(key, to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["authorization"] = "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, " \
+        "Signature={}".format(aws_access_key_id, scope, signed_headers, signature)
+    del headers["host"]
+    return urllib.request.Request(endpoint, data=_STS_BODY.encode("utf-8"), headers=headers,
+                                  method="POST")
+
+
+def _check_zones(domains: List[str], resolver: str, port: int, timeout: float,
+                 marker: str, provider: str) -> Dict[str, str]:
+    """Check that the zone of each domain looks served by a DNS provider.
+
+    Args:
+        marker: Text found in the name of every nameserver of the
+          provider.
+        provider: Name of the provider, for warnings.
+
+    Returns:
+        The zones of the domains, and "warnings" about any that do not
+        look served by the provider, or that could not be found.
+    """
+    zones = {}
+    warnings = []
+    if not resolver:
+        warnings.append("zones not checked: no resolver configured")
+        domains = []
+    for domain in domains:
+        try:
+            zone = dnsquery.find_zone(_challenge_name(domain), resolver, port, timeout)
+            hosts = [rr.data.lower() for rr in
+                     dnsquery.query(zone, dnsquery.NS, resolver, port, timeout).answer
+                     if rr.type == dnsquery.NS]
+        except dnsquery.DNSError as err:
+            # Most often the resolver is unreachable, so the other
+            # domains are not tried.
+            warnings.append("cannot find zone of {}: {}".format(domain, err))
+            break
+        if not hosts or not all(marker in host for host in hosts):
+            warning = "zone {} does not appear to be served by {}".format(zone, provider)
+            if warning not in warnings:
+                warnings.append(warning)
+        zones[domain] = zone
+    details = {"zones": _join(zones)}
+    if warnings:
+        details["warnings"] = "; ".join(warnings)
+    return details
+
+
+def _read(path: str) -> bytes:
+    if not path:
+        raise PreflightError("invalid credentials: no credentials file")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as err:
+        raise PreflightError("cannot read credentials: {}".format(err))
+
+
+def _resolver(resolver: str) -> str:
+    if resolver:
+        return resolver
+    servers = dnsquery.resolvers()
+    return servers[0] if servers else None
+
+
+def _challenge_name(domain: str) -> str:
+    if domain.startswith("*."):
+        domain = domain[2:]
+    return "_acme-challenge." + domain
+
+
+def _join(zones: Dict[str, str]) -> str:
+    return ",".join(sorted(set(zones.values())))
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _find_text(body: bytes, tag: str) -> str:
+    """Find the text of the first element with the given tag."""
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return None
+    for element in root.iter():
+        if element.tag.rpartition("}")[2] == tag:
+            return element.text
+    return None
+
+
+def _sts_error(body: bytes) -> str:
+    return _find_text(body, "Message")
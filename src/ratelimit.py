@@ -0,0 +1,210 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A local ledger of ACME orders, used to stay within rate limits.
+
+ACME servers limit how many certificates may be issued. Orders that
+would exceed a limit fail, slowly, and may extend the time until the
+limit resets. The ledger records every order made by this unit and its
+outcome so that an order that would exceed a limit can be held back
+until the limit has room again.
+
+The limits, and their defaults which match Let's Encrypt, are:
+
+certificates-per-domain
+  Certificates, other than renewals, issued for names of a registered
+  domain per week.
+orders
+  New orders per account every 3 hours.
+duplicates
+  Certificates for exactly the same set of names per week.
+failed-validations
+  Failed validations of a name per hour.
+"""
+
+import contextlib
+import datetime
+import fcntl
+import logging
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from planner import registered_domain
+import state
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of events allowed, and the window they are counted in.
+LIMITS = {
+    "certificates-per-domain": (50, datetime.timedelta(days=7)),
+    "orders": (300, datetime.timedelta(hours=3)),
+    "duplicates": (5, datetime.timedelta(days=7)),
+    "failed-validations": (5, datetime.timedelta(hours=1)),
+}
+
+
+class RateLimited(Exception):
+    """Raised when an order would exceed a rate limit.
+
+    Attributes:
+        limit: Name of the limit that would be exceeded.
+        eta: When the order may be made.
+    """
+
+    def __init__(self, limit: str, eta: datetime.datetime):
+        super().__init__("{} rate limit reached, retry after {}".format(
+            limit, eta.strftime("%Y-%m-%d %H:%M:%S")))
+        self.limit = limit
+        self.eta = eta
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[int, datetime.timedelta]]:
+    """Parse a rate limit override.
+
+    Args:
+        spec: Comma separated list of name=count pairs, a count of 0
+          disables the limit. Invalid entries are logged and ignored.
+
+    Returns:
+        The limits, with the defaults for those not overridden.
+    """
+    limits = dict(LIMITS)
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, count = item.partition("=")
+        name = name.strip()
+        try:
+            count = int(count)
+        except ValueError:
+            count = None
+        if name not in LIMITS or count is None or count < 0:
+            logger.warning("invalid rate limit %r", item)
+            continue
+        if count:
+            limits[name] = (count, LIMITS[name][1])
+        else:
+            del limits[name]
+    return limits
+
+
+class Ledger:
+    """The ledger of orders.
+
+    The ledger may be used by concurrent threads, and by other
+    processes, every change is made holding a lock on the ledger file.
+
+    Args:
+        path: Location of the ledger file.
+        limits: The limits to enforce.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path: str, limits: Dict[str, Tuple[int, datetime.timedelta]] = None):
+        self._path = path
+        self._limits = LIMITS if limits is None else limits
+
+    def check(self, domains: Iterable[str], renewal: bool = False,
+              now: datetime.datetime = None) -> Optional[Tuple[str, datetime.datetime]]:
+        """Check whether an order can be made.
+
+        Args:
+            domains: The names on the certificate.
+            renewal: The order renews an existing certificate.
+            now: The current time.
+
+        Returns:
+            None if the order can be made, otherwise the name of the
+            limit that would be exceeded and when the order can be made.
+        """
+        now = now or _now()
+        with self._locked() as orders:
+            return self._check(orders, list(domains), renewal, now)
+
+    def reserve(self, domains: Iterable[str], renewal: bool = False,
+                now: datetime.datetime = None) -> str:
+        """Record a new order, if it can be made.
+
+        The order counts against the limits until it is finished.
+
+        Args:
+            domains: The names on the certificate.
+            renewal: The order renews an existing certificate.
+            now: The current time.
+
+        Returns:
+            The ID of the order.
+
+        Raises:
+            RateLimited: The order would exceed a limit.
+        """
+        now = now or _now()
+        domains = list(domains)
+        with self._locked() as orders:
+            limited = self._check(orders, domains, renewal, now)
+            if limited:
+                raise RateLimited(*limited)
+            order_id = uuid.uuid4().hex
+            orders.append({"id": order_id, "time": now.isoformat(), "domains": domains,
+                           "renewal": renewal, "status": "pending"})
+        return order_id
+
+    def finish(self, order_id: str, ok: bool):
+        """Record the outcome of an order."""
+        with self._locked() as orders:
+            for order in orders:
+                if order["id"] == order_id:
+                    order["status"] = "ok" if ok else "failed"
+                    order["finished"] = _now().isoformat()
+
+    def _check(self, orders: List[dict], domains: List[str], renewal: bool,
+               now: datetime.datetime) -> Optional[Tuple[str, datetime.datetime]]:
+        """Find the limit, if any, that an order would exceed."""
+        names = set(domains)
+        issued = [o for o in orders if o["status"] != "failed"]
+        events = {"orders": [o["time"] for o in orders]}
+        events["duplicates"] = [o["time"] for o in issued if set(o["domains"]) == names]
+        events["failed-validations"] = [
+            o.get("finished", o["time"]) for o in orders
+            if o["status"] == "failed" and names.intersection(o["domains"])]
+        if not renewal:
+            for group in sorted({registered_domain(d) for d in domains}):
+                events["certificates-per-domain:" + group] = [
+                    o["time"] for o in issued if not o["renewal"] and any(
+                        registered_domain(d) == group for d in o["domains"])]
+        worst = None
+        for key, times in events.items():
+            limit = key.partition(":")[0]
+            if limit not in self._limits:
+                continue
+            count, window = self._limits[limit]
+            times = sorted(t for t in map(state.parse_time, times) if t > now - window)
+            if len(times) < count:
+                continue
+            # Wait until enough events leave the window.
+            eta = times[len(times) - count] + window
+            if worst is None or eta > worst[1]:
+                worst = (limit, eta)
+        return worst
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Load the orders holding the ledger lock, saving any changes."""
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        with self._lock, open(self._path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            orders = state.load_json(self._path, [])
+            before = list(map(dict, orders))
+            yield orders
+            # Forget orders that no longer count against any limit.
+            horizon = _now() - max(w for _, w in LIMITS.values())
+            orders[:] = [o for o in orders if state.parse_time(o["time"]) > horizon]
+            if orders != before:
+                state.save_json(self._path, orders)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
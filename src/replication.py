@@ -0,0 +1,180 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Encoding of certbot state for replication to peer units.
+
+The leader publishes each lineage, and the ACME accounts, as a single
+relation value. Values hold private keys, so they are encrypted with a
+key derived from a passphrase every unit is configured with, and
+authenticated. Every value carries a keyed hash of its content so that
+peers can skip values they have already installed without decrypting
+them.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from lineage import LINEAGE_FILES, current_files
+
+# PBKDF2 parameters stretching the passphrase into the keys.
+_KDF_SALT = b"certbot-charm replication"
+_KDF_ITERATIONS = 200000
+
+_MAC_SIZE = hashlib.sha256().digest_size
+
+
+class Cipher:
+    """Encryption of replicated values.
+
+    The passphrase is stretched once into an encryption key and a MAC
+    key. Values are encrypted with AES-256-CBC by the openssl command,
+    as no cryptography library is available in the charm's environment,
+    and then authenticated with HMAC-SHA256.
+
+    Args:
+        passphrase: The passphrase shared by the units.
+        timeout: Number of seconds after which openssl is killed.
+    """
+
+    def __init__(self, passphrase: str, timeout: float = None):
+        key = hashlib.pbkdf2_hmac("sha256", passphrase.encode("utf-8"), _KDF_SALT,
+                                  _KDF_ITERATIONS, 64)
+        self._enc_key, self._mac_key = key[:32], key[32:]
+        self._timeout = timeout
+
+    def digest(self, files: Mapping[str, bytes]) -> str:
+        """Calculate the keyed hash of a set of files."""
+        h = hmac.new(self._mac_key, digestmod=hashlib.sha256)
+        for key in sorted(files):
+            h.update(key.encode("utf-8") + b"\0" + files[key] + b"\0")
+        return h.hexdigest()
+
+    def encrypt(self, data: bytes) -> bytes:
+        """Encrypt and authenticate data."""
+        ciphertext = self._openssl([], data)
+        return ciphertext + hmac.new(self._mac_key, ciphertext, hashlib.sha256).digest()
+
+    def decrypt(self, data: bytes) -> bytes:
+        """Authenticate and decrypt data made by encrypt.
+
+        Raises:
+            ValueError: The data was not encrypted with this key.
+        """
+        ciphertext, mac = data[:-_MAC_SIZE], data[-_MAC_SIZE:]
+        if not hmac.compare_digest(mac, hmac.new(self._mac_key, ciphertext,
+                                                 hashlib.sha256).digest()):
+            raise ValueError("replicated value not encrypted with the replication-key")
+        return self._openssl(["-d"], ciphertext)
+
+    def _openssl(self, args: List[str], data: bytes) -> bytes:
+        # The key is already stretched, and is passed in the environment
+        # rather than on the command line where other users can see it.
+        proc = subprocess.run(
+            ["openssl", "enc", "-aes-256-cbc", "-pbkdf2", "-iter", "1",
+             "-pass", "env:REPLICATION_KEY"] + args,
+            input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self._timeout,
+            env=dict(os.environ, REPLICATION_KEY=self._enc_key.hex()), check=True)
+        return proc.stdout
+
+
+def pack(files: Mapping[str, bytes], cipher: Cipher) -> str:
+    """Encode a set of files as an encrypted relation value."""
+    plain = json.dumps({k: base64.b64encode(v).decode("ascii") for k, v in files.items()},
+                       sort_keys=True)
+    return json.dumps({
+        "hash": cipher.digest(files),
+        "data": base64.b64encode(cipher.encrypt(plain.encode("utf-8"))).decode("ascii"),
+    }, sort_keys=True)
+
+
+def value_hash(value: Optional[str]) -> Optional[str]:
+    """Find the hash of the files in a relation value, without decrypting it.
+
+    Returns:
+        The hash, or None if there is no valid value.
+    """
+    try:
+        return json.loads(value)["hash"]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def unpack(value: str, cipher: Cipher) -> Tuple[str, Dict[str, bytes]]:
+    """Decode a relation value created by pack.
+
+    Returns:
+        The hash of the files, and the files.
+
+    Raises:
+        ValueError: The value is not valid, or was encrypted with
+          another key.
+    """
+    try:
+        data = json.loads(value)
+        plain = cipher.decrypt(base64.b64decode(data["data"], validate=True))
+        return data["hash"], {k: base64.b64decode(v, validate=True)
+                              for k, v in json.loads(plain.decode("utf-8")).items()}
+    except (KeyError, TypeError, AttributeError) as err:
+        raise ValueError("invalid replicated value: {}".format(err))
+
+
+def read_lineage(config_dir: str, name: str) -> Dict[str, bytes]:
+    """Read the files of a lineage to replicate.
+
+    Returns:
+        The current version of each of the lineage's files, keyed by
+        kind, and its renewal configuration keyed by "renewal", if it
+        has one.
+    """
+    files = current_files(config_dir, name)
+    try:
+        with open(os.path.join(config_dir, "renewal", name + ".conf"), "rb") as f:
+            files["renewal"] = f.read()
+    except FileNotFoundError:
+        pass
+    return files
+
+
+def lineage_files(files: Mapping[str, bytes]) -> Dict[str, bytes]:
+    """Select the certificate and key files from a replicated lineage."""
+    return {kind: files[kind] for kind in LINEAGE_FILES}
+
+
+def read_tree(path: str) -> Dict[str, bytes]:
+    """Read every file in a directory tree.
+
+    Returns:
+        The content of each file keyed by its path relative to path.
+        This is empty if path does not exist.
+    """
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), "rb") as f:
+                files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+    return files
+
+
+def write_tree(path: str, files: Mapping[str, bytes]):
+    """Write files read by read_tree under path.
+
+    Files are only readable by their owner. Relative paths that would
+    escape path are rejected.
+
+    Raises:
+        ValueError: A file's path is outside path.
+    """
+    root = os.path.realpath(path)
+    for relpath, content in files.items():
+        dst = os.path.realpath(os.path.join(root, relpath))
+        if not dst.startswith(root + os.sep):
+            raise ValueError("invalid path {}".format(relpath))
+        os.makedirs(os.path.dirname(dst), mode=0o700, exist_ok=True)
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
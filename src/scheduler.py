@@ -0,0 +1,59 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Selection of certificates for renewal.
+
+Each certificate becomes due for renewal a fixed time before it
+expires, plus a jitter that depends on the unit and the certificate.
+This spreads the renewals of many certificates, and of many units,
+across a window instead of renewing everything at the same moment.
+Where the CA suggests a renewal time that is used instead.
+"""
+
+import datetime
+import hashlib
+from typing import Dict, List
+
+from certindex import not_after
+
+
+def jitter(unit: str, name: str, window: datetime.timedelta) -> datetime.timedelta:
+    """Calculate the jitter for a certificate.
+
+    The jitter is a stable pseudo-random offset within the window that
+    is different for every (unit, certificate) pair.
+    """
+    digest = hashlib.sha256("{}\0{}".format(unit, name).encode("utf-8")).digest()
+    fraction = int.from_bytes(digest[:8], "big") / 2 ** 64
+    return datetime.timedelta(seconds=int(window.total_seconds() * fraction))
+
+
+def due_time(entry: dict, unit: str, before: datetime.timedelta,
+             window: datetime.timedelta) -> datetime.datetime:
+    """Calculate when a certificate becomes due for renewal.
+
+    Args:
+        entry: Certificate index entry.
+        unit: Name of the unit renewing the certificate.
+        before: How long before expiry the renewal window opens.
+        window: Length of the period over which renewals are spread.
+    """
+    return not_after(entry) - before + jitter(unit, entry["name"], window)
+
+
+def select_due(entries: List[dict], now: datetime.datetime, unit: str,
+               before: datetime.timedelta, window: datetime.timedelta,
+               renew_at: Dict[str, datetime.datetime] = None) -> List[dict]:
+    """Select the certificates that are due for renewal.
+
+    Args:
+        renew_at: Renewal times suggested by the CA, keyed by
+          certificate name, used in place of the calculated due time.
+
+    Returns:
+        The due entries, those expiring soonest first.
+    """
+    renew_at = renew_at or {}
+    due = [e for e in entries
+           if renew_at.get(e["name"], due_time(e, unit, before, window)) <= now]
+    return sorted(due, key=not_after)
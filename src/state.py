@@ -0,0 +1,70 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""Persistence of the charm's on-disk state files."""
+
+import datetime
+import json
+import os
+import re
+import tempfile
+from typing import Any
+
+
+def load_json(path: str, default: Any = None) -> Any:
+    """Load a JSON state file.
+
+    Returns:
+        The decoded content, or default if the file does not exist or
+        cannot be decoded.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def save_json(path: str, data: Any, mode: int = 0o600):
+    """Atomically replace a JSON state file.
+
+    The data is written to a temporary file in the same directory,
+    synced and renamed over the target, so that a crash never leaves a
+    partially written state file.
+    """
+    write_atomic(path, json.dumps(data, indent=1, sort_keys=True).encode("utf-8"), mode)
+
+
+def write_atomic(path: str, content: bytes, mode: int = 0o600):
+    """Atomically replace a file with the given content."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def parse_time(value: str) -> datetime.datetime:
+    """Parse a timestamp written by datetime.isoformat.
+
+    datetime.fromisoformat only exists from Python 3.7, and before 3.7
+    strptime takes no colon in the UTC offset.
+
+    Raises:
+        ValueError: The timestamp is not valid.
+    """
+    value = re.sub(r"([+-]\d\d):(\d\d)$", r"\1\2", value)
+    fmt = "%Y-%m-%dT%H:%M:%S"
+    if "." in value:
+        fmt += ".%f"
+    if re.search(r"[+-]\d{4}$", value):
+        fmt += "%z"
+    return datetime.datetime.strptime(value, fmt)
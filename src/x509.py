@@ -0,0 +1,198 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""X.509 certificate fields, as reported by the openssl command.
+
+This extracts the handful of fields the charm needs from a certificate
+without depending on a cryptography library, which isn't available in
+the charm's environment. The fields are read from the output of
+"openssl x509 -text", which differs in small ways between openssl
+releases.
+"""
+
+import datetime
+import re
+import subprocess
+from typing import List, Optional
+
+# Number of seconds after which openssl is killed.
+OPENSSL_TIMEOUT = 30
+
+# Elliptic curves certbot supports, by their openssl names.
+CURVES = {
+    "prime256v1": "secp256r1",
+    "secp384r1": "secp384r1",
+    "secp521r1": "secp521r1",
+}
+
+KEY_TYPES = {
+    "rsaEncryption": "rsa",
+    "id-ecPublicKey": "ecdsa",
+    "ED25519": "ed25519",
+}
+
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+_PEM_RE = re.compile(rb"-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n?", re.DOTALL)
+
+
+class CertificateError(ValueError):
+    """Raised when a certificate cannot be read."""
+    pass
+
+
+def openssl(args: List[str], input: str = None,
+            timeout: float = OPENSSL_TIMEOUT) -> subprocess.CompletedProcess:
+    """Run an openssl command.
+
+    Unlike subprocess.run with check, output is returned whatever the
+    exit status, as openssl reports some failures after its results.
+
+    Returns:
+        The completed process, with its output decoded.
+
+    Raises:
+        OSError: openssl cannot be run.
+        subprocess.TimeoutExpired: openssl did not finish in time.
+    """
+    with subprocess.Popen(["openssl"] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True) as proc:
+        try:
+            stdout, stderr = proc.communicate(input, timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            raise
+    return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+
+def decode_time(text: str) -> datetime.datetime:
+    """Decode a time as printed by openssl, e.g. "Jun  1 12:00:00 2020 GMT"."""
+    try:
+        month, day, clock, year, zone = text.split()
+        if zone != "GMT":
+            raise ValueError("unexpected time zone " + zone)
+        hour, minute, second = clock.split(":")
+        return datetime.datetime(int(year), _MONTHS.index(month) + 1, int(day), int(hour),
+                                 int(minute), int(second), tzinfo=datetime.timezone.utc)
+    except ValueError as err:
+        raise CertificateError("invalid time {}: {}".format(text, err))
+
+
+def pem_certificates(pem: bytes) -> List[bytes]:
+    """Split PEM data into its certificates."""
+    return [m.group(0) for m in _PEM_RE.finditer(pem)]
+
+
+class Certificate:
+    """An X.509 certificate.
+
+    Attributes:
+        pem: The PEM encoded certificate.
+        serial: Serial number.
+        not_before: Start of the validity period.
+        not_after: End of the validity period.
+        common_name: Common name of the subject, if any.
+        sans: DNS subject alternative names.
+        key_type: Public key type, "rsa", "ecdsa", "ed25519" or
+          openssl's name of the algorithm if the type is not known.
+        key_size: RSA modulus size in bits, or None.
+        curve: Elliptic curve name, or None.
+        ocsp_urls: URLs of the issuer's OCSP responders.
+        authority_key_id: Key identifier of the issuer's key, or None.
+    """
+
+    def __init__(self, pem: bytes):
+        self.pem = pem
+        try:
+            proc = openssl(["x509", "-noout", "-serial", "-startdate", "-enddate", "-ocsp_uri",
+                            "-nameopt", "RFC2253", "-text"], pem.decode("ascii"))
+        except (OSError, subprocess.TimeoutExpired, UnicodeDecodeError) as err:
+            raise CertificateError("cannot read certificate: {}".format(err))
+        if proc.returncode != 0:
+            raise CertificateError("invalid certificate: {}".format(
+                (proc.stderr.strip().splitlines() or ["openssl failed"])[0]))
+        self._parse(proc.stdout)
+
+    @classmethod
+    def from_pem(cls, pem: bytes) -> "Certificate":
+        """Read the first certificate in PEM data."""
+        certs = pem_certificates(pem)
+        if not certs:
+            raise CertificateError("no certificate found")
+        return cls(certs[0])
+
+    def _parse(self, output: str):
+        # The fields asked for come first, one per line, then the text.
+        head, sep, text = output.partition("Certificate:\n")
+        if not sep:
+            raise CertificateError("unexpected openssl output")
+        fields = {}
+        self.ocsp_urls = []
+        for line in head.splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key in ("serial", "notBefore", "notAfter"):
+                fields[key] = value
+            elif line:
+                self.ocsp_urls.append(line)
+        try:
+            self.serial = int(fields["serial"], 16)
+            self.not_before = decode_time(fields["notBefore"])
+            self.not_after = decode_time(fields["notAfter"])
+        except (KeyError, ValueError) as err:
+            raise CertificateError("unexpected openssl output: {}".format(err))
+
+        subject = re.search(r"^\s*Subject: (.*)$", text, re.MULTILINE)
+        cn = subject and re.search(r"(?:^|,)CN=((?:[^,\\]|\\.)*)", subject.group(1))
+        self.common_name = cn.group(1) if cn else None
+
+        algorithm = re.search(r"Public Key Algorithm: (\S+)", text)
+        algorithm = algorithm.group(1) if algorithm else ""
+        self.key_type = KEY_TYPES.get(algorithm, algorithm)
+        self.key_size = None
+        self.curve = None
+        if self.key_type == "rsa":
+            # "RSA Public-Key" before openssl 3.0.
+            size = re.search(r"Public-Key: \((\d+) bit\)", text)
+            self.key_size = int(size.group(1)) if size else None
+        elif self.key_type == "ecdsa":
+            curve = re.search(r"ASN1 OID: (\S+)", text)
+            if curve:
+                self.curve = CURVES.get(curve.group(1), curve.group(1))
+
+        sans = _extension(text, "X509v3 Subject Alternative Name")
+        self.sans = [n.strip()[4:] for n in (sans or "").split(",")
+                     if n.strip().startswith("DNS:")]
+
+        self.authority_key_id = None
+        aki = _extension(text, "X509v3 Authority Key Identifier")
+        if aki:
+            # "keyid:" prefixes the identifier before openssl 3.0.
+            keyid = aki.split("\n")[0].strip()
+            if keyid.startswith("keyid:"):
+                keyid = keyid[len("keyid:"):]
+            try:
+                self.authority_key_id = bytes.fromhex(keyid.replace(":", ""))
+            except ValueError:
+                pass
+
+    @property
+    def domains(self) -> List[str]:
+        """All the names in the certificate, common name first."""
+        names = [self.common_name] if self.common_name else []
+        return names + [n for n in self.sans if n not in names]
+
+
+def _extension(text: str, name: str) -> Optional[str]:
+    """Find the value of an extension in "openssl x509 -text" output.
+
+    The value is indented on the lines after the extension's name.
+    """
+    match = re.search(r"^( *){}:(?: critical)?\s*\n((?:\1 +\S.*\n?)+)".format(re.escape(name)),
+                      text, re.MULTILINE)
+    return match.group(2) if match else None
+
+
+def parse_pem_file(path: str) -> Certificate:
+    """Read the first certificate in a PEM file."""
+    with open(path, "rb") as f:
+        return Certificate.from_pem(f.read())
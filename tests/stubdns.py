@@ -0,0 +1,66 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A stub DNS server for testing."""
+
+import socket
+import threading
+
+import dnsquery
+
+
+class StubDNSServer:
+    """A UDP DNS server that answers from a table of records.
+
+    Queries for names with no matching records are answered with the
+    SOA of the closest enclosing zone in the authority section. The
+    handle attribute may be replaced to customise responses.
+    """
+
+    def __init__(self, records=()):
+        self.records = list(records)
+        self.queries = []
+        self.handle = self.answer
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.05)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+
+    def answer(self, message):
+        name, rtype, _ = message.question[0]
+        response = dnsquery.Message(message.id, dnsquery.QR | dnsquery.AA, message.question)
+        response.answer = [r for r in self.records
+                           if r.name.lower() == name.lower() and r.type == rtype]
+        if not response.answer:
+            labels = name.lower().split(".")
+            for i in range(len(labels)):
+                zone = ".".join(labels[i:])
+                soa = [r for r in self.records
+                       if r.name.lower() == zone and r.type == dnsquery.SOA]
+                if soa:
+                    response.authority = soa
+                    break
+        return response
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self._sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            message = dnsquery.Message.from_wire(data)
+            self.queries.append(message)
+            response = self.handle(message)
+            if response is not None:
+                self._sock.sendto(response.to_wire(), addr)
@@ -0,0 +1,116 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+"""A stub certificate authority and OCSP responder for testing.
+
+The certificates and signed OCSP responses are made with the openssl
+command line tool.
+"""
+
+import http.server
+import os
+import subprocess
+import threading
+
+# Tests of code that runs commands replace subprocess.run.
+_run = subprocess.run
+
+
+class StubCA:
+    """A CA issuing ECDSA certificates that name an OCSP responder."""
+
+    def __init__(self, dir, ocsp_url):
+        self.dir = dir
+        self.ocsp_url = ocsp_url
+        self.revoked = set()
+        self._issued = []
+        self.pem = self._path("ca.pem")
+        self._openssl("req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256",
+                      "-nodes", "-keyout", self._path("ca.key"), "-out", self.pem,
+                      "-subj", "/CN=Stub CA", "-days", "30")
+
+    def issue(self, name, serial):
+        """Issue a certificate for name.
+
+        Returns:
+            The PEM encoded certificate and its chain.
+        """
+        key, csr = self._path(name + ".key"), self._path(name + ".csr")
+        ext, cert = self._path(name + ".ext"), self._path(name + ".pem")
+        self._openssl("req", "-new", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256",
+                      "-nodes", "-keyout", key, "-out", csr, "-subj", "/CN=" + name)
+        with open(ext, "w") as f:
+            f.write("subjectAltName=DNS:{}\nauthorityInfoAccess=OCSP;URI:{}\n".format(
+                name, self.ocsp_url))
+        self._openssl("x509", "-req", "-in", csr, "-CA", self.pem, "-CAkey", self._path("ca.key"),
+                      "-set_serial", str(serial), "-days", "10", "-extfile", ext, "-out", cert)
+        self._issued.append((serial, name))
+        with open(cert, "rb") as f, open(self.pem, "rb") as g:
+            return f.read(), g.read()
+
+    def respond(self, request, minutes):
+        """Sign the response to a DER encoded OCSP request."""
+        with open(self._path("index.txt"), "w") as f:
+            for serial, name in self._issued:
+                revoked = "260101000000Z" if serial in self.revoked else ""
+                f.write("{}\t491231235959Z\t{}\t{:X}\tunknown\t/CN={}\n".format(
+                    "R" if revoked else "V", revoked, serial, name))
+        with open(self._path("request.der"), "wb") as f:
+            f.write(request)
+        self._openssl("ocsp", "-index", self._path("index.txt"), "-CA", self.pem,
+                      "-rsigner", self.pem, "-rkey", self._path("ca.key"),
+                      "-reqin", self._path("request.der"), "-respout", self._path("response.der"),
+                      "-nmin", str(minutes))
+        with open(self._path("response.der"), "rb") as f:
+            return f.read()
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _openssl(self, *args):
+        _run(("openssl",) + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+
+class StubOCSPResponder:
+    """An HTTP OCSP responder for the certificates of a StubCA.
+
+    Attributes:
+        ca: The CA.
+        minutes: Validity period of the responses.
+        requests: The DER encoded requests received.
+        fail: Answer requests with an HTTP error.
+    """
+
+    def __init__(self, dir):
+        self.minutes = 60
+        self.requests = []
+        self.fail = False
+        responder = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = self.rfile.read(int(self.headers["Content-Length"]))
+                responder.requests.append(request)
+                if responder.fail:
+                    self.send_error(503)
+                    return
+                body = responder.ca.respond(request, responder.minutes)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/ocsp-response")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.01,),
+                                        daemon=True)
+        self._thread.start()
+        self.ca = StubCA(dir, "http://127.0.0.1:{}/".format(self._server.server_port))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,173 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import http.server
+import json
+import os
+import tempfile
+import threading
+import types
+import unittest
+
+import ari
+import x509
+from tests.stubocsp import StubCA
+
+UTC = datetime.timezone.utc
+
+
+class StubACME(http.server.BaseHTTPRequestHandler):
+    """An ACME server's directory and renewalInfo endpoint.
+
+    The windows are keyed by certificate ID, windows of other
+    certificates are not found.
+    """
+
+    windows = {}
+    retry_after = "21600"
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        base = "http://127.0.0.1:{}".format(self.server.server_port)
+        if self.path == "/dir":
+            body = {"newOrder": base + "/new-order", "renewalInfo": base + "/renewal-info/"}
+        elif self.path == "/old-dir":
+            body = {"newOrder": base + "/new-order"}
+        elif self.path.startswith("/renewal-info/") and self.path[14:] in self.windows:
+            start, end = self.windows[self.path[14:]]
+            body = {"suggestedWindow": {"start": start, "end": end},
+                    "explanationURL": "https://example.com/incident"}
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if self.path.startswith("/renewal-info/"):
+            self.send_header("Retry-After", self.retry_after)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestARI(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        StubACME.windows = {}
+        StubACME.paths = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), StubACME)
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.addCleanup(ari._renewal_info_urls.clear)
+
+    def test_cert_id(self):
+        # The example from RFC 9773.
+        cert = types.SimpleNamespace(
+            authority_key_id=bytes.fromhex("69885B6B87464041E1B37B847BA0AE2CDE01C8D4"),
+            serial=0x0087654321)
+        self.assertEqual(ari.cert_id(cert), "aYhba4dGQEHhs3uEe6CuLN4ByNQ.AIdlQyE")
+        with self.assertRaises(ari.ARIError):
+            ari.cert_id(types.SimpleNamespace(authority_key_id=None, serial=1))
+
+    def test_fetch(self):
+        pem, _ = StubCA(self.dir, "http://127.0.0.1/").issue("example.com", 0x1234)
+        cert = x509.Certificate.from_pem(pem)
+        StubACME.windows[ari.cert_id(cert)] = (
+            "2026-01-01T00:00:00Z", "2026-01-03T00:00:00.123456789Z")
+        window = ari.fetch(self.base + "/dir", cert)
+        self.assertEqual(window.start, datetime.datetime(2026, 1, 1, tzinfo=UTC))
+        self.assertEqual(window.end, datetime.datetime(2026, 1, 3, 0, 0, 0, 123456, tzinfo=UTC))
+        self.assertEqual(window.retry_after, datetime.timedelta(hours=6))
+        self.assertEqual(window.explanation, "https://example.com/incident")
+
+        # The directory is only fetched once.
+        ari.fetch(self.base + "/dir", cert)
+        self.assertEqual(StubACME.paths.count("/dir"), 1)
+
+        other, _ = StubCA(self.dir, "http://127.0.0.1/").issue("other.example.com", 0x5678)
+        with self.assertRaises(OSError):
+            ari.fetch(self.base + "/dir", x509.Certificate.from_pem(other))
+        with self.assertRaises(ari.ARIError):
+            ari.fetch(self.base + "/old-dir", cert)
+
+    def test_parse_time(self):
+        self.assertEqual(ari._parse_time("2026-01-02T03:04:05Z"),
+                         datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=UTC))
+        self.assertEqual(ari._parse_time("2026-01-02t03:04:05.5+01:00"),
+                         datetime.datetime(2026, 1, 2, 2, 4, 5, 500000, tzinfo=UTC))
+        self.assertEqual(ari._parse_time("2026-01-02 03:04:05.123456789z"),
+                         datetime.datetime(2026, 1, 2, 3, 4, 5, 123456, tzinfo=UTC))
+        with self.assertRaises(ValueError):
+            ari._parse_time("2026-01-02T03:04:05")
+
+    def test_parse_retry_after(self):
+        now = datetime.datetime(2026, 1, 1, tzinfo=UTC)
+        self.assertEqual(ari.parse_retry_after("7200", now), datetime.timedelta(hours=2))
+        self.assertEqual(ari.parse_retry_after("Thu, 01 Jan 2026 03:00:00 GMT", now),
+                         datetime.timedelta(hours=3))
+        self.assertEqual(ari.parse_retry_after("5", now), ari.MIN_RETRY)
+        self.assertEqual(ari.parse_retry_after("9999999", now), ari.MAX_RETRY)
+        self.assertEqual(ari.parse_retry_after(None, now), ari.DEFAULT_RETRY)
+        self.assertEqual(ari.parse_retry_after("soon", now), ari.DEFAULT_RETRY)
+
+    def test_lineage_directory(self):
+        os.mkdir(os.path.join(self.dir, "renewal"))
+        with open(os.path.join(self.dir, "renewal", "example.com.conf"), "w") as f:
+            f.write("version = 1.21.0\narchive_dir = /etc/letsencrypt/archive/example.com\n\n"
+                    "[renewalparams]\nauthenticator = dns-google\n"
+                    "server = https://acme-staging-v02.api.letsencrypt.org/directory\n")
+        self.assertEqual(ari.lineage_directory(self.dir, "example.com"),
+                         "https://acme-staging-v02.api.letsencrypt.org/directory")
+        self.assertEqual(ari.lineage_directory(self.dir, "pooled.example.com"),
+                         ari.DEFAULT_DIRECTORY)
+
+
+class TestRenewalInfo(unittest.TestCase):
+    def test_cache(self):
+        now = datetime.datetime(2026, 1, 1, tzinfo=UTC)
+        day = datetime.timedelta(days=1)
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "renewal-info.json")
+            info = ari.RenewalInfo(path, rand=lambda: 0.25)
+            self.assertTrue(info.stale("example.com", "1234", now))
+            self.assertIsNone(info.renew_at("example.com", "1234"))
+
+            window = ari.Window(now + 20 * day, now + 24 * day, datetime.timedelta(hours=6))
+            info.update("example.com", "1234", window, now)
+            self.assertEqual(info.renew_at("example.com", "1234"), now + 21 * day)
+            self.assertFalse(info.stale("example.com", "1234", now))
+            self.assertTrue(info.stale("example.com", "1234", now + datetime.timedelta(hours=6)))
+            # A renewed certificate needs its own window.
+            self.assertTrue(info.stale("example.com", "5678", now))
+            self.assertIsNone(info.renew_at("example.com", "5678"))
+
+            # The renewal time is chosen once per window.
+            info.save()
+            info = ari.RenewalInfo(path, rand=lambda: 0.75)
+            self.assertEqual(info.renew_at("example.com", "1234"), now + 21 * day)
+            info.update("example.com", "1234", window, now + datetime.timedelta(hours=6))
+            self.assertEqual(info.renew_at("example.com", "1234"), now + 21 * day)
+
+            # An early renewal moves the window.
+            info.update("example.com", "1234", ari.Window(now, now + 2 * day), now)
+            self.assertEqual(info.renew_at("example.com", "1234"), now + 1.5 * day)
+
+            # A failed fetch keeps the window and tries again later.
+            info.failed("example.com", "1234", now)
+            self.assertEqual(info.renew_at("example.com", "1234"), now + 1.5 * day)
+            self.assertFalse(info.stale("example.com", "1234", now))
+            self.assertTrue(info.stale("example.com", "1234", now + ari.ERROR_RETRY))
+
+            info.update("other.example.com", "1", window, now)
+            info.retain(["other.example.com"])
+            info.save()
+            info = ari.RenewalInfo(path)
+            self.assertIsNone(info.renew_at("example.com", "1234"))
+            self.assertEqual(info.renew_at("other.example.com", "1"), now + 23 * day)
@@ -0,0 +1,61 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import backoff
+
+NOW = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestBackoff(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(backoff.key("dns-google", "example.com", "cred"),
+                         backoff.key("dns-google", "example.com", "cred"))
+        self.assertNotEqual(backoff.key("dns-google", "example.com", "cred"),
+                            backoff.key("dns-google", "example.com", "other"))
+        self.assertNotIn("cred", backoff.key("dns-google", "example.com", "cred"))
+
+    def test_failure_cache(self):
+        with tempfile.TemporaryDirectory() as dir:
+            cache = backoff.FailureCache(os.path.join(dir, "failures.json"))
+            self.assertFalse(cache.has_failures())
+            self.assertIsNone(cache.retry_at("a", NOW))
+            record = cache.failed("a", NOW)
+            self.assertEqual(record["failures"], 1)
+            self.assertEqual(cache.retry_at("a", NOW), NOW + datetime.timedelta(minutes=5))
+            self.assertIsNone(cache.retry_at("b", NOW))
+            self.assertIsNone(cache.retry_at("a", NOW + datetime.timedelta(minutes=5)))
+
+            cache.failed("a", NOW)
+            self.assertEqual(cache.retry_at("a", NOW), NOW + datetime.timedelta(minutes=10))
+            for _ in range(20):
+                cache.failed("a", NOW)
+            self.assertEqual(cache.failures("a"), 22)
+            self.assertEqual(cache.retry_at("a", NOW), NOW + datetime.timedelta(days=1))
+
+            cache.failed("b", NOW)
+            self.assertEqual(cache.waiting(NOW), {"a", "b"})
+            self.assertEqual(cache.waiting(NOW + datetime.timedelta(hours=1)), {"a"})
+            cache.clear("b")
+            self.assertEqual(cache.waiting(NOW), {"a"})
+
+            self.assertTrue(cache.has_failures())
+            cache.clear()
+            self.assertFalse(cache.has_failures())
+            self.assertIsNone(cache.retry_at("a", NOW))
+
+    def test_defer(self):
+        with tempfile.TemporaryDirectory() as dir:
+            cache = backoff.FailureCache(os.path.join(dir, "failures.json"))
+            until = NOW + datetime.timedelta(hours=3)
+            cache.defer("a", until, NOW)
+            self.assertEqual(cache.retry_at("a", NOW), until)
+            self.assertEqual(cache.failures("a"), 0)
+            self.assertTrue(cache.has_failures())
+            cache.failed("a", NOW)
+            cache.defer("a", until, NOW)
+            self.assertEqual(cache.failures("a"), 1)
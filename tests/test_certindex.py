@@ -0,0 +1,90 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import certindex
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def _write_lineage(live_dir, name, pem):
+    os.makedirs(os.path.join(live_dir, name), exist_ok=True)
+    for kind in ("cert", "chain", "fullchain", "privkey"):
+        shutil.copyfile(os.path.join(DATA, pem), os.path.join(live_dir, name, kind + ".pem"))
+
+
+class TestCertificateIndex(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.live = os.path.join(tmp.name, "live")
+        os.mkdir(self.live)
+        with open(os.path.join(self.live, "README"), "w") as f:
+            f.write("README")
+        self.path = os.path.join(tmp.name, "index.json")
+        self.index = certindex.CertificateIndex(self.path, self.live)
+
+    def test_refresh(self):
+        _write_lineage(self.live, "example.com", "rsa.pem")
+        _write_lineage(self.live, "ec.example.com", "ec.pem")
+        entries = self.index.refresh()
+        self.assertEqual([e["name"] for e in entries], ["ec.example.com", "example.com"])
+        self.assertEqual(entries[0]["domains"], ["ec.example.com", "*.ec.example.com"])
+        self.assertEqual(entries[0]["not-after"], "2026-11-15T20:51:21+00:00")
+        self.assertEqual(entries[0]["serial"], "7")
+        self.assertEqual(entries[0]["key-type"], "ecdsa")
+        self.assertEqual(entries[0]["curve"], "secp256r1")
+        self.assertEqual(entries[1]["serial"], "1234abcd")
+        self.assertEqual(entries[1]["key-size"], 2048)
+        self.assertEqual(certindex.soonest_expiry(entries)["name"], "ec.example.com")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_refresh_incremental(self):
+        _write_lineage(self.live, "example.com", "rsa.pem")
+        _write_lineage(self.live, "ec.example.com", "ec.pem")
+        self.index.refresh()
+        with patch("x509.parse_pem_file") as parse:
+            self.index.refresh()
+            parse.assert_not_called()
+
+        os.unlink(os.path.join(self.live, "example.com", "cert.pem"))
+        shutil.copyfile(os.path.join(DATA, "ec.pem"),
+                        os.path.join(self.live, "example.com", "cert.pem"))
+        with patch("x509.parse_pem_file", wraps=certindex.x509.parse_pem_file) as parse:
+            entries = self.index.refresh()
+            parse.assert_called_once_with(os.path.join(self.live, "example.com", "cert.pem"))
+        self.assertEqual(entries[1]["key-type"], "ecdsa")
+
+    def test_refresh_removed(self):
+        _write_lineage(self.live, "example.com", "rsa.pem")
+        _write_lineage(self.live, "ec.example.com", "ec.pem")
+        self.index.refresh()
+        shutil.rmtree(os.path.join(self.live, "example.com"))
+        self.assertEqual([e["name"] for e in self.index.refresh()], ["ec.example.com"])
+        self.assertEqual(list(certindex.state.load_json(self.path)), ["ec.example.com"])
+
+    def test_refresh_invalid(self):
+        _write_lineage(self.live, "example.com", "rsa.pem")
+        with open(os.path.join(self.live, "example.com", "cert.pem"), "w") as f:
+            f.write("garbage")
+        self.assertEqual(self.index.refresh(), [])
+
+    def test_refresh_no_live_dir(self):
+        index = certindex.CertificateIndex(self.path, os.path.join(self.live, "missing"))
+        self.assertEqual(index.refresh(), [])
+        self.assertIsNone(certindex.soonest_expiry([]))
+
+    def test_key_params(self):
+        _write_lineage(self.live, "example.com", "rsa.pem")
+        _write_lineage(self.live, "ec.example.com", "ec.pem")
+        entries = self.index.refresh()
+        self.assertEqual(certindex.key_params(entries[0]),
+                         {"key-type": "ecdsa", "elliptic-curve": "secp256r1"})
+        self.assertEqual(certindex.key_params(entries[1]),
+                         {"key-type": "rsa", "rsa-key-size": 2048})
+        self.assertEqual(certindex.key_params({"key-type": "ed25519"}), {})
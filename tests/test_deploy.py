@@ -2,13 +2,16 @@
 # See LICENSE file for licensing details.
 
 import configparser
+import datetime
 import os
+import shutil
 import subprocess
 import tempfile
 import unittest
-from unittest.mock import Mock
+from unittest.mock import patch
 
 import deploy
+from tests.stubocsp import StubOCSPResponder
 
 
 class TestDeploy(unittest.TestCase):
@@ -125,9 +128,9 @@ class TestDeploy(unittest.TestCase):
                 config.write(f)
 
             d = deploy.Deploy(os.path.join(dir, "example.com"), configfile)
-            subprocess.run = Mock()
-            d.run()
-            subprocess.run.assert_called_once_with("echo 'OK!'", shell=True)
+            with patch("subprocess.run") as run:
+                d.run()
+            run.assert_called_once_with("echo 'OK!'", shell=True)
 
     def test_deploy_command_error(self):
         with tempfile.TemporaryDirectory() as dir:
@@ -144,6 +147,269 @@ class TestDeploy(unittest.TestCase):
                 config.write(f)
 
             d = deploy.Deploy(os.path.join(dir, "example.com"), configfile)
-            subprocess.run = Mock(side_effect=subprocess.CalledProcessError(1, "test"))
-            d.run()
-            subprocess.run.assert_called_once_with("echo 'OK!'", shell=True)
+            with patch("subprocess.run",
+                       side_effect=subprocess.CalledProcessError(1, "test")) as run:
+                self.assertFalse(d.run())
+            run.assert_called_once_with("echo 'OK!'", shell=True)
+
+    def test_deploy_command_status(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            with patch("subprocess.run", return_value=subprocess.CompletedProcess([], 2)):
+                self.assertFalse(deploy.Deploy(os.path.join(dir, "example.com"), configfile).run())
+            # Unchanged targets don't run the command, so can't fail.
+            with patch("subprocess.run", return_value=subprocess.CompletedProcess([], 2)):
+                self.assertTrue(deploy.Deploy(os.path.join(dir, "example.com"), configfile).run())
+
+    def test_coalesce(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            config = configparser.ConfigParser()
+            config.read(configfile)
+            config["deploy"]["coalesce"] = "true"
+            with open(configfile, "w") as f:
+                config.write(f)
+            os.mkdir(os.path.join(dir, "other.example.com"))
+            for name in ("cert.pem", "chain.pem", "fullchain.pem", "privkey.pem"):
+                with open(os.path.join(dir, "other.example.com", name), "w") as f:
+                    f.write("OTHER\n")
+
+            with patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0)) as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                deploy.Deploy(os.path.join(dir, "other.example.com"), configfile).run()
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_not_called()
+                with open(os.path.join(dir, "dest", "key")) as f:
+                    self.assertEqual(f.read(), "KEY\n")
+
+                deploy.run_pending(configfile)
+                run.assert_called_once()
+                self.assertEqual(run.call_args[0], ("echo 'OK!'",))
+                self.assertEqual(run.call_args[1]["env"]["CERTBOT_CHARM_DOMAINS"],
+                                 "example.com other.example.com")
+
+                run.reset_mock()
+                deploy.run_pending(configfile)
+                run.assert_not_called()
+            self.assertEqual(sorted(os.listdir(dir)), [
+                "config.ini", "dest", "example.com", "other.example.com"])
+
+    def test_coalesce_command_failure(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            pending = os.path.join(dir, "deploy-pending")
+            with open(pending, "w") as f:
+                f.write("example.com\n")
+            failed = subprocess.CompletedProcess([], 1)
+            with patch("subprocess.run", return_value=failed) as run:
+                self.assertFalse(deploy.run_pending(configfile))
+            with open(pending + ".processing") as f:
+                self.assertEqual(f.read(), "example.com\n")
+
+            # Deployments recorded meanwhile are merged with the failed ones.
+            with open(pending, "w") as f:
+                f.write("other.example.com\n")
+            with patch("subprocess.run", return_value=failed) as run:
+                self.assertFalse(deploy.run_pending(configfile))
+            with open(pending + ".processing") as f:
+                self.assertEqual(f.read(), "example.com\nother.example.com\n")
+
+            with patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0)) as run:
+                self.assertTrue(deploy.run_pending(configfile))
+            self.assertEqual(run.call_args[1]["env"]["CERTBOT_CHARM_DOMAINS"],
+                             "example.com other.example.com")
+            self.assertFalse(os.path.exists(pending + ".processing"))
+            with patch("subprocess.run") as run:
+                self.assertTrue(deploy.run_pending(configfile))
+            run.assert_not_called()
+
+    def _setup_lineage(self, dir, command="echo 'OK!'"):
+        os.mkdir(os.path.join(dir, "example.com"))
+        os.mkdir(os.path.join(dir, "dest"))
+        configfile = os.path.join(dir, "config.ini")
+        config = configparser.ConfigParser()
+        config.add_section("deploy")
+        config["DEFAULT"]["cert-path"] = os.path.join(dir, "dest")
+        config["DEFAULT"]["chain-path"] = ""
+        config["DEFAULT"]["combined-path"] = os.path.join(dir, "dest")
+        config["DEFAULT"]["fullchain-path"] = ""
+        config["DEFAULT"]["key-path"] = os.path.join(dir, "dest", "key")
+        config["deploy"]["command"] = command
+        with open(configfile, "w") as f:
+            config.write(f)
+        for name, content in (("cert.pem", "CERTIFICATE\n"), ("chain.pem", "CHAIN\n"),
+                              ("fullchain.pem", "FULLCHAIN\n"), ("privkey.pem", "KEY\n")):
+            with open(os.path.join(dir, "example.com", name), "w") as f:
+                f.write(content)
+        return configfile
+
+    def test_skip_unchanged(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            with patch("subprocess.run") as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_called_once_with("echo 'OK!'", shell=True)
+            inode = os.stat(os.path.join(dir, "dest", "example.com.pem")).st_ino
+
+            with patch("subprocess.run") as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_not_called()
+            self.assertEqual(os.stat(os.path.join(dir, "dest", "example.com.pem")).st_ino, inode)
+
+    def test_deploy_changed(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            os.chmod(os.path.join(dir, "dest"), 0o755)
+            with open(os.path.join(dir, "dest", "key"), "w") as f:
+                f.write("OLD KEY\n")
+            os.chmod(os.path.join(dir, "dest", "key"), 0o640)
+            with open(os.path.join(dir, "dest", "example.com.crt"), "w") as f:
+                f.write("CERTIFICATE\n")
+
+            with patch("subprocess.run") as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_called_once_with("echo 'OK!'", shell=True)
+            with open(os.path.join(dir, "dest", "key")) as f:
+                self.assertEqual(f.read(), "KEY\n")
+            self.assertEqual(os.stat(os.path.join(dir, "dest", "key")).st_mode & 0o777, 0o640)
+            with open(os.path.join(dir, "dest", "example.com.pem")) as f:
+                self.assertEqual(f.read(), "FULLCHAIN\nKEY\n")
+            self.assertEqual(
+                os.stat(os.path.join(dir, "dest", "example.com.pem")).st_mode & 0o777, 0o600)
+            self.assertEqual(sorted(os.listdir(os.path.join(dir, "dest"))),
+                             ["example.com.crt", "example.com.pem", "key"])
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            textfile = os.path.join(dir, "certbot.prom")
+            config = configparser.ConfigParser()
+            config.read(configfile)
+            config["metrics"] = {"textfile": textfile}
+            with open(configfile, "w") as f:
+                config.write(f)
+            shutil.copy(os.path.join(os.path.dirname(__file__), "data", "rsa.pem"),
+                        os.path.join(dir, "example.com", "cert.pem"))
+
+            with patch("subprocess.run", return_value=subprocess.CompletedProcess([], 1)):
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+            with open(textfile) as f:
+                text = f.read()
+        self.assertIn('certbot_certificate_expiry_timestamp_seconds{domain="example.com"} '
+                      '2107543881.0\n', text)
+        self.assertIn('certbot_deploy_command_runs_total{result="success"} 0\n', text)
+        self.assertIn('certbot_deploy_command_runs_total{result="failure"} 1\n', text)
+
+    def test_key_type_suffix(self):
+        with tempfile.TemporaryDirectory() as dir:
+            configfile = self._setup_lineage(dir)
+            config = configparser.ConfigParser()
+            config.read(configfile)
+            config["deploy"]["key-type-suffix"] = "true"
+            with open(configfile, "w") as f:
+                config.write(f)
+            shutil.copytree(os.path.join(dir, "example.com"), os.path.join(dir, "example.com-rsa"))
+            data = os.path.join(os.path.dirname(__file__), "data")
+            shutil.copy(os.path.join(data, "ec.pem"), os.path.join(dir, "example.com", "cert.pem"))
+            shutil.copy(os.path.join(data, "rsa.pem"),
+                        os.path.join(dir, "example.com-rsa", "cert.pem"))
+
+            with patch("subprocess.run",
+                       return_value=subprocess.CompletedProcess([], 0)) as run:
+                self.assertTrue(deploy.Deploy(os.path.join(dir, "example.com"), configfile).run())
+                self.assertTrue(
+                    deploy.Deploy(os.path.join(dir, "example.com-rsa"), configfile).run())
+                self.assertEqual(run.call_count, 2)
+            self.assertEqual(sorted(os.listdir(os.path.join(dir, "dest"))), [
+                "example.com.crt.ecdsa", "example.com.crt.rsa", "example.com.pem.ecdsa",
+                "example.com.pem.rsa", "key.ecdsa", "key.rsa"])
+
+            # Without a readable certificate the targets are unknown.
+            os.unlink(os.path.join(dir, "example.com", "cert.pem"))
+            self.assertFalse(deploy.Deploy(os.path.join(dir, "example.com"), configfile).run())
+
+    def _setup_ocsp(self, dir):
+        os.mkdir(os.path.join(dir, "ca"))
+        responder = StubOCSPResponder(os.path.join(dir, "ca"))
+        self.addCleanup(responder.close)
+        configfile = self._setup_lineage(dir)
+        config = configparser.ConfigParser()
+        config.read(configfile)
+        config["DEFAULT"]["ocsp-path"] = os.path.join(dir, "dest")
+        with open(configfile, "w") as f:
+            config.write(f)
+        cert, chain = responder.ca.issue("example.com", 0x1234)
+        with open(os.path.join(dir, "example.com", "cert.pem"), "wb") as f:
+            f.write(cert)
+        with open(os.path.join(dir, "example.com", "chain.pem"), "wb") as f:
+            f.write(chain)
+        return responder, configfile
+
+    def test_ocsp(self):
+        with tempfile.TemporaryDirectory() as dir:
+            responder, configfile = self._setup_ocsp(dir)
+            staple = os.path.join(dir, "dest", "example.com.pem.ocsp")
+            with patch("subprocess.run") as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_called_once_with("echo 'OK!'", shell=True)
+            self.assertEqual(len(responder.requests), 1)
+            with open(staple, "rb") as f:
+                der = f.read()
+            with open(os.path.join(dir, "ocsp", "example.com.der"), "rb") as f:
+                self.assertEqual(f.read(), der)
+            self.assertEqual(deploy.ocsp.parse_response(
+                der, os.path.join(dir, "example.com", "cert.pem"),
+                os.path.join(dir, "example.com", "chain.pem")).status, "good")
+
+            # The response is reused until it is due for refresh.
+            with patch("subprocess.run") as run:
+                deploy.Deploy(os.path.join(dir, "example.com"), configfile).run()
+                run.assert_not_called()
+            self.assertEqual(len(responder.requests), 1)
+
+    def test_refresh_ocsp(self):
+        with tempfile.TemporaryDirectory() as dir:
+            responder, configfile = self._setup_ocsp(dir)
+            lineage = os.path.join(dir, "example.com")
+            staple = os.path.join(dir, "dest", "example.com.pem.ocsp")
+            with patch("subprocess.run") as run:
+                deploy.Deploy(lineage, configfile).run()
+                self.assertTrue(deploy.refresh_ocsp([lineage], configfile))
+                run.assert_called_once()
+            self.assertEqual(len(responder.requests), 1)
+            with open(staple, "rb") as f:
+                old = f.read()
+
+            due = patch("ocsp.Response.refresh_at",
+                        return_value=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+            # A failed refresh keeps the current response until it expires.
+            responder.fail = True
+            with due, patch("subprocess.run") as run:
+                self.assertTrue(deploy.refresh_ocsp([lineage], configfile))
+                run.assert_not_called()
+            self.assertEqual(len(responder.requests), 2)
+            with open(staple, "rb") as f:
+                self.assertEqual(f.read(), old)
+
+            responder.fail = False
+            with due, patch("subprocess.run",
+                            return_value=subprocess.CompletedProcess([], 0)) as run:
+                self.assertTrue(deploy.refresh_ocsp([lineage], configfile))
+                run.assert_called_once()
+                self.assertEqual(run.call_args[0], ("echo 'OK!'",))
+                self.assertEqual(run.call_args[1]["env"]["CERTBOT_CHARM_DOMAINS"], "example.com")
+            self.assertEqual(len(responder.requests), 3)
+            with open(staple, "rb") as f:
+                self.assertNotEqual(f.read(), old)
+
+    def test_write_atomic_failure(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "target")
+            with open(path, "w") as f:
+                f.write("OLD")
+            with patch("os.replace", side_effect=OSError("failed")):
+                with self.assertRaises(OSError):
+                    deploy._write_atomic(path, b"NEW")
+            self.assertEqual(os.listdir(dir), ["target"])
+            with open(path) as f:
+                self.assertEqual(f.read(), "OLD")
@@ -0,0 +1,119 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import time
+import unittest
+
+import dnsquery
+from dnsquery import A, NS, SOA, TXT, Record
+from tests.stubdns import StubDNSServer
+
+ZONE = [
+    Record("example.com", SOA, ("ns1.example.com", "admin.example.com", 1, 2, 3, 4, 5)),
+    Record("example.com", NS, "ns1.example.com"),
+    Record("example.com", NS, "ns2.example.com"),
+    Record("ns1.example.com", A, "127.0.0.1"),
+    Record("ns2.example.com", A, "127.0.0.2"),
+]
+
+
+class TestMessage(unittest.TestCase):
+    def test_round_trip(self):
+        message = dnsquery.Message(
+            1234, dnsquery.QR | dnsquery.AA, [("example.com", TXT, dnsquery.IN)],
+            answer=[Record("example.com", TXT, "x" * 300, ttl=60)],
+            authority=ZONE[:3], additional=ZONE[3:])
+        decoded = dnsquery.Message.from_wire(message.to_wire())
+        self.assertEqual(decoded.id, 1234)
+        self.assertEqual(decoded.flags, dnsquery.QR | dnsquery.AA)
+        self.assertEqual(decoded.question, [("example.com", TXT, dnsquery.IN)])
+        self.assertEqual(decoded.answer, [Record("example.com", TXT, "x" * 300, ttl=60)])
+        self.assertEqual(decoded.authority, ZONE[:3])
+        self.assertEqual(decoded.additional, ZONE[3:])
+
+    def test_decode_compressed_name(self):
+        data = b"\x07example\x03com\x00\x03www\xc0\x00"
+        self.assertEqual(dnsquery.decode_name(data, 13), ("www.example.com", 19))
+
+    def test_decode_malformed(self):
+        with self.assertRaises(dnsquery.DNSError):
+            dnsquery.Message.from_wire(b"\x00\x01\x00\x00\x00\x01")
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.server = StubDNSServer(ZONE)
+        self.addCleanup(self.server.close)
+
+    def test_query(self):
+        response = dnsquery.query("example.com", NS, "127.0.0.1", self.server.port)
+        self.assertEqual([r.data for r in response.answer], ["ns1.example.com", "ns2.example.com"])
+        self.assertTrue(self.server.queries[0].flags & dnsquery.RD)
+
+    def test_find_zone(self):
+        self.assertEqual(dnsquery.find_zone("_acme-challenge.www.example.com", "127.0.0.1",
+                                            self.server.port), "example.com")
+
+    def test_authoritative_servers(self):
+        self.assertEqual(dnsquery.authoritative_servers("_acme-challenge.example.com",
+                                                        "127.0.0.1", self.server.port),
+                         ["127.0.0.1", "127.0.0.2"])
+
+    def test_no_response(self):
+        self.server.handle = lambda message: None
+        with self.assertRaises(dnsquery.DNSError):
+            dnsquery.query("example.com", NS, "127.0.0.1", self.server.port, timeout=0.1)
+
+    def test_resolvers(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "resolv.conf")
+            with open(path, "w") as f:
+                f.write("# comment\nnameserver 10.0.0.1\nsearch example.com\nnameserver ::1\n")
+            self.assertEqual(dnsquery.resolvers(path), ["10.0.0.1", "::1"])
+            self.assertEqual(dnsquery.resolvers(os.path.join(dir, "missing")), [])
+
+
+class TestWaitForTXT(unittest.TestCase):
+    def setUp(self):
+        # Both nameservers are served by the same stub.
+        self.server = StubDNSServer(ZONE[:3] + [Record("ns1.example.com", A, "127.0.0.1"),
+                                                Record("ns2.example.com", A, "127.0.0.1")])
+        self.addCleanup(self.server.close)
+
+    def test_propagated(self):
+        self.server.records.append(Record("_acme-challenge.example.com", TXT, "token"))
+        start = time.monotonic()
+        self.assertTrue(dnsquery.wait_for_txt([("_acme-challenge.example.com", "token")], 10,
+                                              "127.0.0.1", self.server.port, interval=0.01))
+        self.assertLess(time.monotonic() - start, 1)
+        txt = [m for m in self.server.queries if m.question[0][1] == TXT]
+        self.assertFalse(txt[0].flags & dnsquery.RD)
+
+    def test_delayed_propagation(self):
+        answer = self.server.answer
+
+        def handle(message):
+            if message.question[0][1] == TXT and len(self.server.queries) > 5:
+                self.server.records.append(Record("_acme-challenge.example.com", TXT, "token"))
+                self.server.handle = answer
+            return answer(message)
+
+        self.server.handle = handle
+        self.assertTrue(dnsquery.wait_for_txt([("_acme-challenge.example.com", "token")], 10,
+                                              "127.0.0.1", self.server.port, interval=0.01))
+        self.assertGreater(len(self.server.queries), 5)
+
+    def test_timeout(self):
+        self.server.records.append(Record("_acme-challenge.example.com", TXT, "other"))
+        start = time.monotonic()
+        self.assertFalse(dnsquery.wait_for_txt([("_acme-challenge.example.com", "token")], 0.2,
+                                               "127.0.0.1", self.server.port, interval=0.01))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_no_zone(self):
+        start = time.monotonic()
+        self.assertFalse(dnsquery.wait_for_txt([("_acme-challenge.example.org", "token")], 0.2,
+                                               "127.0.0.1", self.server.port, interval=0.01))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
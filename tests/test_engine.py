@@ -0,0 +1,114 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import configparser
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import engine
+
+FAKE_CERTBOT = '''
+import os
+import time
+
+
+def main(argv):
+    print("certbot output that must not corrupt the protocol")
+    if "--fail" in argv:
+        return "simulated failure"
+    if "--hang" in argv:
+        time.sleep(60)
+    if "--require-env" in argv and os.environ.get("FAKE_CERTBOT_ENV") != "set":
+        return "environment not set"
+    opts = dict(a[2:].split("=", 1) for a in argv if a.startswith("--") and "=" in a)
+    live = os.path.join(opts["config-dir"], "live", opts["cert-name"])
+    os.makedirs(live, exist_ok=True)
+    for name in ("cert", "chain", "fullchain", "privkey"):
+        with open(os.path.join(live, name + ".pem"), "w") as f:
+            f.write(name.upper() + "\\n")
+'''
+
+
+class TestCertbotWorker(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        os.mkdir(os.path.join(self.dir, "certbot"))
+        with open(os.path.join(self.dir, "certbot", "__init__.py"), "w") as f:
+            f.write("")
+        with open(os.path.join(self.dir, "certbot", "main.py"), "w") as f:
+            f.write(FAKE_CERTBOT)
+        os.mkdir(os.path.join(self.dir, "dest"))
+        self.configfile = os.path.join(self.dir, "config.ini")
+        config = configparser.ConfigParser()
+        config.add_section("deploy")
+        config["DEFAULT"]["cert-path"] = os.path.join(self.dir, "dest")
+        config["deploy"]["command"] = ""
+        with open(self.configfile, "w") as f:
+            config.write(f)
+
+        bindir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin")
+        pythonpath = os.pathsep.join([self.dir, os.environ.get("PYTHONPATH", "")])
+        patcher = patch.dict(os.environ, {"PYTHONPATH": pythonpath})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cmd = [sys.executable, os.path.join(bindir, "certbot_worker.py"),
+                    "--config={}".format(self.configfile)]
+        self.worker = engine.CertbotWorker(self.cmd)
+        self.addCleanup(self.worker.close)
+
+    def test_certbot_and_deploy(self):
+        config_dir = os.path.join(self.dir, "le")
+        for _ in range(2):
+            response = self.worker.certbot(["certonly", "--config-dir={}".format(config_dir),
+                                            "--cert-name=example.com"])
+            self.assertTrue(response["ok"])
+            self.assertIn("certbot-seconds", response)
+        response = self.worker.deploy(os.path.join(config_dir, "live", "example.com"))
+        self.assertIn("deploy-seconds", response)
+        with open(os.path.join(self.dir, "dest", "example.com.crt")) as f:
+            self.assertEqual(f.read(), "CERT\n")
+        self.assertTrue(self.worker.flush()["ok"])
+
+    def test_certbot_failure(self):
+        with self.assertRaises(engine.WorkerError) as cm:
+            self.worker.certbot(["certonly", "--fail"])
+        self.assertEqual(str(cm.exception), "simulated failure")
+        # The worker survives a failed request.
+        with self.assertRaises(engine.WorkerError) as cm:
+            self.worker.deploy(os.path.join(self.dir, "missing"))
+        self.assertTrue(str(cm.exception).startswith("FileNotFoundError: "))
+
+    def test_certbot_env(self):
+        config_dir = os.path.join(self.dir, "le")
+        args = ["certonly", "--require-env", "--config-dir={}".format(config_dir),
+                "--cert-name=example.com"]
+        self.assertTrue(self.worker.certbot(args, env={"FAKE_CERTBOT_ENV": "set"})["ok"])
+        # The environment only applies to the run it was given for.
+        with self.assertRaises(engine.WorkerError) as cm:
+            self.worker.certbot(args)
+        self.assertEqual(str(cm.exception), "environment not set")
+
+    def test_certbot_timeout(self):
+        worker = engine.CertbotWorker(self.cmd, {"certbot": 1.0})
+        self.addCleanup(worker.close)
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            worker.certbot(["certonly", "--hang"])
+        self.assertLess(time.monotonic() - start, 30)
+        # A new worker is started for the next request.
+        config_dir = os.path.join(self.dir, "le")
+        self.assertTrue(worker.certbot(["certonly", "--config-dir={}".format(config_dir),
+                                        "--cert-name=example.com"])["ok"])
+
+    def test_worker_exit(self):
+        worker = engine.CertbotWorker([sys.executable, "-c", "pass"])
+        with self.assertRaises(engine.WorkerError) as cm:
+            worker.certbot(["certonly"])
+        self.assertEqual(str(cm.exception), "certbot worker exited")
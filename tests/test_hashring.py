@@ -0,0 +1,42 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import collections
+import unittest
+
+from hashring import HashRing
+
+KEYS = ["site{}.example.com".format(i) for i in range(2000)]
+
+
+class TestHashRing(unittest.TestCase):
+    def test_owner(self):
+        ring = HashRing(["certbot/0", "certbot/1", "certbot/2"])
+        self.assertEqual(ring.nodes, ["certbot/0", "certbot/1", "certbot/2"])
+        owners = {key: ring.owner(key) for key in KEYS}
+        # Ownership only depends on the set of nodes.
+        other = HashRing(["certbot/2", "certbot/0", "certbot/1", "certbot/0"])
+        self.assertEqual(owners, {key: other.owner(key) for key in KEYS})
+        counts = collections.Counter(owners.values())
+        for node in ring.nodes:
+            self.assertGreater(counts[node], len(KEYS) / 3 * 0.7)
+        self.assertEqual(ring.owned("certbot/1", KEYS),
+                         [key for key in KEYS if owners[key] == "certbot/1"])
+
+    def test_rebalance(self):
+        nodes = ["certbot/{}".format(i) for i in range(5)]
+        before = HashRing(nodes)
+        after = HashRing(nodes + ["certbot/5"])
+        moved = [key for key in KEYS if before.owner(key) != after.owner(key)]
+        # Only keys moving to the new node change owner.
+        self.assertTrue(all(after.owner(key) == "certbot/5" for key in moved))
+        self.assertLess(len(moved), len(KEYS) / 6 * 1.3)
+        self.assertGreater(len(moved), len(KEYS) / 6 * 0.7)
+
+        removed = HashRing(nodes[1:])
+        moved = [key for key in KEYS if before.owner(key) != removed.owner(key)]
+        self.assertTrue(all(before.owner(key) == "certbot/0" for key in moved))
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            HashRing([]).owner("example.com")
@@ -0,0 +1,106 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import http01
+
+
+class TestResponder(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.webroot = tmp.name
+        os.makedirs(os.path.join(self.webroot, ".well-known", "acme-challenge"))
+        with open(os.path.join(self.webroot, ".well-known", "acme-challenge", "tok_EN-1"),
+                  "w") as f:
+            f.write("tok_EN-1.thumbprint")
+        with open(os.path.join(self.webroot, "secret"), "w") as f:
+            f.write("SECRET")
+        self.responder = http01.Responder(self.webroot, timeout=0.2)
+
+    def test_respond(self):
+        self.assertEqual(self.responder.respond("GET", "/.well-known/acme-challenge/tok_EN-1"),
+                         (200, b"tok_EN-1.thumbprint"))
+        self.assertEqual(self.responder.respond("GET", "/.well-known/acme-challenge/tok_EN-1?x"),
+                         (200, b"tok_EN-1.thumbprint"))
+        for target in ("/.well-known/acme-challenge/missing", "/.well-known/acme-challenge/",
+                       "/.well-known/acme-challenge/../../secret", "/secret", "/"):
+            self.assertEqual(self.responder.respond("GET", target), (404, b""))
+        self.assertEqual(self.responder.respond("POST", "/.well-known/acme-challenge/tok_EN-1"),
+                         (405, b""))
+
+    def _exchange(self, *requests):
+        async def exchange():
+            server = await self.responder.start("127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            responses = []
+            try:
+                for request in requests:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.write(request)
+                    await writer.drain()
+                    responses.append(await reader.read())
+                    writer.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return responses
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(exchange())
+
+    def test_serve(self):
+        ok, head, missing, bad, slow = self._exchange(
+            b"GET /.well-known/acme-challenge/tok_EN-1 HTTP/1.1\r\nHost: example.com\r\n"
+            b"User-Agent: validator\r\n\r\n",
+            b"HEAD /.well-known/acme-challenge/tok_EN-1 HTTP/1.1\r\nHost: example.com\r\n\r\n",
+            b"GET /index.html HTTP/1.0\r\n\r\n",
+            b"NONSENSE\r\n\r\n",
+            b"GET /.well-known/acme-challenge/tok_EN-1 HTTP/1.1\r\n")
+        self.assertEqual(ok, b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                             b"Content-Length: 19\r\nConnection: close\r\n\r\n"
+                             b"tok_EN-1.thumbprint")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(head.endswith(b"Content-Length: 19\r\nConnection: close\r\n\r\n"))
+        self.assertTrue(missing.startswith(b"HTTP/1.1 404 Not Found\r\n"))
+        self.assertTrue(bad.startswith(b"HTTP/1.1 400 Bad Request\r\n"))
+        # A client that never finishes its request is disconnected.
+        self.assertEqual(slow, b"")
+
+    def test_run(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "bin", "http01.py")
+        proc = subprocess.Popen([sys.executable, script, self.webroot, str(port)])
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                conn = socket.create_connection(("127.0.0.1", port), timeout=1)
+                break
+            except OSError:
+                self.assertIsNone(proc.poll())
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+        with conn:
+            conn.sendall(b"GET /.well-known/acme-challenge/tok_EN-1 HTTP/1.0\r\n\r\n")
+            response = b""
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                response += data
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(response.endswith(b"\r\n\r\ntok_EN-1.thumbprint"))
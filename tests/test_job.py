@@ -0,0 +1,144 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+import job
+import lineage
+import ratelimit
+import state
+
+_CERTBOT = """
+import sys
+print("Performing the following challenges:")
+print("Waiting 10 seconds for DNS changes to propagate")
+print("Waiting for verification...")
+sys.exit(int(sys.argv[1]))
+"""
+
+
+class TestJob(unittest.TestCase):
+    def setUp(self):
+        # Keep the job's output out of the test output.
+        for redirect in (contextlib.redirect_stdout, contextlib.redirect_stderr):
+            cm = redirect(io.StringIO())
+            cm.__enter__()
+            self.addCleanup(cm.__exit__, None, None, None)
+
+    def _job(self, dir, certbot_status=0, deploy=None, **kwargs):
+        path = os.path.join(dir, "jobs", "1.json")
+        data = {
+            "name": "example.com",
+            "domains": "example.com",
+            "status": "queued",
+            "history": [["queued", 0]],
+            "certbot": [sys.executable, "-c", _CERTBOT, str(certbot_status)],
+            "deploy": deploy or [],
+        }
+        data.update(kwargs)
+        state.save_json(path, data)
+        return path
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as dir:
+            out = os.path.join(dir, "deployed")
+            textfile = os.path.join(dir, "certbot.prom")
+            path = self._job(dir, deploy=[{
+                "cmd": ["sh", "-c", 'echo "$RENEWED_LINEAGE" > {}'.format(out)],
+                "env": {"RENEWED_LINEAGE": "/etc/letsencrypt/live/example.com"},
+            }], metrics=[os.path.join(dir, "metrics.json"), textfile])
+            job.run(path)
+            data = state.load_json(path)
+            with open(out) as f:
+                self.assertEqual(f.read(), "/etc/letsencrypt/live/example.com\n")
+            with open(textfile) as f:
+                self.assertIn('certbot_runs_total{domain="example.com",operation="issue",'
+                              'result="success"} 1\n', f.read())
+        self.assertEqual(data["status"], "done")
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertEqual([h[0] for h in data["history"]], [
+            "queued", "running", "challenge-published", "validating", "deploying", "done"])
+        self.assertEqual(data["history"], sorted(data["history"], key=lambda h: h[1]))
+
+    def test_run_certbot_env(self):
+        with tempfile.TemporaryDirectory() as dir:
+            out = os.path.join(dir, "env")
+            path = self._job(dir, certbot=[
+                "sh", "-c", 'echo "$AWS_CONFIG_FILE $PATH" > {}'.format(out)],
+                **{"certbot-env": {"AWS_CONFIG_FILE": "/etc/certbot-charm/aws/1"}})
+            job.run(path)
+            with open(out) as f:
+                self.assertEqual(f.read(), "/etc/certbot-charm/aws/1 {}\n".format(
+                    os.environ["PATH"]))
+            self.assertEqual(state.load_json(path)["status"], "done")
+
+    def test_run_failed(self):
+        with tempfile.TemporaryDirectory() as dir:
+            cred = os.path.join(dir, "action-1.cred")
+            with open(cred, "w") as f:
+                f.write("secret")
+            ledger = ratelimit.Ledger(os.path.join(dir, "ledger.json"))
+            order = ledger.reserve(["example.com"])
+            path = self._job(dir, certbot_status=1, cleanup=[cred],
+                             ledger=[os.path.join(dir, "ledger.json"), order])
+            job.run(path)
+            data = state.load_json(path)
+            self.assertFalse(os.path.exists(cred))
+            self.assertEqual(state.load_json(os.path.join(dir, "ledger.json"))[0]["status"],
+                             "failed")
+        self.assertEqual(data["status"], "failed")
+        self.assertTrue(data["error"].endswith(
+            "exited with status 1: Waiting for verification..."))
+        self.assertEqual([h[0] for h in data["history"]], [
+            "queued", "running", "challenge-published", "validating", "failed"])
+
+    def test_run_install(self):
+        with tempfile.TemporaryDirectory() as dir:
+            work_dir = os.path.join(dir, "csr", "example.com-job-1")
+            os.makedirs(work_dir)
+            for kind in lineage.LINEAGE_FILES:
+                with open(os.path.join(work_dir, kind + ".pem"), "w") as f:
+                    f.write(kind.upper())
+            config_dir = os.path.join(dir, "letsencrypt")
+            marker = os.path.join(dir, "pooled", "example.com")
+            path = self._job(dir, install={"dir": work_dir, "config-dir": config_dir,
+                                           "marker": marker})
+            job.run(path)
+            data = state.load_json(path)
+            self.assertEqual(lineage.current_files(config_dir, "example.com")["privkey"],
+                             b"PRIVKEY")
+            self.assertTrue(os.path.exists(marker))
+            self.assertFalse(os.path.exists(work_dir))
+        self.assertEqual(data["status"], "done")
+
+    def test_run_renewal_env(self):
+        with tempfile.TemporaryDirectory() as dir:
+            env_path = os.path.join(dir, "renewal-env", "example.com.json")
+            env = {"AWS_CONFIG_FILE": "/etc/certbot-charm/aws/1"}
+            job.run(self._job(dir, **{"renewal-env": [env_path, env]}))
+            self.assertEqual(state.load_json(env_path), env)
+            # A lineage issued with the default credentials forgets them.
+            job.run(self._job(dir, **{"renewal-env": [env_path, None]}))
+            self.assertFalse(os.path.exists(env_path))
+
+    def test_run_timeout(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = self._job(dir, certbot=["sleep", "10"], timeouts={"certbot": 0.2})
+            job.run(path)
+            data = state.load_json(path)
+        self.assertEqual(data["status"], "failed")
+        self.assertEqual(data["error"], "sleep timed out after 0.2s")
+
+    def test_advance(self):
+        with tempfile.TemporaryDirectory() as dir:
+            j = job.Job(self._job(dir, status="validating"))
+            j.advance("challenge-published")
+            self.assertEqual(j.status, "validating")
+            j.advance("deploying")
+            self.assertEqual(j.status, "deploying")
+            self.assertEqual(state.load_json(j.path)["status"], "deploying")
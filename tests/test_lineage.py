@@ -0,0 +1,144 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+
+import lineage
+
+
+def _write_lineage(config_dir, name, content, version=1):
+    archive = os.path.join(config_dir, "archive", name)
+    live = os.path.join(config_dir, "live", name)
+    os.makedirs(archive, exist_ok=True)
+    os.makedirs(live, exist_ok=True)
+    for kind in lineage.LINEAGE_FILES:
+        filename = "{}{}.pem".format(kind, version)
+        with open(os.path.join(archive, filename), "w") as f:
+            f.write("{} {}\n".format(kind.upper(), content))
+        link = os.path.join(live, kind + ".pem")
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.join("..", "..", "archive", name, filename), link)
+
+
+class TestLineage(unittest.TestCase):
+    def test_isolated_dirs(self):
+        with tempfile.TemporaryDirectory() as dir:
+            live = os.path.join(dir, "live")
+            os.makedirs(os.path.join(live, "accounts", "acme", "directory"))
+            with open(os.path.join(live, "accounts", "acme", "directory", "key.json"), "w") as f:
+                f.write("KEY")
+            dirs = lineage.IsolatedDirs(os.path.join(dir, "worker"))
+            _write_lineage(dirs.config_dir, "example.com", "STALE")
+            dirs.prepare(live, "example.com")
+
+            self.assertEqual(dirs.args(), [
+                "--config-dir={}".format(os.path.join(dir, "worker", "config")),
+                "--work-dir={}".format(os.path.join(dir, "worker", "work")),
+                "--logs-dir={}".format(os.path.join(dir, "worker", "logs")),
+            ])
+            self.assertTrue(os.path.isdir(dirs.work_dir))
+            self.assertTrue(os.path.isdir(dirs.logs_dir))
+            self.assertFalse(os.path.exists(
+                os.path.join(dirs.config_dir, "live", "example.com")))
+            with open(os.path.join(dirs.config_dir, "accounts", "acme", "directory",
+                                   "key.json")) as f:
+                self.assertEqual(f.read(), "KEY")
+
+    def test_latest_version(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.assertEqual(lineage.latest_version(dir, "example.com"), 0)
+            _write_lineage(dir, "example.com", "A", 1)
+            _write_lineage(dir, "example.com", "B", 12)
+            _write_lineage(dir, "example.com", "C", 3)
+            self.assertEqual(lineage.latest_version(dir, "example.com"), 12)
+
+    def test_merge_new_lineage(self):
+        with tempfile.TemporaryDirectory() as dir:
+            src = os.path.join(dir, "src")
+            dst = os.path.join(dir, "dst")
+            _write_lineage(src, "example.com", "NEW")
+            os.makedirs(os.path.join(src, "renewal"))
+            with open(os.path.join(src, "renewal", "example.com.conf"), "w") as f:
+                f.write("archive_dir = {0}/archive/example.com\n"
+                        "cert = {0}/live/example.com/cert.pem\n"
+                        "[renewalparams]\n"
+                        "work_dir = {1}/work\n"
+                        "logs_dir = {1}/logs\n"
+                        "config_dir = {0}\n".format(src, dir))
+
+            self.assertTrue(lineage.merge_lineage(src, dst, "example.com"))
+            self.assertEqual(lineage.current_files(dst, "example.com"),
+                             lineage.current_files(src, "example.com"))
+            self.assertEqual(os.readlink(os.path.join(dst, "live", "example.com", "cert.pem")),
+                             os.path.join("..", "..", "archive", "example.com", "cert1.pem"))
+            self.assertEqual(os.stat(os.path.join(dst, "archive", "example.com",
+                                                  "privkey1.pem")).st_mode & 0o777, 0o600)
+            with open(os.path.join(dst, "renewal", "example.com.conf")) as f:
+                self.assertEqual(f.read(),
+                                 "archive_dir = {0}/archive/example.com\n"
+                                 "cert = {0}/live/example.com/cert.pem\n"
+                                 "[renewalparams]\n"
+                                 "config_dir = {0}\n".format(dst))
+
+    def test_merge_new_account(self):
+        # On a fresh unit every isolated run registers its own account,
+        # which the merged renewal configuration refers to.
+        with tempfile.TemporaryDirectory() as dir:
+            src = os.path.join(dir, "src")
+            dst = os.path.join(dir, "dst")
+            _write_lineage(src, "example.com", "NEW")
+            for account in ("abc123", "def456"):
+                path = os.path.join(src, "accounts", "acme.example.com", "directory", account)
+                os.makedirs(path)
+                for filename in ("meta.json", "private_key.json", "regr.json"):
+                    with open(os.path.join(path, filename), "w") as f:
+                        f.write(account)
+            os.makedirs(os.path.join(src, "renewal"))
+            with open(os.path.join(src, "renewal", "example.com.conf"), "w") as f:
+                f.write("[renewalparams]\n"
+                        "account = abc123\n"
+                        "config_dir = {}\n".format(src))
+
+            lineage.merge_lineage(src, dst, "example.com")
+            accounts = os.path.join(dst, "accounts", "acme.example.com", "directory")
+            self.assertEqual(os.listdir(accounts), ["abc123"])
+            self.assertEqual(sorted(os.listdir(os.path.join(accounts, "abc123"))),
+                             ["meta.json", "private_key.json", "regr.json"])
+            with open(os.path.join(accounts, "abc123", "private_key.json")) as f:
+                self.assertEqual(f.read(), "abc123")
+            self.assertEqual(os.stat(os.path.join(accounts, "abc123")).st_mode & 0o777, 0o700)
+
+            # An account dst already has is not replaced.
+            with open(os.path.join(accounts, "abc123", "regr.json"), "w") as f:
+                f.write("LIVE")
+            lineage.merge_lineage(src, dst, "example.com")
+            with open(os.path.join(accounts, "abc123", "regr.json")) as f:
+                self.assertEqual(f.read(), "LIVE")
+
+    def test_merge_existing_lineage(self):
+        with tempfile.TemporaryDirectory() as dir:
+            src = os.path.join(dir, "src")
+            dst = os.path.join(dir, "dst")
+            _write_lineage(src, "example.com", "NEW")
+            _write_lineage(dst, "example.com", "OLD", 1)
+            _write_lineage(dst, "example.com", "OLDER", 2)
+
+            self.assertTrue(lineage.merge_lineage(src, dst, "example.com"))
+            self.assertEqual(lineage.latest_version(dst, "example.com"), 3)
+            with open(os.path.join(dst, "live", "example.com", "fullchain.pem")) as f:
+                self.assertEqual(f.read(), "FULLCHAIN NEW\n")
+            with open(os.path.join(dst, "archive", "example.com", "fullchain1.pem")) as f:
+                self.assertEqual(f.read(), "FULLCHAIN OLD\n")
+
+    def test_merge_unchanged_lineage(self):
+        with tempfile.TemporaryDirectory() as dir:
+            src = os.path.join(dir, "src")
+            dst = os.path.join(dir, "dst")
+            _write_lineage(src, "example.com", "SAME")
+            _write_lineage(dst, "example.com", "SAME")
+
+            self.assertFalse(lineage.merge_lineage(src, dst, "example.com"))
+            self.assertEqual(lineage.latest_version(dst, "example.com"), 1)
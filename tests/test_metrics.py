@@ -0,0 +1,107 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled(self):
+        with tempfile.TemporaryDirectory() as dir:
+            m = metrics.Metrics(os.path.join(dir, "metrics.json"), "")
+            self.assertFalse(m.enabled)
+            m.record_run("example.com", "issue", True, 1.0, 2.0)
+            m.record_deploy_command(True, 1.0)
+            m.set_expiry("example.com", 2000000000)
+            self.assertEqual(os.listdir(dir), [])
+
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as dir:
+            textfile = os.path.join(dir, "textfile", "certbot.prom")
+            m = metrics.Metrics(os.path.join(dir, "metrics.json"), textfile)
+            with patch("time.time", return_value=1700000000.5):
+                m.record_run("example.com", "issue", True, 12.5, 0.25)
+            with patch("time.time", return_value=1700000100.0):
+                m.record_run("example.com", "renew", False, 3.0)
+                m.record_deploy_command(False, 0.5)
+            m.record_install("apt", 42.5)
+            m.set_expiry("example.com", 1800000000.0)
+            m.set_expiry("b.example.com", 1900000000.0)
+            with open(textfile) as f:
+                text = f.read()
+            self.assertEqual(os.stat(textfile).st_mode & 0o777, 0o644)
+
+        self.assertEqual(text, """\
+# HELP certbot_certificate_expiry_timestamp_seconds Time at which the certificate expires.
+# TYPE certbot_certificate_expiry_timestamp_seconds gauge
+certbot_certificate_expiry_timestamp_seconds{domain="b.example.com"} 1900000000.0
+certbot_certificate_expiry_timestamp_seconds{domain="example.com"} 1800000000.0
+# HELP certbot_run_timestamp_seconds Time of the last issuance or renewal attempt.
+# TYPE certbot_run_timestamp_seconds gauge
+certbot_run_timestamp_seconds{domain="example.com",operation="issue"} 1700000000.5
+certbot_run_timestamp_seconds{domain="example.com",operation="renew"} 1700000100.0
+# HELP certbot_run_success_timestamp_seconds Time of the last successful issuance or renewal.
+# TYPE certbot_run_success_timestamp_seconds gauge
+certbot_run_success_timestamp_seconds{domain="example.com",operation="issue"} 1700000000.5
+# HELP certbot_run_certbot_seconds Time spent running certbot in the last issuance or renewal \
+attempt.
+# TYPE certbot_run_certbot_seconds gauge
+certbot_run_certbot_seconds{domain="example.com",operation="issue"} 12.5
+certbot_run_certbot_seconds{domain="example.com",operation="renew"} 3.0
+# HELP certbot_run_deploy_seconds Time spent deploying the certificate in the last issuance or \
+renewal attempt.
+# TYPE certbot_run_deploy_seconds gauge
+certbot_run_deploy_seconds{domain="example.com",operation="issue"} 0.25
+# HELP certbot_runs_total Number of issuance or renewal attempts.
+# TYPE certbot_runs_total counter
+certbot_runs_total{domain="example.com",operation="issue",result="success"} 1
+certbot_runs_total{domain="example.com",operation="issue",result="failure"} 0
+certbot_runs_total{domain="example.com",operation="renew",result="success"} 0
+certbot_runs_total{domain="example.com",operation="renew",result="failure"} 1
+# HELP certbot_deploy_command_timestamp_seconds Time the deploy command was last run.
+# TYPE certbot_deploy_command_timestamp_seconds gauge
+certbot_deploy_command_timestamp_seconds 1700000100.0
+# HELP certbot_deploy_command_seconds Duration of the last run of the deploy command.
+# TYPE certbot_deploy_command_seconds gauge
+certbot_deploy_command_seconds 0.5
+# HELP certbot_deploy_command_runs_total Number of runs of the deploy command.
+# TYPE certbot_deploy_command_runs_total counter
+certbot_deploy_command_runs_total{result="success"} 0
+certbot_deploy_command_runs_total{result="failure"} 1
+# HELP certbot_install_seconds Time spent installing packages in the install hook, by where \
+they came from.
+# TYPE certbot_install_seconds gauge
+certbot_install_seconds{source="apt"} 42.5
+""")
+
+    def test_counters_persist(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "metrics.json")
+            textfile = os.path.join(dir, "certbot.prom")
+            for _ in range(3):
+                metrics.Metrics(path, textfile).record_run("example.com", "renew", True)
+            with open(textfile) as f:
+                self.assertIn('certbot_runs_total{domain="example.com",operation="renew",'
+                              'result="success"} 3\n', f.read())
+
+    def test_replace_expiry(self):
+        with tempfile.TemporaryDirectory() as dir:
+            textfile = os.path.join(dir, "certbot.prom")
+            m = metrics.Metrics(os.path.join(dir, "metrics.json"), textfile)
+            m.set_expiry("a.example.com", 1800000000)
+            m.replace_expiry({"b.example.com": 1900000000})
+            with open(textfile) as f:
+                text = f.read()
+        self.assertNotIn("a.example.com", text)
+        self.assertIn('{domain="b.example.com"} 1900000000\n', text)
+
+    def test_render_escapes_labels(self):
+        text = metrics.render({"expiry": {'a"b\\c\nd': 1.0}})
+        self.assertIn('{domain="a\\"b\\\\c\\nd"} 1.0\n', text)
+
+    def test_render_empty(self):
+        self.assertEqual(metrics.render({}), "")
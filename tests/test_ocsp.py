@@ -0,0 +1,95 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import os
+import subprocess
+import tempfile
+import unittest
+
+import ocsp
+import x509
+from tests.stubocsp import StubCA, StubOCSPResponder
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class TestOCSP(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.responder = StubOCSPResponder(self.dir)
+        self.addCleanup(self.responder.close)
+        self.responder.ca.issue("example.com", 0x1234)
+        self.cert = os.path.join(self.dir, "example.com.pem")
+        self.issuer = self.responder.ca.pem
+
+    def test_certificate_fields(self):
+        cert = x509.parse_pem_file(self.cert)
+        self.assertEqual(cert.ocsp_urls, [self.responder.ca.ocsp_url])
+        self.assertEqual(cert.serial, 0x1234)
+
+    def test_fetch(self):
+        self.responder.minutes = 120
+        response = ocsp.fetch(self.cert, self.issuer)
+        self.assertEqual(len(self.responder.requests), 1)
+        self.assertEqual(response.status, "good")
+        self.assertEqual(response.serial, 0x1234)
+        self.assertEqual(response.next_update - response.this_update,
+                         datetime.timedelta(hours=2))
+        self.assertEqual(response.refresh_at(),
+                         response.this_update + datetime.timedelta(hours=1))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.assertLess(abs(response.this_update - now), datetime.timedelta(minutes=1))
+        self.assertEqual(ocsp.parse_response(response.der, self.cert, self.issuer).der,
+                         response.der)
+
+    def test_fetch_revoked(self):
+        self.responder.ca.revoked.add(0x1234)
+        self.assertEqual(ocsp.fetch(self.cert, self.issuer).status, "revoked")
+
+    def test_fetch_error(self):
+        self.responder.fail = True
+        with self.assertRaises(ocsp.OCSPError) as cm:
+            ocsp.fetch(self.cert, self.issuer)
+        self.assertIn("Error querying OCSP responder", str(cm.exception))
+
+    def test_no_responder(self):
+        with self.assertRaises(ocsp.OCSPError):
+            ocsp.fetch(os.path.join(DATA, "rsa.pem"), self.issuer)
+
+    def test_other_certificate(self):
+        self.responder.ca.issue("other.example.com", 0x5678)
+        response = ocsp.fetch(self.cert, self.issuer)
+        with self.assertRaises(ocsp.OCSPError) as cm:
+            ocsp.parse_response(response.der, os.path.join(self.dir, "other.example.com.pem"),
+                                self.issuer)
+        self.assertIn("No Status found", str(cm.exception))
+
+    def test_forged(self):
+        # A response signed by a key the issuer did not delegate to.
+        response = ocsp.fetch(self.cert, self.issuer)
+        os.mkdir(os.path.join(self.dir, "forged"))
+        forged = StubCA(os.path.join(self.dir, "forged"), self.responder.ca.ocsp_url)
+        # The stub CA keeps its index and the last request in its directory.
+        subprocess.run(["openssl", "ocsp", "-index", os.path.join(self.dir, "index.txt"),
+                        "-CA", self.issuer, "-rsigner", forged.pem,
+                        "-rkey", os.path.join(self.dir, "forged", "ca.key"),
+                        "-reqin", os.path.join(self.dir, "request.der"),
+                        "-respout", os.path.join(self.dir, "forged.der")],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with open(os.path.join(self.dir, "forged.der"), "rb") as f:
+            der = f.read()
+        self.assertNotEqual(der, response.der)
+        with self.assertRaises(ocsp.OCSPError) as cm:
+            ocsp.parse_response(der, self.cert, self.issuer)
+        self.assertIn("Response Verify Failure", str(cm.exception))
+
+    def test_unsuccessful(self):
+        with self.assertRaises(ocsp.OCSPError) as cm:
+            ocsp.parse_response(b"\x30\x03\x0a\x01\x03", self.cert, self.issuer)
+        self.assertEqual(str(cm.exception),
+                         "unusable OCSP response: Responder Error: trylater (3)")
+        with self.assertRaises(ocsp.OCSPError):
+            ocsp.parse_response(b"\x30\x05\x0a\x01\x00\xa0\x00", self.cert, self.issuer)
@@ -0,0 +1,85 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import unittest
+
+import planner
+
+SITES = ["h{}.example.com".format(i) for i in range(150)]
+
+
+class TestPlanner(unittest.TestCase):
+    def test_parse_hostnames(self):
+        text = " A.example.com,b.example.com.\n*.c.com, a.example.com"
+        self.assertEqual(planner.parse_hostnames(text),
+                         ["a.example.com", "b.example.com", "*.c.com"])
+        self.assertEqual(planner.parse_hostnames(""), [])
+        for text in ("a..example.com", "a.*.example.com", "-a.example.com", "example"):
+            with self.assertRaises(ValueError):
+                planner.parse_hostnames(text)
+
+    def test_registered_domain(self):
+        self.assertEqual(planner.registered_domain("a.b.example.com"), "example.com")
+        self.assertEqual(planner.registered_domain("*.example.com"), "example.com")
+        self.assertEqual(planner.registered_domain("www.example.co.uk"), "example.co.uk")
+
+    def test_covered(self):
+        wildcards = {"*.example.com"}
+        self.assertTrue(planner.covered("www.example.com", wildcards))
+        self.assertFalse(planner.covered("example.com", wildcards))
+        self.assertFalse(planner.covered("a.www.example.com", wildcards))
+        self.assertFalse(planner.covered("*.example.com", wildcards))
+
+    def test_plan(self):
+        plan = planner.plan(SITES + ["*.a.com", "www.a.com", "a.com"])
+        self.assertEqual(sorted(len(d) for d in plan.certificates.values()), [52, 100])
+        self.assertEqual(plan.changed, sorted(plan.certificates))
+        self.assertEqual(plan.removed, [])
+        names = [d for domains in plan.certificates.values() for d in domains]
+        self.assertNotIn("www.a.com", names)
+        self.assertEqual(sorted(names), sorted(SITES + ["*.a.com", "a.com"]))
+        # The names of a registered domain are kept together.
+        a = [lineage for lineage, domains in plan.certificates.items() if "a.com" in domains]
+        self.assertIn("*.a.com", plan.certificates[a[0]])
+        for lineage, domains in plan.certificates.items():
+            self.assertEqual(domains[0], lineage)
+
+    def test_plan_max_names(self):
+        plan = planner.plan(SITES, max_names=40)
+        self.assertEqual(sorted(len(d) for d in plan.certificates.values()), [30, 40, 40, 40])
+        plan = planner.plan(SITES, max_names=1000)
+        self.assertEqual(sorted(len(d) for d in plan.certificates.values()), [50, 100])
+
+    def test_plan_isolate(self):
+        names = ["a.com", "www.a.com", "b.com", "www.b.com"]
+        self.assertEqual(len(planner.plan(names).certificates), 1)
+        plan = planner.plan(names, isolate=True)
+        self.assertEqual(plan.certificates, {
+            "a.com": ["a.com", "www.a.com"],
+            "b.com": ["b.com", "www.b.com"],
+        })
+
+    def test_plan_stable(self):
+        before = planner.plan(SITES + ["a.com", "www.a.com"])
+        self.assertEqual(planner.plan(SITES + ["a.com", "www.a.com"],
+                                      before.certificates).changed, [])
+
+        # A new name only changes the certificate it is added to.
+        after = planner.plan(SITES + ["a.com", "www.a.com", "api.a.com"], before.certificates)
+        self.assertEqual(len(after.changed), 1)
+        self.assertIn("api.a.com", after.certificates[after.changed[0]])
+        self.assertEqual(set(after.certificates), set(before.certificates))
+
+        # Removing a name only changes the certificate that held it.
+        after = planner.plan(SITES[1:] + ["a.com", "www.a.com"], before.certificates)
+        self.assertEqual(len(after.changed), 1)
+        self.assertNotIn("h0.example.com", after.certificates[after.changed[0]])
+
+        # Certificates with no wanted names are removed.
+        after = planner.plan(["a.com", "www.a.com"], before.certificates)
+        self.assertEqual(len(after.certificates), 1)
+        self.assertEqual(len(after.removed), 1)
+
+    def test_plan_reserved(self):
+        plan = planner.plan(["a.com"], reserved=["a.com", "a.com-0001"])
+        self.assertEqual(plan.certificates, {"a.com-0002": ["a.com"]})
@@ -0,0 +1,64 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import sys
+import types
+import unittest
+from unittest.mock import Mock, patch
+
+import propagation
+
+
+class FakeAuthenticator:
+    dest_namespace = "dns_test_"
+
+    def __init__(self, propagation_seconds):
+        self.config = types.SimpleNamespace(dns_test_propagation_seconds=propagation_seconds)
+        self.slept = None
+
+    def dest(self, var):
+        return self.dest_namespace + var.replace("-", "_")
+
+    def perform(self, achalls):
+        self.slept = getattr(self.config, self.dest("propagation-seconds"))
+        return ["response"]
+
+
+class TestPropagation(unittest.TestCase):
+    def setUp(self):
+        dns_common = types.ModuleType("certbot.plugins.dns_common")
+        dns_common.DNSAuthenticator = type("DNSAuthenticator", (FakeAuthenticator,), {})
+        modules = {
+            "certbot": types.ModuleType("certbot"),
+            "certbot.plugins": types.ModuleType("certbot.plugins"),
+            "certbot.plugins.dns_common": dns_common,
+        }
+        modules["certbot.plugins"].dns_common = dns_common
+        patcher = patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dns_common = dns_common
+
+    @patch("dnsquery.wait_for_txt")
+    def test_install(self, wait):
+        propagation.install(resolver="10.0.0.1", interval=1.0)
+        propagation.install(resolver="10.0.0.1", interval=1.0)
+        auth = self.dns_common.DNSAuthenticator(120)
+        achall = Mock(domain="example.com")
+        achall.validation_domain_name.return_value = "_acme-challenge.example.com"
+        achall.validation.return_value = "token"
+        self.assertEqual(auth.perform([achall]), ["response"])
+        self.assertEqual(auth.slept, 0)
+        self.assertEqual(auth.config.dns_test_propagation_seconds, 120)
+        wait.assert_called_once_with([("_acme-challenge.example.com", "token")], 120,
+                                     resolver="10.0.0.1", interval=1.0)
+
+    def test_parse_args(self):
+        self.assertEqual(propagation.parse_args(["certonly", "-n"]),
+                         ({"resolver": None, "interval": 2.0}, ["certonly", "-n"]))
+        self.assertEqual(
+            propagation.parse_args(["--resolver=10.0.0.1", "--interval=0.5", "--",
+                                    "certonly", "--", "-n"]),
+            ({"resolver": "10.0.0.1", "interval": 0.5}, ["certonly", "--", "-n"]))
+        with self.assertRaises(ValueError):
+            propagation.parse_args(["--unknown", "--", "certonly"])
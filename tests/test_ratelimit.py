@@ -0,0 +1,75 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import ratelimit
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        dir = tempfile.TemporaryDirectory()
+        self.addCleanup(dir.cleanup)
+        self.path = os.path.join(dir.name, "ledger.json")
+
+    def test_parse_limits(self):
+        limits = ratelimit.parse_limits("orders=10, duplicates=0,unknown=1,failed-validations=x")
+        self.assertEqual(limits["orders"], (10, datetime.timedelta(hours=3)))
+        self.assertNotIn("duplicates", limits)
+        self.assertEqual(limits["failed-validations"],
+                         ratelimit.LIMITS["failed-validations"])
+        self.assertEqual(ratelimit.parse_limits(""), ratelimit.LIMITS)
+
+    def test_orders(self):
+        ledger = ratelimit.Ledger(self.path, ratelimit.parse_limits("orders=2"))
+        first = NOW - datetime.timedelta(hours=2)
+        ledger.finish(ledger.reserve(["a.example.com"], now=first), True)
+        ledger.reserve(["b.example.com"], now=NOW)
+        self.assertEqual(ledger.check(["c.example.com"], now=NOW),
+                         ("orders", first + datetime.timedelta(hours=3)))
+        with self.assertRaises(ratelimit.RateLimited) as cm:
+            ledger.reserve(["c.example.com"], now=NOW)
+        self.assertEqual(cm.exception.limit, "orders")
+        self.assertIsNone(ledger.check(["c.example.com"], now=NOW + datetime.timedelta(hours=1)))
+
+    def test_certificates_per_domain(self):
+        ledger = ratelimit.Ledger(self.path, ratelimit.parse_limits(
+            "certificates-per-domain=2"))
+        # Failed orders and renewals are not counted.
+        ledger.finish(ledger.reserve(["c.example.com"], now=NOW), False)
+        ledger.finish(ledger.reserve(["d.example.com"], renewal=True, now=NOW), True)
+        ledger.finish(ledger.reserve(["a.example.com"], now=NOW), True)
+        ledger.finish(ledger.reserve(["b.example.com", "other.com"], now=NOW), True)
+        self.assertEqual(ledger.check(["e.example.com", "e.com"], now=NOW)[0],
+                         "certificates-per-domain")
+        self.assertIsNone(ledger.check(["e.example.com"], renewal=True, now=NOW))
+        self.assertIsNone(ledger.check(["www.example.co.uk"], now=NOW))
+
+    def test_duplicates(self):
+        ledger = ratelimit.Ledger(self.path, ratelimit.parse_limits("duplicates=1"))
+        ledger.finish(ledger.reserve(["a.example.com", "b.example.com"], now=NOW), True)
+        self.assertEqual(ledger.check(["b.example.com", "a.example.com"], renewal=True,
+                                      now=NOW),
+                         ("duplicates", NOW + datetime.timedelta(days=7)))
+        self.assertIsNone(ledger.check(["a.example.com"], now=NOW))
+
+    def test_failed_validations(self):
+        ledger = ratelimit.Ledger(self.path, ratelimit.parse_limits("failed-validations=1"))
+        ledger.finish(ledger.reserve(["a.example.com"]), False)
+        limited = ledger.check(["a.example.com", "b.example.com"])
+        self.assertEqual(limited[0], "failed-validations")
+        self.assertGreater(limited[1], NOW + datetime.timedelta(minutes=59))
+        self.assertIsNone(ledger.check(["b.example.com"]))
+
+    def test_prune(self):
+        ledger = ratelimit.Ledger(self.path)
+        ledger.finish(ledger.reserve(["a.example.com"], now=NOW - datetime.timedelta(days=8)),
+                      True)
+        ledger.reserve(["b.example.com"], now=NOW)
+        self.assertEqual([o["domains"] for o in ratelimit.state.load_json(self.path)],
+                         [["b.example.com"]])
@@ -0,0 +1,65 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import base64
+import json
+import os
+import tempfile
+import unittest
+
+import lineage
+import replication
+
+FILES = {"cert": b"CERT", "chain": b"CHAIN", "fullchain": b"FULLCHAIN", "privkey": b"KEY"}
+
+
+class TestReplication(unittest.TestCase):
+    def test_pack(self):
+        cipher = replication.Cipher("secret")
+        value = replication.pack(FILES, cipher)
+        digest, files = replication.unpack(value, cipher)
+        self.assertEqual(files, FILES)
+        self.assertEqual(replication.value_hash(value), digest)
+        self.assertEqual(digest, cipher.digest(dict(reversed(list(FILES.items())))))
+        self.assertNotEqual(digest, replication.unpack(
+            replication.pack(dict(FILES, privkey=b"OTHER"), cipher), cipher)[0])
+        self.assertNotIn(b"KEY", base64.b64decode(json.loads(value)["data"]))
+
+    def test_unpack_wrong_key(self):
+        value = replication.pack(FILES, replication.Cipher("secret"))
+        other = replication.Cipher("other")
+        self.assertNotEqual(replication.value_hash(value), other.digest(FILES))
+        with self.assertRaises(ValueError):
+            replication.unpack(value, other)
+
+    def test_unpack_invalid(self):
+        cipher = replication.Cipher("secret")
+        for value in ("", "[]", '{"hash": "x"}', '{"hash": "x", "data": "!"}',
+                      '{"hash": "x", "data": "eA=="}'):
+            with self.assertRaises(ValueError):
+                replication.unpack(value, cipher)
+        self.assertIsNone(replication.value_hash(None))
+        self.assertIsNone(replication.value_hash("[]"))
+
+    def test_read_lineage(self):
+        with tempfile.TemporaryDirectory() as dir:
+            lineage.install_version(dir, "example.com", FILES)
+            self.assertEqual(replication.read_lineage(dir, "example.com"), FILES)
+            os.makedirs(os.path.join(dir, "renewal"))
+            with open(os.path.join(dir, "renewal", "example.com.conf"), "w") as f:
+                f.write("version = 1.0\n")
+            files = replication.read_lineage(dir, "example.com")
+            self.assertEqual(files["renewal"], b"version = 1.0\n")
+            self.assertEqual(replication.lineage_files(files), FILES)
+
+    def test_tree(self):
+        with tempfile.TemporaryDirectory() as dir:
+            src = os.path.join(dir, "src")
+            files = {"a": b"A", os.path.join("b", "c", "d"): b"D"}
+            replication.write_tree(src, files)
+            self.assertEqual(replication.read_tree(src), files)
+            self.assertEqual(os.stat(os.path.join(src, "b", "c", "d")).st_mode & 0o777, 0o600)
+            self.assertEqual(replication.read_tree(os.path.join(dir, "missing")), {})
+            with self.assertRaises(ValueError):
+                replication.write_tree(src, {os.path.join("..", "escape"): b"X"})
+            self.assertFalse(os.path.exists(os.path.join(dir, "escape")))
@@ -0,0 +1,60 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import unittest
+
+import scheduler
+
+DAY = datetime.timedelta(days=1)
+
+
+def _entry(name, not_after):
+    return {"name": name, "not-after": not_after}
+
+
+class TestScheduler(unittest.TestCase):
+    def test_jitter(self):
+        window = datetime.timedelta(hours=24)
+        j = scheduler.jitter("certbot/0", "example.com", window)
+        self.assertEqual(j, scheduler.jitter("certbot/0", "example.com", window))
+        self.assertNotEqual(j, scheduler.jitter("certbot/1", "example.com", window))
+        self.assertNotEqual(j, scheduler.jitter("certbot/0", "www.example.com", window))
+        jitters = [scheduler.jitter("certbot/{}".format(i), "example.com", window)
+                   for i in range(100)]
+        self.assertTrue(all(datetime.timedelta(0) <= j < window for j in jitters))
+        # The jitter should be spread across the window.
+        self.assertLess(min(jitters), window / 4)
+        self.assertGreater(max(jitters), window * 3 / 4)
+        self.assertEqual(scheduler.jitter("certbot/0", "example.com", datetime.timedelta(0)),
+                         datetime.timedelta(0))
+
+    def test_due_time(self):
+        entry = _entry("example.com", "2030-01-31T00:00:00+00:00")
+        due = scheduler.due_time(entry, "certbot/0", 30 * DAY, DAY)
+        start = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertTrue(start <= due < start + DAY)
+        self.assertEqual(scheduler.due_time(entry, "certbot/0", 30 * DAY, datetime.timedelta(0)),
+                         start)
+
+    def test_select_due(self):
+        entries = [
+            _entry("later.example.com", "2030-03-01T00:00:00+00:00"),
+            _entry("due.example.com", "2030-01-20T00:00:00+00:00"),
+            _entry("sooner.example.com", "2030-01-10T00:00:00+00:00"),
+            _entry("window.example.com", "2030-01-31T12:00:00+00:00"),
+        ]
+        now = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            [e["name"] for e in scheduler.select_due(entries, now, "certbot/0", 30 * DAY, DAY)],
+            ["sooner.example.com", "due.example.com"])
+        self.assertEqual(
+            [e["name"] for e in scheduler.select_due(entries, now, "certbot/0", 31 * DAY,
+                                                     datetime.timedelta(0))],
+            ["sooner.example.com", "due.example.com", "window.example.com"])
+        # Renewal times suggested by the CA replace the calculated ones.
+        renew_at = {"later.example.com": now - DAY, "due.example.com": now + DAY}
+        self.assertEqual(
+            [e["name"] for e in scheduler.select_due(entries, now, "certbot/0", 30 * DAY, DAY,
+                                                     renew_at)],
+            ["sooner.example.com", "later.example.com"])
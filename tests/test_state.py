@@ -0,0 +1,23 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import unittest
+
+import state
+
+UTC = datetime.timezone.utc
+
+
+class TestState(unittest.TestCase):
+    def test_parse_time(self):
+        for t in (datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=UTC),
+                  datetime.datetime(2026, 1, 2, 3, 4, 5, 123456, tzinfo=UTC),
+                  datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(
+                      -datetime.timedelta(hours=5, minutes=30))),
+                  datetime.datetime(2026, 1, 2, 3, 4, 5)):
+            parsed = state.parse_time(t.isoformat())
+            self.assertEqual(parsed, t)
+            self.assertEqual(parsed.utcoffset(), t.utcoffset())
+        with self.assertRaises(ValueError):
+            state.parse_time("2026-01-02")
@@ -0,0 +1,64 @@
+# Copyright 2020 Canonical Ltd
+# See LICENSE file for licensing details.
+
+import datetime
+import os
+import unittest
+
+import x509
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def _read(name):
+    with open(os.path.join(DATA, name), "rb") as f:
+        return f.read()
+
+
+class TestCertificate(unittest.TestCase):
+    def test_rsa(self):
+        c = x509.Certificate.from_pem(_read("rsa.pem"))
+        self.assertEqual(c.serial, 0x1234abcd)
+        self.assertEqual(c.common_name, "example.com")
+        self.assertEqual(c.sans, ["example.com", "www.example.com"])
+        self.assertEqual(c.domains, ["example.com", "www.example.com"])
+        self.assertEqual(c.key_type, "rsa")
+        self.assertEqual(c.key_size, 2048)
+        self.assertIsNone(c.curve)
+        self.assertEqual(c.not_before, datetime.datetime(2026, 10, 16, 20, 51, 21,
+                                                         tzinfo=datetime.timezone.utc))
+        self.assertEqual(c.not_after, datetime.datetime(2036, 10, 13, 20, 51, 21,
+                                                        tzinfo=datetime.timezone.utc))
+
+    def test_ecdsa(self):
+        c = x509.Certificate.from_pem(_read("ec.pem"))
+        self.assertEqual(c.serial, 7)
+        self.assertEqual(c.domains, ["ec.example.com", "*.ec.example.com"])
+        self.assertEqual(c.key_type, "ecdsa")
+        self.assertIsNone(c.key_size)
+        self.assertEqual(c.curve, "secp256r1")
+        self.assertEqual(c.not_after, datetime.datetime(2026, 11, 15, 20, 51, 21,
+                                                        tzinfo=datetime.timezone.utc))
+
+    def test_chain(self):
+        certs = x509.pem_certificates(_read("ec.pem") + b"\n" + _read("rsa.pem"))
+        self.assertEqual(len(certs), 2)
+        self.assertEqual(x509.Certificate(certs[1]).common_name, "example.com")
+
+    def test_invalid(self):
+        with self.assertRaises(x509.CertificateError):
+            x509.Certificate.from_pem(b"not a certificate")
+        with self.assertRaises(x509.CertificateError):
+            x509.Certificate(x509.pem_certificates(_read("rsa.pem"))[0][:100])
+
+    def test_authority_key_id(self):
+        c = x509.Certificate.from_pem(_read("rsa.pem"))
+        self.assertEqual(c.authority_key_id.hex(), "1a3fd8f8de691bc60467bc3ab055d112bad22855")
+        self.assertEqual(c.ocsp_urls, [])
+
+    def test_decode_time(self):
+        self.assertEqual(x509.decode_time("Jun  1 12:00:05 2020 GMT"),
+                         datetime.datetime(2020, 6, 1, 12, 0, 5, tzinfo=datetime.timezone.utc))
+        for text in ("Jun 1 2020", "Jun  1 12:00:05 2020 CET", "Foo  1 12:00:05 2020 GMT"):
+            with self.assertRaises(x509.CertificateError):
+                x509.decode_time(text)